@@ -1,15 +1,33 @@
+import asyncio
+import atexit
+import functools
 import json
+import time
+import websockets
+from collections import deque
+from collections.abc import Iterator
 from multiprocessing import Process
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 
-from dipla.api_support import script_templates
+from dipla.api_support import script_templates, file_splits
 from dipla.api_support.function_serialise import get_encoded_script
+from dipla.api_support.function_serialise import get_encoded_pipeline_script
 from dipla.server.dashboard import DashboardServer
 from dipla.server.result_verifier import ResultVerifier
+from dipla.server import result_cache, query_plan, reducers, local_executor
+from dipla.server.scheduler import Scheduler
+from dipla.server.local_executor import LocalExecutor
+from dipla.server.heartbeat import HeartbeatMonitor
+from dipla.server.reduce_sizer import ReduceSizer
+from dipla.server.server_pool import ServerTaskPool
+from dipla.server.shuffle import Shuffle, check_pairs
 from dipla.server.server import BinaryManager, Server, ServerServices
 from dipla.server.task_queue import TaskQueue, Task, DataSource, MachineType
-from dipla.shared import uid_generator, statistics
+from dipla.server.task_queue import PriorityMode, IteratorStream, DataStreamer
+from dipla.server.task_queue import AsyncIteratorStream
+from dipla.shared import uid_generator, statistics, broadcasts, sketches
+from dipla.shared.message_generator import generate_message
 from dipla.client.client_factory import ClientFactory
 from dipla.client.config_handler import ConfigHandler
 
@@ -25,6 +43,12 @@ class Dipla:
         "num_idle_workers": 0,
         "start_time": "",
         "num_results_from_clients": 0,
+        "num_cache_hits": 0,
+        "num_cache_misses": 0,
+        "cache_hit_ratio": 0,
+        "num_rounds": 0,
+        "last_round_time": 0,
+        "mean_round_time": 0,
     }
     stat_updater = statistics.StatisticsUpdater(_stats)
     # This is a dictionary of function id to a function that creates a
@@ -46,17 +70,193 @@ class Dipla:
     _reduce_task_group_sizes = dict()
 
     _use_control_webpage = False
+    # The SchedulingPolicy used by the server, None uses the default
+    _scheduling_policy = None
+    # The keyword arguments for the server's LocalExecutor, or None if
+    # every input is sent to the workers
+    _local_execution = None
+    # The keyword arguments for the server's ServerTaskPool, or None if
+    # the functions of server tasks are run on the event loop
+    _server_pool = None
+    # The keyword arguments for the server's HeartbeatMonitor, or None if
+    # no heartbeats are sent
+    _heartbeat = {'interval': 5.0, 'timeout': 20.0}
+    # The keyword arguments for the server's ReduceSizer, or None if
+    # reduce tasks keep their group sizes and run entirely on workers
+    _reduce_sizing = {'server_threshold': 16, 'max_group_time': 5.0}
+    # The Session that is currently open, if any
+    _session = None
+    # Dictionary of broadcast key to serialised value, for every value
+    # that has been broadcast
+    _broadcasts = dict()
+    # Dictionary of function id to the function_namespace of each
+    # function whose results are cached
+    _cached_functions = dict()
+    # Set of the ids of the functions whose results are kept on the
+    # workers that computed them
+    _resident_functions = set()
+    # Dictionary of function id to the resources a worker must have to
+    # run the function. See Worker.satisfies
+    _function_requirements = dict()
+    # Set of the ids of the reduce functions that are also run as a
+    # combiner by the workers of the distributable they are applied to
+    _combining_functions = set()
+    # Where the result cache is stored and its maximum size in bytes. The
+    # ResultCache itself is only opened when a cached function is applied
+    _result_cache_path = 'dipla_cache.db'
+    _result_cache_max_size = 256 * 1024 * 1024
+    _result_cache = None
+    # Dictionary of the uid of each task that was fused into the task
+    # reading it to the (function, arguments) it was created from
+    _fused_tasks = dict()
+    # Dictionary of the name of each fused task's binary to the list of
+    # ids of the functions it applies
+    _fused_pipelines = dict()
+    # True once the user has chosen a PriorityMode, which QueryPlans then
+    # leave alone
+    _priority_mode_chosen = False
+    # Dictionary of the name of each binary that applies a reduce
+    # distributable to every key of a partition of a shuffle, to the id
+    # of the function it applies. See Dipla.reduce_by_key
+    _keyed_reducers = dict()
 
     @staticmethod
     def use_control_webpage():
         Dipla._use_control_webpage = True
 
+    @staticmethod
+    def set_scheduling_policy(policy):
+        """
+        Set the policy the server uses to decide which task input is sent
+        to which worker, e.g. a FifoPolicy, LocalityPolicy,
+        FairSharePolicy or AffinityPolicy from dipla.server.scheduler
+        """
+        Dipla._scheduling_policy = policy
+
+    @staticmethod
+    def enable_local_execution(max_workers=None, margin=2.0):
+        """
+        Let the server run the inputs of cheap distributables in a pool
+        of local processes, whenever sending them to the workers is
+        measured to be slower. See dipla.server.local_executor
+
+        Params:
+         - max_workers: The number of local processes, which defaults to
+        the number of CPUs
+         - margin: How many times quicker running a task locally must be
+        measured to be before it is run locally
+        """
+        Dipla._local_execution = {
+            'max_workers': max_workers,
+            'margin': margin,
+        }
+
+    @staticmethod
+    def set_server_pool(kind='thread', max_workers=None):
+        """
+        Set where the server runs the functions of server tasks, such as
+        the functions decorated with Dipla.data_source. By default they
+        run on the server's event loop. On a pool the server keeps talking
+        to workers while data is being read, and their results are still
+        kept in the order the values were read.
+
+        Params:
+         - kind: 'thread' for a pool of threads, 'process' for a pool of
+        processes, which suits functions that use the CPU, or None to run
+        them on the server's event loop
+         - max_workers: The number of threads or processes, which defaults
+        to the number of CPUs
+        """
+        if kind is None:
+            Dipla._server_pool = None
+            return
+        if kind not in ('thread', 'process'):
+            raise ValueError("kind must be 'thread', 'process' or None")
+        Dipla._server_pool = {'kind': kind, 'max_workers': max_workers}
+
+    @staticmethod
+    def set_heartbeat(interval=5.0, timeout=20.0):
+        """
+        Set how often the server sends heartbeats to the workers, which
+        measure each worker's round trip time and bandwidth, and how long
+        a worker can be silent for before it is removed and the input it
+        was running is given to another worker. See dipla.server.heartbeat
+
+        Params:
+         - interval: The number of seconds between heartbeats, or None to
+        send no heartbeats
+         - timeout: The number of seconds a worker can be silent for, which
+        must be longer than the interval
+        """
+        if interval is None:
+            Dipla._heartbeat = None
+            return
+        if timeout <= interval:
+            raise ValueError("The timeout must be longer than the interval")
+        Dipla._heartbeat = {'interval': interval, 'timeout': timeout}
+
+    @staticmethod
+    def set_reduce_sizing(enabled=True, server_threshold=16,
+                          max_group_time=5.0):
+        """
+        Set how the server sizes the groups of reduce distributables while
+        they run. Reduce distributables not given an `n` have each group
+        sized to split the values waiting between the idle workers, and
+        every reduce distributable's last values are reduced by the server
+        itself. See dipla.server.reduce_sizer
+
+        Params:
+         - enabled: False to keep every group size fixed and send every
+        group to a worker
+         - server_threshold: The number of values left below which the
+        server reduces them itself
+         - max_group_time: The most seconds a worker should spend on one
+        group
+        """
+        if not enabled:
+            Dipla._reduce_sizing = None
+            return
+        Dipla._reduce_sizing = {'server_threshold': server_threshold,
+                                'max_group_time': max_group_time}
+
+    @staticmethod
+    def set_priority_mode(mode):
+        """
+        Set the order in which tasks with available input are considered
+        when choosing what to run next.
+
+        Params:
+         - mode: A PriorityMode from dipla.server.task_queue. Use
+        PriorityMode.downstream_first to keep data flowing through a
+        pipeline rather than building up between stages, or
+        PriorityMode.critical_path to favour the longest chain of tasks.
+        """
+        Dipla.task_queue.set_priority_mode(mode)
+        Dipla._priority_mode_chosen = True
+
+    @staticmethod
+    def limit_in_flight(promise, max_in_flight):
+        """
+        Limit how many results the task behind a promise can be waiting
+        on at once. No more of its input is handed out while it is at the
+        limit, which stops an upstream stage running far ahead of the
+        stages that consume its output.
+
+        Params:
+         - promise: The Promise returned when the task was created
+         - max_in_flight: A positive integer
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        task = Dipla._get_promised_task(promise)
+        task.max_in_flight = max_in_flight
+
     # Stop reading the data source once we hit EOF
     # TODO(StefanKennedy) Set up data sources to run indefinitely.
     @staticmethod
     def complete_on_eof(streamer):
         if streamer.stream_location >= len(streamer.stream):
-            return True
+            return not streamer.is_waiting()
         return False
 
     # TODO(StefanKennedy) There's a bit of tracking the number of
@@ -65,7 +265,8 @@ class Dipla:
     # values. Investigate this, it could clean up the code
     @staticmethod
     def complete_when_unavailable(streamer):
-        return not streamer.has_available_data()
+        return not streamer.has_available_data() and \
+            not streamer.is_waiting()
 
     @staticmethod
     def stream_not_empty(stream, location):
@@ -83,17 +284,17 @@ class Dipla:
     def _read_by_consuming(collection, current_location):
         return [collection.pop(0)]
 
+    def _read_items(collection, current_location):
+        return list(collection[current_location])
+
     def _any_data_available(collection, current_location):
         return len(collection) - current_location > 0
 
     def _create_clientside_task(task_instructions,
                                 is_reduce=False,
                                 reduce_group_size=2):
-        task_uid = uid_generator.generate_uid(
-            length=8,
-            existing_uids=Dipla.task_queue.get_task_ids())
         return Task(
-            task_uid,
+            Dipla._generate_task_id(),
             task_instructions,
             MachineType.client,
             complete_check=Dipla.complete_when_unavailable,
@@ -122,9 +323,59 @@ class Dipla:
             data_source_creator = DataSource.create_source_from_iterable
             if isinstance(source, Task):
                 data_source_creator = DataSource.create_source_from_task
+            elif isinstance(source, LazySource):
+                data_source_creator = Dipla._create_source_from_lazy
+            elif isinstance(source, Broadcast):
+                data_source_creator = Dipla._create_source_from_broadcast
             task.add_data_source(
                 create_data_source_function(source, data_source_creator))
 
+    def _always_available(collection, current_location):
+        return True
+
+    def _create_source_from_broadcast(broadcast, source_uid, *unused):
+        # The reference is given with every input, and never runs out.
+        # Scoped and chasing distributables pass their own read functions,
+        # which are not needed as the reference is the same every time
+        return DataSource.create_source_from_iterable(
+            [broadcasts.make_reference(broadcast.key)],
+            source_uid,
+            Dipla._read_without_consuming,
+            Dipla._always_available,
+            Dipla._return_current_location)
+
+    def _create_source_from_lazy(lazy_source, source_uid):
+        data_source = DataSource.create_source_from_iterator(
+            lazy_source.iterable, source_uid, lazy_source.prefetch)
+        Dipla._watch_stream(data_source.data_streamer.stream)
+        return data_source
+
+    def _create_lazy_stream(lazy_source):
+        if hasattr(lazy_source.iterable, '__aiter__'):
+            stream = AsyncIteratorStream(
+                lazy_source.iterable, lazy_source.prefetch)
+        else:
+            stream = IteratorStream(lazy_source.iterable, lazy_source.prefetch)
+        Dipla._watch_stream(stream)
+        return stream
+
+    def _watch_stream(stream):
+        if not isinstance(stream, AsyncIteratorStream):
+            return
+        # Streams made before the server are woken up by it once it is
+        # made, see _create_server
+        if Dipla._session is not None:
+            stream.on_available = Dipla._session.server.scheduler.wake
+
+    def _to_lazy_source(source):
+        """
+        Wraps iterators and async iterators in a LazySource with the
+        default prefetch, and returns anything else unchanged
+        """
+        if isinstance(source, Iterator) or hasattr(source, '__aiter__'):
+            return LazySource(source)
+        return source
+
     def _create_normal_task(sources,
                             task_instructions,
                             is_reduce=False,
@@ -154,20 +405,54 @@ class Dipla:
                 verifier)
 
     @staticmethod
-    def distributable(verifier=None):
+    def distributable(verifier=None, cache=False, keep_on_worker=False,
+                      cpu=None, mem_mb=None, disk_mb=None, numpy=False):
         """
         Takes a function and converts it to a binary, the binary is then
         registered with the BinaryManager. The function is returned unchanged.
+
+        If cache is True, the result of every input is stored on disk, and
+        inputs that the same code has already been run on are not sent to
+        workers again. Only use this for functions whose results depend on
+        nothing but their arguments. See Dipla.set_result_cache
+
+        If keep_on_worker is True, each result stays on the worker that
+        computed it and the server only holds a reference to it. Input
+        reading the results is sent to the worker holding them where
+        possible, and they are only sent to the server when they are
+        needed elsewhere, such as by Dipla.get. A verifier or cache cannot
+        be used with it, as both need the results on the server
+
+        cpu, mem_mb and disk_mb are the least number of CPUs, MB of memory
+        and MB of free disk a worker must have to be sent the function's
+        input, and if numpy is True the worker must be able to import
+        NumPy. Input waits until a worker that has them is available
+
+        Raises:
+         - ValueError if keep_on_worker is used with a verifier or cache
         """
+        if keep_on_worker and (verifier or cache):
+            raise ValueError(
+                "keep_on_worker cannot be used with a verifier or cache")
+
         def distributable_decorator(function):
             Dipla._process_decorated_function(function, verifier)
             Dipla._task_creators[id(function)] = Dipla._create_normal_task
+            if cache:
+                Dipla._cached_functions[id(function)] = \
+                    result_cache.function_namespace(function)
+            if keep_on_worker:
+                Dipla._resident_functions.add(id(function))
+            else:
+                Dipla._resident_functions.discard(id(function))
+            Dipla._set_requirements(function, cpu, mem_mb, disk_mb, numpy)
             return function
 
         return distributable_decorator
 
     @staticmethod
-    def reduce_distributable(n=2):
+    def reduce_distributable(n=None, cpu=None, mem_mb=None, disk_mb=None,
+                             numpy=False, combine=False):
         """Takes a reduce function and converts it to a binary. The binary is
         then registered with the BinaryManager.
 
@@ -179,11 +464,23 @@ class Dipla:
         The reduce function given here should expect a single parameter, which
         will be the list of values to reduce. You can provide a parameter `n`
         to this decorator; this denotes the maximum number of inputs that will
-        be given to the reduce function at a time. It defaults to 2, which is
-        the standard case for a canonical reduce function. Raising this number
-        may increase performance in some cases."""
-
-        if n <= 1:
+        be given to the reduce function at a time. If it is not given, it is
+        chosen from the number of values to reduce when the result is asked
+        for, and is 2 if that number cannot be estimated. It is then changed
+        as the reduce runs to split the values between the idle workers,
+        see Dipla.set_reduce_sizing. Raising this number may increase
+        performance in some cases.
+
+        cpu, mem_mb, disk_mb and numpy are the resources a worker must have
+        to run the function, as for Dipla.distributable
+
+        If combine is True, the workers of the distributable whose results
+        are reduced also apply the function to each batch of results they
+        compute, and send back one value for the batch instead. This only
+        gives the right answer if the function is associative and returns
+        the same type of value as the ones it reduces, like sum or max"""
+
+        if n is not None and n <= 1:
             s = "Input size for a reduce function must be greater than 1"
             raise ReduceBadSize(s)
 
@@ -191,10 +488,27 @@ class Dipla:
             Dipla._process_decorated_function(function, None)
             Dipla._task_creators[id(function)] = Dipla._create_normal_task
             Dipla._reduce_task_group_sizes[id(function)] = n
+            Dipla._set_requirements(function, cpu, mem_mb, disk_mb, numpy)
+            if combine:
+                Dipla._combining_functions.add(id(function))
+            else:
+                Dipla._combining_functions.discard(id(function))
             return function
 
         return distributable_decorator
 
+    @staticmethod
+    def _set_requirements(function, cpu, mem_mb, disk_mb, numpy):
+        requirements = {'cpu': cpu, 'mem_mb': mem_mb, 'disk_mb': disk_mb}
+        requirements = {name: amount for name, amount in requirements.items()
+                        if amount is not None}
+        if numpy:
+            requirements['numpy'] = True
+        if requirements:
+            Dipla._function_requirements[id(function)] = requirements
+        else:
+            Dipla._function_requirements.pop(id(function), None)
+
     @staticmethod
     def scoped_distributable(count, verifier=None):
         """
@@ -313,26 +627,188 @@ class Dipla:
             # output to a single value array
             if len(source) > 0:
                 return [function(source.pop(0))]
+        # read_data_source runs the function itself, on the server pool
+        read_function_wrapper.parse_function = function
         return read_function_wrapper
 
     @staticmethod
     def _generate_task_id():
+        existing_uids = Dipla.task_queue.get_task_ids()
+        if Dipla._fused_tasks:
+            # The uids of fused tasks are still held by their promises,
+            # so they are not given to new tasks
+            existing_uids = list(existing_uids) + list(Dipla._fused_tasks)
         return uid_generator.generate_uid(
-            length=8, existing_uids=Dipla.task_queue.get_task_ids())
+            length=8, existing_uids=existing_uids)
+
+    def _get_promised_task(promise):
+        """
+        Returns the task of a promise, making the task again if it was
+        fused with the task that read it
+        """
+        if promise.task_uid in Dipla._fused_tasks:
+            function, raw_args = Dipla._fused_tasks.pop(promise.task_uid)
+            if any(isinstance(arg, LazySource) for arg in raw_args):
+                raise UnsupportedInput(
+                    "The results of this promise were passed straight to "
+                    "the function applied to it, and cannot be made again "
+                    "from a lazy source")
+            Dipla._apply_distributable(function, raw_args, promise.task_uid)
+        return Dipla.task_queue.get_task_by_id(promise.task_uid)
+
+    def _can_fuse(upstream_uid, downstream_uid):
+        upstream = Dipla.task_queue.get_task(upstream_uid)
+        downstream = Dipla.task_queue.get_task(downstream_uid)
+        if upstream.stages is None or downstream.stages is None:
+            return False
+        if Dipla.task_queue.get_dependee_ids(upstream_uid) != \
+                [downstream_uid]:
+            # Something else reads the values, so they must be kept
+            return False
+        if len(downstream.data_instructions) != 1:
+            return False
+        if upstream.requirements != downstream.requirements:
+            # A fused task could only be sent to workers meeting both
+            return False
+        streamer = downstream.data_instructions[0].data_streamer
+        if streamer.read_function is not DataSource.read_one_value or \
+                streamer.stream_location_changer is not \
+                DataSource.move_by_one:
+            return False
+        for task in (upstream, downstream):
+            if task.is_reduce or task.result_cache is not None or \
+                    task.num_expected_results > 0 or task.task_output:
+                return False
+        for function_id in upstream.stages + downstream.stages:
+            name = Dipla._task_functions[function_id].__name__
+            if function_id in Dipla._task_input_script_info or \
+                    Dipla.result_verifier.has_verifier(name):
+                return False
+        return True
+
+    def _fuse_map_chains(task_uid, visited=None):
+        """
+        Fuses every task the given task depends on that is read by
+        nothing but one distributable applied straight to it, so that the
+        client runs both functions in one go instead of sending the
+        intermediate values back to the server
+        """
+        if visited is None:
+            visited = set()
+        visited.add(task_uid)
+        dependency_uids = Dipla.task_queue.get_dependency_ids(task_uid)
+        while len(dependency_uids) == 1 and \
+                Dipla._can_fuse(dependency_uids[0], task_uid):
+            upstream_uid = dependency_uids[0]
+            upstream = Dipla.task_queue.get_task(upstream_uid)
+            task = Dipla.task_queue.get_task(task_uid)
+            stages = upstream.stages + task.stages
+            name = "+".join(Dipla._task_functions[function_id].__name__
+                            for function_id in stages)
+            Dipla._fused_pipelines[name] = stages
+            task.stages = stages
+            Dipla.task_queue.fuse_tasks(upstream_uid, task_uid, name)
+            Dipla._fused_tasks[upstream_uid] = upstream.application
+            dependency_uids = Dipla.task_queue.get_dependency_ids(task_uid)
+        for dependency_uid in dependency_uids:
+            if dependency_uid not in visited:
+                Dipla._fuse_map_chains(dependency_uid, visited)
+
+    @staticmethod
+    def broadcast(value):
+        """
+        Returns a Broadcast of the value, which can be given to
+        apply_distributable in place of a list. Every input of the task
+        is given the value, but the value itself is only sent to each
+        worker once, rather than with every input that uses it. The value
+        must be JSON serialisable.
+        """
+        broadcast = Broadcast(value)
+        Dipla._broadcasts[broadcast.key] = broadcast.serialised
+        if Dipla._session is not None:
+            Dipla._session.server.add_broadcast(
+                broadcast.key, broadcast.serialised)
+        return broadcast
+
+    @staticmethod
+    def lazy_source(iterable, prefetch=100):
+        """
+        Wraps an iterable, iterator, generator or async generator so that
+        it can be given to apply_distributable or read_data_source without
+        building a list of its values. Values are pulled from it only as
+        they are needed, and at most prefetch values are pulled ahead of
+        being handed out. Iterators and async iterators that are given
+        directly are wrapped with the default prefetch.
+
+        Raises:
+         - ValueError if prefetch is less than 1
+        """
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        return LazySource(iterable, prefetch)
+
+    @staticmethod
+    def file_source(path,
+                    shared=True,
+                    split_size=1024 * 1024,
+                    delimiter=b'\n',
+                    record_size=None,
+                    encoding='utf-8',
+                    prefetch=100):
+        """
+        Splits a file into parts of roughly split_size bytes that can be
+        given to apply_distributable, so that each input is one part of
+        the file. Parts always end at the end of a record, where records
+        end with delimiter, or are all record_size bytes long if it is
+        given. Only the ends of the parts are read to find them, so the
+        file is never read into memory on the server. The number of parts
+        sent to a worker at once is decided by the scheduling policy's
+        batch_size.
+
+        Args:
+         - path: The path of the file to split
+         - shared: If True the workers can read the file at the same path,
+        so they are only sent the offset and length of their parts and
+        read the parts themselves. Otherwise the contents of each part
+        are sent to them
+         - encoding: The encoding used to decode each part into a string
+        before it is given to the distributable function. If this is None
+        the function is given bytes
+         - prefetch: See Dipla.lazy_source
+
+        Returns:
+         - A LazySource of the parts of the file
+        """
+        splits = file_splits.find_splits(
+            path, split_size, delimiter, record_size)
+        if shared:
+            parts = file_splits.split_references(path, splits, encoding)
+        else:
+            parts = file_splits.split_contents(path, splits, encoding)
+        return Dipla.lazy_source(parts, prefetch)
 
     @staticmethod
     def read_data_source(read_function, source):
         task_uid = Dipla._generate_task_id()
+        source = Dipla._to_lazy_source(source)
+        if isinstance(source, LazySource):
+            source = Dipla._create_lazy_stream(source)
         # The Task name is only used to run binaries, which does not
         # happen when reading a data source, so we simply call this
         # 'read_data_source' as it is never used. This actually creates
         # a Task object from the provided read function, so we will add
         # it to the TaskQueue as a Server task
+        # Functions decorated with data_source are applied to each value
+        # by the server, on its pool, after the value has been read
+        parse_function = getattr(read_function, 'parse_function', None)
+        if parse_function is not None:
+            read_function = Dipla._read_by_consuming
         read_task = Task(
             task_uid,
             'read_data_source',
             MachineType.server,
-            complete_check=Dipla.complete_on_eof)
+            complete_check=Dipla.complete_on_eof,
+            server_function=parse_function)
         source_uid = uid_generator.generate_uid(length=8, existing_uids=[])
         # Create a reader task that consumes the input source being read,
         # this does not move the location because consuming the values
@@ -346,8 +822,252 @@ class Dipla:
         Dipla.task_queue.push_task(read_task)
         return Promise(task_uid)
 
+    @staticmethod
+    def reduce_sum(promise):
+        """
+        Adds up the values of a promise, which are numbers or lists of
+        numbers of the same shape that are added element by element. The
+        server adds the values up itself as they arrive, with NumPy if it
+        is installed, so they are never sent back to workers
+
+        Returns:
+         - A Promise of the sum, which get returns as a single value
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_sum', reducers.total)
+
+    @staticmethod
+    def reduce_min(promise):
+        """
+        Finds the smallest of the values of a promise on the server, as
+        reduce_sum adds them up
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_min', reducers.minimum)
+
+    @staticmethod
+    def reduce_max(promise):
+        """
+        Finds the largest of the values of a promise on the server, as
+        reduce_sum adds them up
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_max', reducers.maximum)
+
+    @staticmethod
+    def reduce_mean(promise):
+        """
+        Finds the mean of the values of a promise on the server, as
+        reduce_sum adds them up
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_mean', reducers.mean, reducers.finish_mean)
+
+    @staticmethod
+    def reduce_histogram(promise, edges):
+        """
+        Counts how many of the values of a promise fall between each pair
+        of edges on the server, as numpy.histogram does. Each value is a
+        number or a list of numbers, and numbers outside the edges are not
+        counted
+
+        Raises:
+         - ValueError if there are fewer than 2 edges or they are not in
+        increasing order
+
+        Returns:
+         - A Promise of the list of counts, one fewer than the edges
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_histogram', reducers.Histogram(edges),
+            reducers.finish_histogram)
+
+    @staticmethod
+    def reduce_top_k(promise, k, counters=None):
+        """
+        Finds the k most frequent of the values of a promise on the server,
+        approximately, with a TopK sketch from dipla.shared.sketches. The
+        values must be hashable, e.g. strings or numbers
+
+        Returns:
+         - A Promise of a list of [value, estimated count] pairs, most
+           frequent first
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_top_k',
+            reducers.SketchReducer(
+                functools.partial(sketches.TopK, k, counters)),
+            lambda partial: reducers.finish_sketch(partial).top())
+
+    @staticmethod
+    def reduce_distinct(promise, precision=12):
+        """
+        Estimates the number of distinct values of a promise on the server,
+        with a HyperLogLog sketch from dipla.shared.sketches
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_distinct',
+            reducers.SketchReducer(
+                functools.partial(sketches.HyperLogLog, precision)),
+            lambda partial: reducers.finish_sketch(partial).count())
+
+    @staticmethod
+    def reduce_sample(promise, size=100, seed=None):
+        """
+        Takes a uniform random sample of up to size of the values of a
+        promise on the server, with a Reservoir sketch from
+        dipla.shared.sketches
+
+        Returns:
+         - A Promise of the list of sampled values
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_sample',
+            reducers.SketchReducer(
+                functools.partial(sketches.Reservoir, size, seed)),
+            lambda partial: reducers.finish_sketch(partial).sample)
+
+    @staticmethod
+    def reduce_count_min(promise, width=1024, depth=4):
+        """
+        Counts the values of a promise on the server, approximately, with a
+        CountMin sketch from dipla.shared.sketches
+
+        Returns:
+         - A Promise of the CountMin sketch, whose estimate method gives the
+           count of any value
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'reduce_count_min',
+            reducers.SketchReducer(
+                functools.partial(sketches.CountMin, width, depth)),
+            reducers.finish_sketch)
+
+    @staticmethod
+    def merge_sketches(promise):
+        """
+        Merges the values of a promise on the server, which are sketches
+        from dipla.shared.sketches encoded by the workers that built them
+
+        Returns:
+         - A Promise of the merged sketch
+        """
+        return Dipla._apply_builtin_reducer(
+            promise, 'merge_sketches', reducers.merge_sketches,
+            reducers.finish_sketch)
+
+    def _apply_builtin_reducer(promise, name, function, finish=None):
+        source_task = Dipla._get_promised_task(promise)
+        # The reduce is a server task, which reduces whatever values have
+        # arrived each time it runs, along with its earlier result
+        reduce_task = Task(
+            Dipla._generate_task_id(),
+            name,
+            MachineType.server,
+            complete_check=Dipla.complete_when_unavailable,
+            is_reduce=True,
+            reduce_group_size=reducers.GROUP_SIZE,
+            server_function=function)
+        source_uid = uid_generator.generate_uid(length=8, existing_uids=[])
+        reduce_task.add_data_source(DataSource.create_source_from_task(
+            source_task, source_uid))
+        reduce_task.finish = finish
+        Dipla.task_queue.push_task(reduce_task)
+        return Promise(reduce_task.uid)
+
+    @staticmethod
+    def reduce_by_key(function, promise, partitions=16, spill_after=None):
+        """
+        Groups the values of a promise by key, and reduces the values of
+        each key with a reduce distributable. The keys are split between
+        partitions by their hash, and each partition is reduced by one
+        worker once the promised task has finished, so the partitions are
+        reduced at the same time by different workers.
+
+        Params:
+         - function: A function decorated with @Dipla.reduce_distributable,
+        which is given the list of every value of a key at once
+         - promise: A Promise whose values are each a list of [key, value]
+        pairs, or a dictionary of key to value
+         - partitions: The number of partitions, which should be at least
+        the number of workers
+         - spill_after: The most values each partition holds in memory on
+        the server before writing them to disk. None means they never are
+
+        Raises:
+         - KeyError if the function was not decorated with
+        reduce_distributable
+         - ValueError if the function has a verifier or signals
+         - UnsupportedInput if the promised results are kept on workers
+         - ValueError if a promised value that has already arrived is not
+        a list of pairs or a dictionary. One that arrives later fails the
+        task reducing the partitions instead
+
+        Returns:
+         - A Promise of a [key, reduced value] pair for each key
+        """
+        function_id = id(function)
+        if function_id not in Dipla._reduce_task_group_sizes:
+            raise KeyError("Provided function was not decorated using "
+                           "Dipla.reduce_distributable")
+        if function_id in Dipla._task_input_script_info or \
+                Dipla.result_verifier.has_verifier(function.__name__):
+            raise ValueError("A reduce distributable with a verifier or "
+                             "signals cannot be applied by key")
+        source_task = Dipla._get_promised_task(promise)
+        if source_task.keep_on_worker:
+            raise UnsupportedInput(
+                "The results of a distributable kept on workers cannot be "
+                "grouped by key")
+        for value in source_task.task_output:
+            check_pairs(value)
+        task_queue = Dipla.task_queue
+        shuffle = Shuffle(
+            source_task.task_output,
+            functools.partial(task_queue.is_task_finished, source_task.uid),
+            partitions,
+            spill_after,
+            can_consume=lambda: task_queue.get_dependee_ids(
+                source_task.uid) == [partition_task.uid])
+
+        name = function.__name__ + '.by_key'
+        Dipla._keyed_reducers[name] = function_id
+        # Each partition is sent to a worker on its own
+        partition_task = Task(
+            Dipla._generate_task_id(),
+            name,
+            MachineType.client,
+            complete_check=Dipla.complete_when_unavailable,
+            batch_size=1)
+        partition_task.requirements = Dipla._function_requirements.get(
+            function_id)
+        source_uid = uid_generator.generate_uid(length=8, existing_uids=[])
+        partition_task.add_data_source(DataSource(
+            source_uid, source_task.uid, DataStreamer(
+                shuffle, Shuffle.read_partition, Shuffle.any_partition_ready)))
+        task_queue.push_task(partition_task)
+        source_task.result_checks[partition_task.uid] = \
+            check_pairs
+
+        # The result for each partition is a list of pairs, which is split
+        # back up into a value for each key
+        pairs_task = Task(
+            Dipla._generate_task_id(),
+            'reduce_by_key',
+            MachineType.server,
+            complete_check=Dipla.complete_on_eof)
+        source_uid = uid_generator.generate_uid(length=8, existing_uids=[])
+        pairs_task.add_data_source(DataSource.create_source_from_task(
+            partition_task, source_uid, Dipla._read_items))
+        task_queue.push_task(pairs_task)
+        return Promise(pairs_task.uid)
+
     @staticmethod
     def terminate_tasks():
+        # Distributables run by the server's local executor call this, and
+        # their signal is sent with their results
+        if local_executor.send_signal('TERMINATE', [True]):
+            return
         # This is here in case someone calls Dipla.terminate_tasks() from
         # outside a distributed function.
         print("terminate_tasks can only be called inside a distributable")
@@ -373,6 +1093,14 @@ class Dipla:
          - A Promise, which can be used later as the input to another task,
         or the user can await its results.
         """
+        return Dipla._apply_distributable(function, raw_args)
+
+    def _apply_distributable(function, raw_args, task_uid=None):
+        """
+        Applies the function as apply_distributable does. If task_uid is
+        given, it is used as the uid of the task of a distributable
+        function, rather than a new uid
+        """
         if id(function) not in Dipla._task_creators:
             raise KeyError("Provided function was not decorated using Dipla")
 
@@ -382,24 +1110,59 @@ class Dipla:
             s = "Incorrect number of arguments given for reduce distributable"
             raise KeyError(s)
 
+        if raw_args and all(isinstance(arg, Broadcast) for arg in raw_args) \
+                and Dipla._task_creators[id(function)] is \
+                Dipla._create_normal_task:
+            # Broadcasts never run out, so there would be no end to the
+            # inputs of the task
+            raise UnsupportedInput(
+                "At least one argument must not be a broadcast")
+
+        raw_args = [Dipla._to_lazy_source(arg) for arg in raw_args]
         args = []
         for arg in raw_args:
             if isinstance(arg, Promise):
-                args.append(Dipla.task_queue.get_task_by_id(arg.task_uid))
-            elif isinstance(arg, list):
+                args.append(Dipla._get_promised_task(arg))
+            elif isinstance(arg, (list, Broadcast)):
+                args.append(arg)
+            elif isinstance(arg, LazySource):
+                if Dipla._task_creators[id(function)] is not \
+                        Dipla._create_normal_task:
+                    # Scoped and chasing distributables re-read the same
+                    # values, so they need them all to be held
+                    raise UnsupportedInput(
+                        "Lazy sources can only be given to distributable "
+                        "and reduce_distributable functions")
                 args.append(arg)
             else:
                 raise UnsupportedInput()
         function_id = id(function)
+        combined_task = None
+        if function_id in Dipla._combining_functions and \
+                isinstance(args[0], Task):
+            combined_task = args[0]
+            Dipla._check_combinable(combined_task, function)
         tasks = None
         if is_reduce:
             size = Dipla._reduce_task_group_sizes[function_id]
-            tasks = Dipla._task_creators[function_id](args,
-                                                      function.__name__,
-                                                      is_reduce=True,
-                                                      reduce_group_size=size)
+            tasks = Dipla._task_creators[function_id](
+                args,
+                function.__name__,
+                is_reduce=True,
+                reduce_group_size=size or 2)
+            tasks[0].reduce_function = function
+            tasks[0].adaptive_group_size = size is None
         else:
             tasks = Dipla._task_creators[function_id](args, function.__name__)
+            if Dipla._task_creators[function_id] is \
+                    Dipla._create_normal_task:
+                # Remember how the task was made, so that it can be fused
+                # with the task that reads it, and made again if it is
+                # needed after that
+                if task_uid is not None:
+                    tasks[0].uid = task_uid
+                tasks[0].stages = [function_id]
+                tasks[0].application = (function, raw_args)
         for task in tasks:
             task.signals = {
                 'TERMINATE': lambda server, uid, _: server.terminate_task(uid)
@@ -407,9 +1170,45 @@ class Dipla:
             if function_id in Dipla._task_input_script_info:
                 task.signals.update(
                     Dipla._task_input_script_info[function_id][1])
+            if function_id in Dipla._cached_functions:
+                task.result_cache = Dipla._get_result_cache()
+                task.cache_namespace = Dipla._cached_functions[function_id]
+            task.keep_on_worker = function_id in Dipla._resident_functions
+            task.requirements = Dipla._function_requirements.get(function_id)
             Dipla.task_queue.push_task(task)
+        if combined_task is not None:
+            combined_task.combiner = function.__name__
         return Promise(tasks[-1].uid)
 
+    def _check_combinable(task, function):
+        """
+        Raises:
+         - ValueError if the reduce function cannot be run as a combiner
+        by the workers of the task
+        """
+        if task.stages is None:
+            raise ValueError(
+                "Only the results of a distributable can be combined")
+        if Dipla.task_queue.get_dependee_ids(task.uid):
+            raise ValueError(
+                "The results of a distributable read by another function "
+                "cannot be combined")
+        requirements = Dipla._function_requirements.get(id(function))
+        if requirements is not None and requirements != task.requirements:
+            raise ValueError(
+                "A reduce function can only be combined into a "
+                "distributable with the same requirements")
+        if task.result_cache is not None:
+            raise ValueError(
+                "The results of a cached distributable cannot be combined")
+        for function_id in task.stages:
+            if function_id in Dipla._task_input_script_info or \
+                    Dipla.result_verifier.has_verifier(
+                        Dipla._task_functions[function_id].__name__):
+                raise ValueError(
+                    "The results of a distributable with a verifier or "
+                    "signals cannot be combined")
+
     def _create_binary_manager():
         return BinaryManager()
 
@@ -426,12 +1225,48 @@ class Dipla:
         return proc
 
     @staticmethod
-    def get(promise, run_on_server=False):
-        """Turns a promise into the immediate values by starting the server
+    def _create_get_task(promise, buffer_size=None):
+        """
+        Creates and pushes the server task that collects the results of
+        a promise into its task_output.
+
+        If buffer_size is given the get task stops reading once it holds
+        that many results, so they must be taken out of task_output as
+        they arrive. If nothing else reads the promised task's output,
+        the get task consumes it too and the promised task is paused
+        while buffer_size results are waiting, so that neither list grows
+        without bound.
+        """
+        return Dipla._create_get_tasks([promise], buffer_size)[0]
 
-        Args:
-         - promise: Promise to get
-         - run_on_server: Start a client alongside the server for debugging"""
+    @staticmethod
+    def _create_get_tasks(promises, buffer_size=None):
+        """
+        Creates and pushes a get task for each promise, as
+        _create_get_task does. The promises are planned together, so a
+        task that several of them depend on is only run once, and a
+        promised task is never fused into another task reading it.
+
+        Returns:
+         - The list of get tasks, in the same order as the promises
+        """
+        source_tasks = [Dipla._get_promised_task(promise)
+                        for promise in promises]
+        plan = Dipla.plan(promises)
+        # The get tasks are pushed before fusing, so that a promised task
+        # is seen to be read by its get task
+        get_tasks = [Dipla._push_get_task(promise, source_task, buffer_size)
+                     for promise, source_task in zip(promises, source_tasks)]
+        visited = set()
+        for promise in promises:
+            Dipla._fuse_map_chains(promise.task_uid, visited)
+        plan.apply(Dipla.task_queue)
+        if not Dipla._priority_mode_chosen:
+            Dipla.task_queue.set_priority_mode(PriorityMode.planned)
+        return get_tasks
+
+    @staticmethod
+    def _push_get_task(promise, source_task, buffer_size):
         task_uid = Dipla._generate_task_id()
 
         # Get function is given a complete function so that the server
@@ -440,27 +1275,75 @@ class Dipla:
             task_uid,
             'get',
             MachineType.server,
-            complete_check=Dipla.complete_on_eof)
+            complete_check=Dipla.complete_on_eof,
+            max_buffered_output=buffer_size)
         # Generate a uid for the source (bridge) from the get task to
         # the task provided in the promise
         source_uid = uid_generator.generate_uid(length=8, existing_uids=[])
-        get_task.add_data_source(DataSource.create_source_from_task(
-            Dipla.task_queue.get_task(promise.task_uid), source_uid))
+        if buffer_size is not None and \
+                not Dipla.task_queue.get_dependee_ids(promise.task_uid):
+            source_task.max_buffered_output = buffer_size
+            get_task.add_data_source(DataSource.create_source_from_task(
+                source_task,
+                source_uid,
+                Dipla._read_by_consuming,
+                Dipla._any_data_available,
+                Dipla._return_current_location))
+        else:
+            get_task.add_data_source(DataSource.create_source_from_task(
+                source_task, source_uid))
         Dipla.task_queue.push_task(get_task)
+        return get_task
 
-        binary_manager = Dipla._create_binary_manager()
-        for function_id in Dipla._task_functions:
+    @staticmethod
+    def _encode_binaries(function_ids):
+        """
+        Returns a list of (task name, base64'd Python script) tuples for
+        the distributable functions with the given ids
+        """
+        binaries = []
+        for function_id in function_ids:
             input_template = (script_templates.argv_input_script, dict())
             if function_id in Dipla._task_input_script_info:
                 input_template = Dipla._task_input_script_info[function_id]
             function = Dipla._task_functions[function_id]
             # Turn the function into a base64'd Python script.
             base64_binary = get_encoded_script(function, input_template[0])
-            # Register the result as a new binary for any platform with the
-            # name of the function as the task name.
-            binary_manager.add_encoded_binaries('.*', [
-                (function.__name__, base64_binary),
-            ])
+            binaries.append((function.__name__, base64_binary))
+        return binaries
+
+    def _encode_keyed_reducers(names):
+        """
+        Returns a list of (task name, base64'd Python script) tuples for
+        the reduce distributables applied by key with the given names
+        """
+        return [(name, get_encoded_script(
+                    Dipla._task_functions[Dipla._keyed_reducers[name]],
+                    script_templates.keyed_reduce_argv_input_script))
+                for name in names]
+
+    def _encode_pipelines(names):
+        """
+        Returns a list of (task name, base64'd Python script) tuples for
+        the fused tasks with the given names
+        """
+        binaries = []
+        for name in names:
+            functions = [Dipla._task_functions[function_id]
+                         for function_id in Dipla._fused_pipelines[name]]
+            binaries.append((name, get_encoded_pipeline_script(
+                functions, script_templates.fused_argv_input_script)))
+        return binaries
+
+    @staticmethod
+    def _create_server():
+        binary_manager = Dipla._create_binary_manager()
+        # Register the binaries for any platform with the name of the
+        # function as the task name.
+        binary_manager.add_encoded_binaries(
+            '.*', Dipla._encode_binaries(Dipla._task_functions) +
+            Dipla._encode_pipelines(Dipla._fused_pipelines) +
+            Dipla._encode_keyed_reducers(Dipla._keyed_reducers))
 
         server = Server(
             task_queue=Dipla.task_queue,
@@ -469,26 +1352,434 @@ class Dipla:
                 Dipla.stat_updater),
             result_verifier=Dipla.result_verifier,
             stats=Dipla.stat_updater,
-            should_distribute_tasks=not Dipla._use_control_webpage)
+            should_distribute_tasks=not Dipla._use_control_webpage,
+            scheduler=Scheduler(Dipla._scheduling_policy),
+            local_executor=Dipla._create_local_executor(),
+            server_pool=Dipla._create_server_pool(),
+            heartbeat_monitor=Dipla._create_heartbeat_monitor(),
+            reduce_sizer=Dipla._create_reduce_sizer())
+        # The lazy sources that pull values in the background wake up the
+        # server that reads them
+        for task_uid in Dipla.task_queue.get_task_ids():
+            task = Dipla.task_queue.get_task(task_uid)
+            for source in task.data_instructions:
+                stream = source.data_streamer.stream
+                if isinstance(stream, AsyncIteratorStream):
+                    stream.on_available = server.scheduler.wake
+        for key, serialised_value in Dipla._broadcasts.items():
+            server.add_broadcast(key, serialised_value)
+        return server
+
+    @staticmethod
+    def _create_heartbeat_monitor():
+        if Dipla._heartbeat is None:
+            return None
+        return HeartbeatMonitor(**Dipla._heartbeat)
+
+    @staticmethod
+    def _create_reduce_sizer():
+        if Dipla._reduce_sizing is None:
+            return None
+        return ReduceSizer(**Dipla._reduce_sizing)
+
+    @staticmethod
+    def _create_server_pool():
+        if Dipla._server_pool is None:
+            return None
+        return ServerTaskPool(**Dipla._server_pool)
+
+    @staticmethod
+    def _create_local_executor():
+        if Dipla._local_execution is None:
+            return None
+        executor = LocalExecutor(**Dipla._local_execution)
+        Dipla._add_local_functions(
+            executor, Dipla._task_functions, Dipla._fused_pipelines)
+        return executor
+
+    @staticmethod
+    def _add_local_functions(executor, function_ids, pipeline_names):
+        """
+        Lets the executor run the distributables with the given ids and
+        the fused tasks with the given names. Distributables that use
+        signals or have a verifier are always sent to the workers
+        """
+        for function_id in function_ids:
+            function = Dipla._task_functions[function_id]
+            if function_id in Dipla._task_input_script_info or \
+                    Dipla.result_verifier.has_verifier(function.__name__):
+                continue
+            executor.add_function(function.__name__, [function])
+        for name in pipeline_names:
+            executor.add_function(
+                name, [Dipla._task_functions[function_id]
+                       for function_id in Dipla._fused_pipelines[name]])
+
+    @staticmethod
+    def _adaptive_reduce_uids():
+        # The reduce tasks whose group sizes are chosen by the QueryPlan,
+        # because none was given to reduce_distributable
+        return {task_uid for task_uid in Dipla.task_queue.get_task_ids()
+                if Dipla.task_queue.get_task(task_uid).adaptive_group_size}
+
+    @staticmethod
+    def plan(promises):
+        """Returns the QueryPlan that get, get_all and stream would use to
+        run the tasks a promise, or a list of promises, depends on, without
+        running anything. Print it to see the estimated size and cost of
+        each task, the batch and reduce group sizes that would be used,
+        which tasks would be fused and which tasks are not needed. Use its
+        to_dict() method to dump it, e.g. as JSON.
+
+        Outside of a session, tasks that the promises do not depend on are
+        not run. The batch sizes are only chosen when no scheduling policy
+        has been set, see Dipla.set_scheduling_policy"""
+        if isinstance(promises, Promise):
+            promises = [promises]
+        target_uids = []
+        for promise in promises:
+            Dipla._get_promised_task(promise)
+            if promise.task_uid not in target_uids:
+                target_uids.append(promise.task_uid)
+        return query_plan.build_plan(
+            Dipla.task_queue,
+            target_uids,
+            can_fuse=Dipla._can_fuse,
+            choose_batch_sizes=Dipla._scheduling_policy is None,
+            choose_group_sizes=Dipla._adaptive_reduce_uids(),
+            hold_unneeded=Dipla._session is None)
 
+    @staticmethod
+    def get(promise, run_on_server=False):
+        """Turns a promise into the immediate values by starting the server
+
+        Args:
+         - promise: Promise to get
+         - run_on_server: Start a client alongside the server for debugging.
+        This is ignored inside a session, see Dipla.session"""
+        get_task = Dipla._create_get_task(promise)
+        if Dipla._session is not None:
+            Dipla._session.run_until_complete(get_task)
+            return Dipla._get_value(promise, get_task)
+
+        server = Dipla._create_server()
         if run_on_server:
             client = Dipla._start_client_thread()
             server.start(password=Dipla._password)
             client.terminate()
         else:
             server.start(password=Dipla._password)
+        return Dipla._get_value(promise, get_task)
 
-        if Dipla.task_queue.get_task(promise.task_uid).is_reduce:
+    @staticmethod
+    def get_all(promises, run_on_server=False):
+        """Gets the values of several promises in one run of the server.
+        Tasks that more than one of the promises depend on are only run
+        once, and a promise that another promise reads from is not fused
+        with it, see Chained distributables in the docs.
+
+        Args:
+         - promises: A list of the promises to get
+         - run_on_server: Start a client alongside the server for debugging.
+        This is ignored inside a session, see Dipla.session
+
+        Returns:
+         - A list of the values of the promises, in the same order, as get
+        would return them"""
+        promises = list(promises)
+        get_tasks = Dipla._create_get_tasks(promises)
+        if Dipla._session is not None:
+            for get_task in get_tasks:
+                Dipla._session.run_until_complete(get_task)
+        else:
+            server = Dipla._create_server()
+            if run_on_server:
+                client = Dipla._start_client_thread()
+                server.start(password=Dipla._password)
+                client.terminate()
+            else:
+                server.start(password=Dipla._password)
+        return [Dipla._get_value(promise, get_task)
+                for promise, get_task in zip(promises, get_tasks)]
+
+    @staticmethod
+    def _get_value(promise, get_task):
+        task = Dipla.task_queue.get_task(promise.task_uid)
+        if task.is_reduce:
             # The task that has been requested is a reduce task,
             # so we only care about the very last value returned.
-            return get_task.task_output[-1]
+            value = get_task.task_output[-1]
+            if task.finish is not None:
+                value = task.finish(value)
+            return value
         else:
             return get_task.task_output
 
+    @staticmethod
+    def submit_job(promise, server_address, weight=1):
+        """Sends the tasks that a promise depends on to a job server as
+        one job, and waits for its results. A job server runs the jobs of
+        many programs at once, sharing its workers between them, see
+        dipla.server.jobs.start_job_server.
+
+        Only tasks created by applying distributables and reduce
+        distributables to lists and other promises can be submitted.
+
+        Args:
+         - promise: Promise to get the values of
+         - server_address: The websocket address of the job server, e.g.
+        'ws://localhost:8765'
+         - weight: The job's share of the workers relative to the other
+        jobs on the server
+
+        Raises:
+         - UnsupportedInput if the promise depends on a task that cannot
+        be submitted
+         - JobFailed if the server rejects the job
+
+        Returns:
+         - The values of the promise, as they would be returned by get"""
+        data = Dipla._describe_job(promise)
+        data['weight'] = weight
+        if Dipla._password is not None:
+            data['password'] = Dipla._password
+        results = asyncio.get_event_loop().run_until_complete(
+            Dipla._run_job(server_address, data))
+        if Dipla.task_queue.get_task(promise.task_uid).is_reduce:
+            return results[-1]
+        return results
+
+    @staticmethod
+    def _describe_job(promise):
+        tasks = []
+        binaries = {}
+        functions_by_name = {function.__name__: function_id
+                             for function_id, function
+                             in Dipla._task_functions.items()}
+
+        def describe_task(task_uid):
+            if any(task['uid'] == task_uid for task in tasks):
+                return
+            for dependency_uid in Dipla.task_queue.get_dependency_ids(
+                    task_uid):
+                describe_task(dependency_uid)
+            task = Dipla.task_queue.get_task(task_uid)
+            unsupported = UnsupportedInput(
+                "Task '{}' cannot be submitted as a job".format(
+                    task.instructions))
+            if task.machine_type != MachineType.client or \
+                    task.combiner is not None or \
+                    (task.instructions not in functions_by_name and
+                     task.instructions not in Dipla._fused_pipelines):
+                raise unsupported
+            sources = []
+            for source in task.data_instructions:
+                streamer = source.data_streamer
+                if streamer.read_function is not DataSource.read_one_value:
+                    raise unsupported
+                if source.source_task_uid is not None:
+                    sources.append({'task': source.source_task_uid})
+                else:
+                    sources.append({'values': list(streamer.stream)})
+            tasks.append({
+                'uid': task_uid,
+                'instructions': task.instructions,
+                'sources': sources,
+                'is_reduce': task.is_reduce,
+                'reduce_group_size': task.reduce_group_size,
+            })
+            if task.instructions in Dipla._fused_pipelines:
+                binaries.update(Dipla._encode_pipelines([task.instructions]))
+                return
+            function_id = functions_by_name[task.instructions]
+            if function_id in Dipla._task_input_script_info and \
+                    Dipla._task_input_script_info[function_id][1]:
+                # Signal handlers run on the server, so cannot be sent
+                raise unsupported
+            binaries.update(Dipla._encode_binaries([function_id]))
+
+        Dipla._get_promised_task(promise)
+        describe_task(promise.task_uid)
+        return {
+            'tasks': tasks,
+            'binaries': binaries,
+            'result_task': promise.task_uid,
+        }
+
+    @staticmethod
+    async def _run_job(server_address, data):
+        websocket = await websockets.connect(server_address)
+        try:
+            await websocket.send(json.dumps(
+                generate_message('submit_job', data)))
+            while True:
+                message = json.loads(await websocket.recv())
+                if message['label'] == 'job_result':
+                    return message['data']['results']
+                if message['label'] == 'runtime_error':
+                    raise JobFailed(message['data']['details'])
+        finally:
+            await websocket.close()
+
+    @staticmethod
+    def session(address='0.0.0.0', port=8765, run_on_server=False):
+        """Returns a Session to be used in a with statement. Inside it the
+        server keeps listening, and workers stay connected, across calls
+        to get and stream, rather than being started and stopped by each
+        one. Each get only waits for the tasks its promise depends on.
+
+        Distributables can still be defined inside the session, and their
+        binaries are sent to the connected workers when they are first
+        needed.
+
+        Args:
+         - address: The address the server listens on
+         - port: The port the server listens on
+         - run_on_server: Start a client alongside the server for debugging
+
+        Raises:
+         - SessionAlreadyOpen if another session is open"""
+        return Session(address, port, run_on_server)
+
+    @staticmethod
+    def iterate(step, state, until=None, max_rounds=100,
+                run_on_server=False):
+        """Runs rounds of work until the state they refine converges, for
+        algorithms such as k-means that make many passes over the same
+        data. The rounds run in one session, so the server, the connected
+        workers and their binaries are kept between rounds, see
+        Dipla.session. If a session is already open it is used.
+
+        Each round calls step(state), which returns the next state. It may
+        return a promise, in which case the next state is the value of the
+        promise. Pass the state to the workers with Dipla.broadcast, so
+        that only the new state is sent each round. The tasks created by a
+        round are removed once it has finished, so their results are not
+        kept in memory.
+
+        The time taken by each round is recorded in the statistics as
+        num_rounds, last_round_time and mean_round_time.
+
+        Args:
+         - step: Function taking the current state and returning the next
+         - state: The state to start from
+         - until: Function taking the previous and the next state, that
+        returns True once they have converged. If None, max_rounds rounds
+        are run
+         - max_rounds: The most rounds to run
+         - run_on_server: Start a client alongside the server for
+        debugging. This is ignored if a session is already open
+
+        Returns:
+         - The last state"""
+        if Dipla._session is None:
+            with Dipla.session(run_on_server=run_on_server):
+                return Dipla.iterate(step, state, until, max_rounds)
+
+        for _ in range(max_rounds):
+            start = time.time()
+            existing_uids = set(Dipla.task_queue.get_task_ids())
+            existing_fused_uids = set(Dipla._fused_tasks)
+            next_state = step(state)
+            if isinstance(next_state, Promise):
+                next_state = Dipla.get(next_state)
+            Dipla._remove_finished_tasks(existing_uids, existing_fused_uids)
+            Dipla._record_round_time(time.time() - start)
+            converged = until is not None and until(state, next_state)
+            state = next_state
+            if converged:
+                break
+        return state
+
+    @staticmethod
+    def _remove_finished_tasks(existing_uids, existing_fused_uids):
+        """
+        Removes the finished tasks that are not in existing_uids, except
+        those read by a task that is kept, and forgets how to make again
+        the tasks that were fused away since existing_fused_uids
+        """
+        finished = {task_uid for task_uid in Dipla.task_queue.get_task_ids()
+                    if task_uid not in existing_uids and
+                    Dipla.task_queue.is_subgraph_inactive(task_uid) and
+                    Dipla.task_queue.get_task(task_uid).in_flight() == 0}
+        # A task is only removed if every task reading it is removed too
+        while True:
+            kept = {task_uid for task_uid in finished
+                    if not set(Dipla.task_queue.get_dependee_ids(task_uid)) <=
+                    finished}
+            if not kept:
+                break
+            finished -= kept
+        Dipla.task_queue.remove_tasks(finished)
+        for task_uid in set(Dipla._fused_tasks) - existing_fused_uids:
+            del Dipla._fused_tasks[task_uid]
+
+    @staticmethod
+    def _record_round_time(duration):
+        reader = statistics.StatisticsReader(Dipla._stats)
+        num_rounds = reader.read("num_rounds")
+        mean = reader.read("mean_round_time")
+        Dipla.stat_updater.increment("num_rounds")
+        Dipla.stat_updater.overwrite("last_round_time", duration)
+        Dipla.stat_updater.overwrite(
+            "mean_round_time", (mean * num_rounds + duration) /
+            (num_rounds + 1))
+
+    @staticmethod
+    def stream(promise, buffer_size=100, run_on_server=False):
+        """Starts the server and returns a ResultStream that yields the
+        results of a promise as soon as they arrive, rather than waiting
+        for all of them like Dipla.get().
+
+        At most buffer_size results are held on the server waiting to be
+        yielded. While the buffer is full no more input is handed out
+        for the promised task, so a slow consumer slows the work down
+        instead of using more memory. The stream can be used in a for
+        loop, or with async for in a coroutine on the event loop.
+
+        Args:
+         - promise: Promise to stream the results of
+         - buffer_size: The number of results that can wait to be yielded
+         - run_on_server: Start a client alongside the server for debugging
+
+        Raises:
+         - UnsupportedInput if the promise is for a reduce task, as only
+        its final value is meaningful
+         - ValueError if buffer_size is less than 1"""
+        if Dipla._get_promised_task(promise).is_reduce:
+            raise UnsupportedInput(
+                "The results of a reduce task cannot be streamed")
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1")
+        return ResultStream(promise, buffer_size, run_on_server)
+
     @staticmethod
     def set_password(password):
         Dipla._password = password
 
+    @staticmethod
+    def set_result_cache(path, max_size=256 * 1024 * 1024):
+        """
+        Sets the file the results of functions decorated with
+        distributable(cache=True) are stored in, and the maximum size of
+        the stored results in bytes. When the results grow larger than
+        this, the least recently used ones are removed
+        """
+        if Dipla._result_cache is not None:
+            Dipla._result_cache.close()
+            Dipla._result_cache = None
+        Dipla._result_cache_path = path
+        Dipla._result_cache_max_size = max_size
+
+    def _get_result_cache():
+        if Dipla._result_cache is None:
+            Dipla._result_cache = result_cache.ResultCache(
+                Dipla._result_cache_path, Dipla._result_cache_max_size)
+            # The uses of results looked up since the last flush are only
+            # written when the cache is flushed or closed
+            atexit.register(Dipla._result_cache.close)
+        return Dipla._result_cache
+
     def start_dashboard(host='localhost', port=8080):
         """
         Start a webserver hosting a dashboard at the given host and port,
@@ -618,6 +1909,9 @@ class Promise:
         return Dipla.apply_distributable(
             function, *([self] + [x for x in args]))
 
+    def reduce_by_key(self, function, partitions=16, spill_after=None):
+        return Dipla.reduce_by_key(function, self, partitions, spill_after)
+
     def get(self, run_on_server=False):
         """Get the immediate value of this promise by starting the server
 
@@ -625,6 +1919,216 @@ class Promise:
         server to help with debugging."""
         return Dipla.get(self, run_on_server)
 
+    def stream(self, buffer_size=100, run_on_server=False):
+        """Get the values of this promise as they arrive by starting the
+        server. See Dipla.stream for details."""
+        return Dipla.stream(self, buffer_size, run_on_server)
+
+
+class Broadcast:
+    """
+    A value that is sent to each worker at most once. Create one using
+    Dipla.broadcast()
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.key, self.serialised = broadcasts.serialise(value)
+
+
+class LazySource:
+    """
+    An iterable whose values are pulled only as they are needed. Create
+    one using Dipla.lazy_source()
+    """
+
+    def __init__(self, iterable, prefetch=100):
+        self.iterable = iterable
+        self.prefetch = prefetch
+
+
+class ResultStream:
+    """
+    Iterates over the results of a promise while the server is running.
+    The server is started on the first call to next, and closed once
+    every result has been yielded or close is called.
+    """
+
+    def __init__(self, promise, buffer_size, run_on_server=False):
+        self._promise = promise
+        self._buffer_size = buffer_size
+        self._run_on_server = run_on_server
+        self._started = False
+        self._finished = False
+        self._server = None
+        self._client = None
+        self._get_task = None
+        self._pending = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._run_on_server and self._client is None and \
+                not self._started and Dipla._session is None:
+            # The client process must be forked before the event loop is
+            # running, otherwise it inherits the running loop
+            self._client = Dipla._start_client_thread()
+        try:
+            return asyncio.get_event_loop().run_until_complete(
+                self.__anext__())
+        except StopAsyncIteration:
+            raise StopIteration
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._started:
+            await self._start()
+        while not self._pending:
+            if self._finished:
+                self.close()
+                raise StopAsyncIteration
+            await self._server.wait_until(self._has_results_or_finished)
+            self._take_results()
+        return self._pending.popleft()
+
+    async def _start(self):
+        self._started = True
+        self._get_task = Dipla._create_get_task(
+            self._promise, self._buffer_size)
+        if Dipla._session is not None:
+            self._server = Dipla._session.prepare()
+            return
+        self._server = Dipla._create_server()
+        if self._run_on_server and self._client is None:
+            self._client = Dipla._start_client_thread()
+        await self._server.listen(password=Dipla._password)
+
+    def _is_finished(self):
+        # The get task is marked complete whenever it catches up with the
+        # promised task, so this waits for everything it reads from too
+        return Dipla.task_queue.is_subgraph_inactive(self._get_task.uid)
+
+    def _has_results_or_finished(self):
+        return len(self._get_task.task_output) > 0 or self._is_finished()
+
+    def _take_results(self):
+        # Check this before emptying the buffer, as any results that
+        # arrived with the final one are still in it
+        self._finished = self._is_finished()
+        self._pending.extend(self._get_task.task_output)
+        del self._get_task.task_output[:]
+        # There is room in the buffer again, so more input can be handed
+        # out for the promised task
+        self._server.scheduler.wake()
+
+    def close(self):
+        """
+        Stop the server. This is done automatically once every result has
+        been yielded, but can be called to stop early.
+        """
+        if self._started and not self._finished:
+            # Stopping early, so the tasks this stream was waiting on are
+            # cancelled to stop them holding up the queue
+            self._cancel_with_dependencies(self._get_task.uid)
+        self._finished = True
+        self._pending.clear()
+        if self._server is not None:
+            if Dipla._session is None:
+                self._server.close()
+            self._server = None
+        if self._client is not None:
+            self._client.terminate()
+            self._client = None
+
+    def _cancel_with_dependencies(self, task_uid):
+        if Dipla.task_queue.is_task_complete(task_uid):
+            return
+        Dipla.task_queue.cancel_task(task_uid)
+        for dependency_uid in Dipla.task_queue.get_dependency_ids(task_uid):
+            self._cancel_with_dependencies(dependency_uid)
+
+
+class Session:
+    """
+    Keeps a server listening across several calls to Dipla.get. Create
+    one using Dipla.session().
+    """
+
+    def __init__(self, address, port, run_on_server=False):
+        self.address = address
+        self.port = port
+        self.run_on_server = run_on_server
+        self.server = None
+        self._client = None
+        # The ids of the distributables, and the names of the fused tasks
+        # and reducers applied by key, that the server has binaries for
+        self._sent_function_ids = set()
+        self._sent_pipelines = set()
+        self._sent_keyed_reducers = set()
+
+    def __enter__(self):
+        if Dipla._session is not None:
+            raise SessionAlreadyOpen("Only one session can be open at once")
+        if self.run_on_server:
+            self._client = Dipla._start_client_thread()
+        self.server = Dipla._create_server()
+        self._sent_function_ids = set(Dipla._task_functions)
+        self._sent_pipelines = set(Dipla._fused_pipelines)
+        self._sent_keyed_reducers = set(Dipla._keyed_reducers)
+        asyncio.get_event_loop().run_until_complete(self.server.listen(
+            self.address, self.port, Dipla._password))
+        Dipla._session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Dipla._session = None
+        self.server.close()
+        if self._client is not None:
+            self._client.terminate()
+            self._client = None
+
+    def prepare(self):
+        """
+        Sends the binaries of any distributables defined since the session
+        was opened, and wakes the scheduler to run tasks that have been
+        added to the queue.
+
+        Returns:
+         - The session's Server
+        """
+        new_ids = set(Dipla._task_functions) - self._sent_function_ids
+        if new_ids:
+            self.server.add_binaries('.*', Dipla._encode_binaries(new_ids))
+            self._sent_function_ids.update(new_ids)
+        new_pipelines = set(Dipla._fused_pipelines) - self._sent_pipelines
+        if new_pipelines:
+            self.server.add_binaries(
+                '.*', Dipla._encode_pipelines(new_pipelines))
+            self._sent_pipelines.update(new_pipelines)
+        new_keyed_reducers = set(Dipla._keyed_reducers) - \
+            self._sent_keyed_reducers
+        if new_keyed_reducers:
+            self.server.add_binaries(
+                '.*', Dipla._encode_keyed_reducers(new_keyed_reducers))
+            self._sent_keyed_reducers.update(new_keyed_reducers)
+        if self.server.local_executor is not None:
+            Dipla._add_local_functions(
+                self.server.local_executor, new_ids, new_pipelines)
+        self.server.scheduler.wake()
+        return self.server
+
+    def run_until_complete(self, get_task):
+        """
+        Runs the server until the given get task, and every task it reads
+        from, have finished
+        """
+        server = self.prepare()
+        asyncio.get_event_loop().run_until_complete(server.wait_until(
+            lambda: Dipla.task_queue.is_subgraph_inactive(get_task.uid)))
+
 
 class UnsupportedInput(Exception):
     """
@@ -650,6 +2154,21 @@ class DiscoveryBadRequest(RuntimeError):
     pass
 
 
+class SessionAlreadyOpen(RuntimeError):
+    """
+    An exception that is raised when a session is opened while another
+    one is still open
+    """
+    pass
+
+
+class JobFailed(RuntimeError):
+    """
+    An exception that is raised when a job server rejects a submitted job
+    """
+    pass
+
+
 class ReduceBadSize(RuntimeError):
     """
     An exception that is raised when a reduce distributable is given an
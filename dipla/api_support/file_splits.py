@@ -0,0 +1,90 @@
+"""
+This module splits files into ranges of whole records, so that tasks can be
+given a reference to part of a file rather than the data itself.
+
+A split is sent to clients as a dictionary, which the client side scripts
+turn back into the contents of the split before calling the distributable
+function. See dipla.shared.arguments.
+"""
+import mmap
+import os
+from base64 import b64encode
+
+
+def find_splits(path, split_size, delimiter=b'\n', record_size=None):
+    """
+    Divides a file into consecutive splits of roughly split_size bytes,
+    where each split ends at the end of a record.
+
+    Records either end with the delimiter, or are all record_size bytes
+    long if it is given. Only the bytes around the end of each split are
+    read to find the end of its last record, using mmap so that the file
+    is never read into memory.
+
+    Returns:
+     - A list of (offset, length) tuples, in the order they appear in the
+       file
+    """
+    if split_size < 1:
+        raise ValueError("split_size must be at least 1")
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    if record_size is not None:
+        if record_size < 1:
+            raise ValueError("record_size must be at least 1")
+        step = max(split_size // record_size, 1) * record_size
+        return [(offset, min(step, size - offset))
+                for offset in range(0, size, step)]
+
+    splits = []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = size
+            if start + split_size < size:
+                # Find the first delimiter that ends at or after the
+                # target size of the split
+                found = mm.find(delimiter,
+                                max(start + split_size - len(delimiter),
+                                    start))
+                if found != -1:
+                    end = found + len(delimiter)
+            splits.append((start, end - start))
+            start = end
+    return splits
+
+
+def split_references(path, splits, encoding='utf-8'):
+    """
+    Yields the splits as references to the file, for clients that can read
+    the file at the same path, e.g. from shared storage.
+    """
+    path = os.path.abspath(path)
+    for offset, length in splits:
+        yield {
+            '__dipla_file_split__': [path, offset, length],
+            'encoding': encoding,
+        }
+
+
+def split_contents(path, splits, encoding='utf-8'):
+    """
+    Yields the splits with their contents, for clients that cannot read the
+    file. The bytes are base64 encoded straight from the mmap'd file,
+    without being decoded into Python strings on the server.
+    """
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for offset, length in splits:
+                yield {
+                    '__dipla_file_bytes__': b64encode(
+                        view[offset:offset + length]).decode('ascii'),
+                    'encoding': encoding,
+                }
+        finally:
+            view.release()
@@ -16,6 +16,22 @@ def get_encoded_script(func, input_script_template):
     return b64encode(bytes(filled_script, 'UTF-8')).decode('UTF-8')
 
 
+def get_encoded_pipeline_script(functions, input_script_template):
+    """
+    Takes in a list of functions and a template and wraps all of the
+    functions in that template, see fused_argv_input_script
+
+    Returns:
+        A base64 python script that applies each function to the output
+        of the one before it
+    """
+    b64_codes = [str(b64encode(serialise_code_object(func.__code__)))
+                 for func in functions]
+    filled_script = input_script_template.format(
+        "[" + ", ".join(b64_codes) + "]")
+    return b64encode(bytes(filled_script, 'UTF-8')).decode('UTF-8')
+
+
 def serialise_code_object(co):
     """
     Splits a code object into its parts and pickles them.
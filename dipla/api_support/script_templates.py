@@ -2,14 +2,42 @@
 # will run.
 # The '{}' will be replaced with the base64 of the pickle of the deconstructed
 # function code object.
+import inspect
 
-unwrap_function_script = """#! /usr/bin/python3
+from dipla.shared import arguments
+
+
+def _escape(source):
+    # Source copied into a template must keep its braces through format()
+    return source.replace('{', '{{').replace('}', '}}')
+
+
+_script_imports = """#! /usr/bin/python3
 from base64 import b64decode
 from types import CodeType
 import dill
 import json
 import sys
+"""
+
+_script_support = """
+output = dict()
+output['signals'] = dict()
 
+class Dipla:
+    @staticmethod
+    def terminate_tasks():
+        output['signals']['TERMINATE'] = [True]
+
+def read_broadcast_file(value):
+    # Broadcast values are stored in files by the client
+    if '__dipla_broadcast_file__' not in value:
+        return None
+    with open(value['__dipla_broadcast_file__']) as f:
+        return f.read()
+""" + _escape(inspect.getsource(arguments))
+
+unwrap_function_script = _script_imports + """
 encoded_code = {}
 pickled_code = b64decode(encoded_code)
 codeobject_data = dill.loads(pickled_code)
@@ -19,25 +47,52 @@ def unwraped_func():
     pass
 
 unwraped_func.__code__ = func_code
-
-output = dict()
-output['signals'] = dict()
-
-class Dipla:
-    @staticmethod
-    def terminate_tasks():
-        output['signals']['TERMINATE'] = [True]
-"""
+""" + _script_support
 
 argv_input_script = unwrap_function_script + """
-args = json.loads(sys.argv[1])
+args = [load_argument(arg, read_broadcast_file)
+        for arg in json.loads(sys.argv[1])]
 output['data'] = unwraped_func(*args)
 print(json.dumps(output))"""
 
+# The '{}' in this template is replaced with a list of the base64 of each
+# function's code object, in the order the functions are applied.
+fused_argv_input_script = _script_imports + """
+encoded_codes = {}
+
+def unwrap(encoded_code):
+    def unwraped_func():
+        pass
+
+    unwraped_func.__code__ = CodeType(*dill.loads(b64decode(encoded_code)))
+    return unwraped_func
+
+stages = [unwrap(encoded_code) for encoded_code in encoded_codes]
+""" + _script_support + """
+args = [load_argument(arg, read_broadcast_file)
+        for arg in json.loads(sys.argv[1])]
+value = stages[0](*args)
+for stage in stages[1:]:
+    # Values are passed through JSON as they would be if each stage ran
+    # as a separate task, so that tuples become lists and so on
+    value = stage(json.loads(json.dumps(value)))
+output['data'] = value
+print(json.dumps(output))"""
+
+# The argument of this script is one partition of a shuffle, a list of
+# [key, values] groups, and the function reduces the values of each key.
+# See dipla.server.shuffle
+keyed_reduce_argv_input_script = unwrap_function_script + """
+args = [load_argument(arg, read_broadcast_file)
+        for arg in json.loads(sys.argv[1])]
+output['data'] = [[key, unwraped_func(values)] for key, values in args[0]]
+print(json.dumps(output))"""
+
 explorer_argv_input_script = unwrap_function_script + """
 discovered = []
 
-args = json.loads(sys.argv[1])
+args = [load_argument(arg, read_broadcast_file)
+        for arg in json.loads(sys.argv[1])]
 output['data'] = unwraped_func(*args, discovered)
 
 for value in discovered:
@@ -1,11 +1,14 @@
 import asyncio
 import websockets
 import json
+import shutil
+import tempfile
 import threading
 import time
 import os
 
 from dipla.client.quality_scorer import QualityScorer
+from dipla.client.resources import measure_resources
 from dipla.shared.services import ServiceError
 from dipla.shared.message_generator import generate_message
 from dipla.shared.logutils import LogUtils
@@ -20,6 +23,17 @@ class Client(object):
         self.connect_tries_limit = 8
         # Set of task UIDs that have been marked as terminated by the server
         self._terminated_tasks = set()
+        # Dictionary of broadcast key to the file the value is stored in.
+        # Values are stored in files so that they are not passed to every
+        # run of a binary on its command line
+        self.broadcast_paths = {}
+        self._broadcast_directory = None
+        self._broadcast_lock = threading.Lock()
+        # Dictionary of object id to the file holding the object, for the
+        # results this client keeps rather than sending to the server.
+        # See dipla.shared.objects
+        self.object_paths = {}
+        self._object_directory = None
         # A class to be used to assign a quality to this client
         if quality_scorer:
             self.quality_scorer = quality_scorer
@@ -32,6 +46,55 @@ class Client(object):
     def is_task_terminated(self, task_uid):
         return task_uid in self._terminated_tasks
 
+    def add_broadcast(self, key, serialised_value):
+        with self._broadcast_lock:
+            if key in self.broadcast_paths:
+                return
+            if self._broadcast_directory is None:
+                self._broadcast_directory = tempfile.mkdtemp(
+                    prefix='dipla_broadcasts_')
+            path = os.path.join(self._broadcast_directory, key)
+            with open(path, 'w') as broadcast_file:
+                broadcast_file.write(serialised_value)
+            self.broadcast_paths[key] = path
+
+    def add_object(self, object_id, serialised_value):
+        with self._broadcast_lock:
+            if self._object_directory is None:
+                self._object_directory = tempfile.mkdtemp(
+                    prefix='dipla_objects_')
+            path = os.path.join(self._object_directory, object_id)
+            with open(path, 'w') as object_file:
+                object_file.write(serialised_value)
+            self.object_paths[object_id] = path
+
+    def remove_stored_values(self):
+        """
+        Deletes the files of the broadcasts and objects this client holds.
+        The server forgets the objects of a worker once it disconnects, so
+        they are of no use after that
+        """
+        with self._broadcast_lock:
+            for directory in (self._broadcast_directory,
+                              self._object_directory):
+                if directory is not None:
+                    shutil.rmtree(directory, ignore_errors=True)
+            self._broadcast_directory = None
+            self._object_directory = None
+            self.broadcast_paths = {}
+            self.object_paths = {}
+
+    def read_object(self, object_id):
+        """
+        Returns:
+         - The serialised value of an object this client holds
+
+        Raises:
+         - KeyError if the client does not hold the object
+        """
+        with open(self.object_paths[object_id]) as object_file:
+            return object_file.read()
+
     def inject_services(self, services):
         # TODO: Refactor Client
         #
@@ -169,10 +232,14 @@ class Client(object):
         data = {
             'platform': self._get_platform(),
             'quality': self._get_quality(),
+            'resources': measure_resources(),
             'password': password,
         }
         asyncio.ensure_future(
             self._send_async(generate_message('get_binaries', data)))
 
         self._stats_updater.overwrite('running', True)
-        loop.run_until_complete(receive_task)
+        try:
+            loop.run_until_complete(receive_task)
+        finally:
+            self.remove_stored_values()
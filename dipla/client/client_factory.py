@@ -4,6 +4,8 @@ from dipla.client.client_services import VerifyInputsService
 from dipla.client.client_services import BinaryReceiverService
 from dipla.client.client_services import ServerErrorService
 from dipla.client.client_services import TerminateTaskService
+from dipla.client.client_services import FetchObjectsService
+from dipla.client.client_services import HeartbeatService
 from dipla.client.command_line_binary_runner import CommandLineBinaryRunner
 from dipla.shared.logutils import LogUtils
 from dipla.shared.statistics import StatisticsUpdater
@@ -80,6 +82,8 @@ class ClientFactory:
                 ClientFactory._create_binary_receiver(client),
             ServerErrorService.get_label(): ServerErrorService(client),
             TerminateTaskService.get_label(): TerminateTaskService(client),
+            FetchObjectsService.get_label(): FetchObjectsService(client),
+            HeartbeatService.get_label(): HeartbeatService(client),
         }
         return services
 
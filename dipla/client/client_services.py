@@ -1,6 +1,7 @@
+import json
 import logging
 import os
-from dipla.shared import message_generator
+from dipla.shared import message_generator, broadcasts, objects
 from dipla.shared.services import ServiceError
 from dipla.shared.error_codes import ErrorCodes
 
@@ -50,6 +51,51 @@ class BinaryRunnerService(ClientService):
         expected_results = len(args[0])
         return [None] * expected_results
 
+    def _resolve_broadcasts(self, data):
+        # Swap each reference to a broadcast or to an object this client
+        # holds for a reference to the file the value is stored in, which
+        # the binary reads it from
+        for key, serialised_value in data.get('broadcasts', {}).items():
+            self._client.add_broadcast(key, serialised_value)
+        arguments = []
+        for argument_values in data['arguments']:
+            resolved = []
+            for value in argument_values:
+                key = broadcasts.get_reference_key(value)
+                if key is None:
+                    resolved.append(self._resolve_objects(value))
+                    continue
+                if key not in self._client.broadcast_paths:
+                    raise ServiceError(
+                        KeyError('Broadcast "' + key + '" was not sent'),
+                        ErrorCodes.missing_broadcast)
+                resolved.append({
+                    '__dipla_broadcast_file__':
+                        self._client.broadcast_paths[key],
+                })
+            arguments.append(resolved)
+        return arguments
+
+    def _resolve_objects(self, value):
+        object_id = objects.get_object_id(value)
+        if object_id is not None:
+            return {'__dipla_broadcast_file__': self._object_path(object_id)}
+        # The groups given to reduce functions are lists, whose objects
+        # are read here, as the binary only reads files at the top level
+
+        def read(reference):
+            object_id = objects.get_object_id(reference)
+            self._object_path(object_id)
+            return json.loads(self._client.read_object(object_id))
+        return objects.replace_references(value, read)
+
+    def _object_path(self, object_id):
+        if object_id not in self._client.object_paths:
+            raise ServiceError(
+                KeyError('Object "' + object_id + '" is not held'),
+                ErrorCodes.missing_object)
+        return self._client.object_paths[object_id]
+
     def _make_final_message(self, uid, results, signals):
         data = {
             'task_uid': uid,
@@ -74,7 +120,7 @@ class BinaryRunnerService(ClientService):
         future_res = self._pool.submit(
             self._binary_runner.run,
             self._client.binary_paths[task],
-            data['arguments'])
+            self._resolve_broadcasts(data))
         # This loop checks every 1 second to see if a task has been terminated
         # as soon as there is a result ready it moves on, so there is very
         # little performance penalty.
@@ -100,8 +146,38 @@ class RunInstructionsService(BinaryRunnerService):
     def execute(self, data):
         result_message = super().execute(data)
         result_message['label'] = 'client_result'
+        if data.get('combiner') is not None:
+            self._combine(data, result_message['data'])
+        if data.get('keep_results'):
+            result_message['data']['results'] = [
+                self._keep(result)
+                for result in result_message['data']['results']]
         return result_message
 
+    def _combine(self, data, result_data):
+        # The batch's results are folded into one with the reduce function
+        # of the task reading them, which is sent back in their place
+        results = result_data['results']
+        if len(results) < 2 or self._client.is_task_terminated(
+                data['task_uid']):
+            return
+        combiner = data['combiner']
+        if combiner not in self._client.binary_paths:
+            raise ServiceError(
+                KeyError('Combiner "' + combiner + '" does not exist'),
+                ErrorCodes.invalid_binary_key)
+        combined, _ = self._binary_runner.run(
+            self._client.binary_paths[combiner], [[results]])
+        result_data['results'] = combined
+        result_data['combined'] = len(results)
+
+    def _keep(self, result):
+        # The result stays on this client, and the server is sent a
+        # reference to it
+        object_id, serialised = objects.serialise(result)
+        self._client.add_object(object_id, serialised)
+        return objects.make_reference(object_id, len(serialised))
+
 
 class VerifyInputsService(BinaryRunnerService):
 
@@ -115,6 +191,38 @@ class VerifyInputsService(BinaryRunnerService):
         return result_message
 
 
+class FetchObjectsService(ClientService):
+
+    @staticmethod
+    def get_label():
+        return 'fetch_objects'
+
+    def execute(self, data):
+        found = {}
+        missing = []
+        for object_id in data['object_ids']:
+            try:
+                found[object_id] = self._client.read_object(object_id)
+            except KeyError:
+                missing.append(object_id)
+        return message_generator.generate_message(
+            'fetched_objects', {'objects': found, 'missing': missing})
+
+
+class HeartbeatService(ClientService):
+
+    @staticmethod
+    def get_label():
+        return 'heartbeat'
+
+    def execute(self, data):
+        # The probe is not echoed back, as its size is all the server needs
+        # to measure the bandwidth
+        return message_generator.generate_message(
+            'heartbeat', {'sent_at': data['sent_at'],
+                          'probe_size': len(data.get('probe', ''))})
+
+
 class BinaryReceiverService(ClientService):
 
     @staticmethod
@@ -0,0 +1,45 @@
+"""
+This module measures the resources of the machine a client runs on, which
+the client reports to the server so that tasks with requirements, e.g.
+Dipla.distributable(mem_mb=2000), are only sent to workers that meet them.
+"""
+import importlib.util
+import os
+import shutil
+
+
+def measure_resources(path='.'):
+    """
+    Params:
+     - path: A path on the disk that binaries and objects are stored on
+
+    Returns:
+     - A dictionary with the number of CPUs ('cpu'), the physical memory in
+       MB ('mem_mb'), the free disk space in MB ('disk_mb') and whether
+       NumPy can be imported ('numpy'). Resources that cannot be measured
+       on this platform are left out
+    """
+    resources = {
+        'cpu': os.cpu_count(),
+        'mem_mb': _memory_mb(),
+        'disk_mb': _free_disk_mb(path),
+        'numpy': importlib.util.find_spec('numpy') is not None,
+    }
+    return {name: value for name, value in resources.items()
+            if value is not None}
+
+
+def _memory_mb():
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+    return pages * page_size // (1024 * 1024)
+
+
+def _free_disk_mb(path):
+    try:
+        return shutil.disk_usage(path).free // (1024 * 1024)
+    except OSError:
+        return None
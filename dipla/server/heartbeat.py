@@ -0,0 +1,67 @@
+"""
+This module measures how far away each worker is. The server sends every
+connected worker a heartbeat message at a regular interval, which the
+worker echoes straight back, and the time taken is the worker's round trip
+time. Every few heartbeats a probe of padding is added to the message, and
+the extra time it takes gives an estimate of the worker's bandwidth.
+
+Workers that have sent nothing, heartbeat or otherwise, for longer than the
+timeout are taken to be gone, even if their connection has not closed.
+"""
+from dipla.shared.statistics import moving_average
+
+# The shortest time a probe is taken to have been transferred in, so that
+# a probe that was no slower than a heartbeat does not give an infinite
+# bandwidth
+MIN_TRANSFER_TIME = 0.001
+
+
+class HeartbeatMonitor:
+
+    def __init__(self, interval=5.0, timeout=20.0, probe_every=12,
+                 probe_size=64 * 1024):
+        """
+        Params:
+         - interval: The number of seconds between heartbeats
+         - timeout: The number of seconds a worker can be silent for before
+        it is removed
+         - probe_every: Every probe_every'th heartbeat sent to a worker
+        carries a probe, starting with the second one so that the round
+        trip time is known first. 0 means no probes are sent
+         - probe_size: The number of bytes of padding in a probe
+        """
+        if timeout <= interval:
+            raise ValueError("The timeout must be longer than the interval")
+        self.interval = interval
+        self.timeout = timeout
+        self.probe_every = probe_every
+        self.probe_size = probe_size
+
+    def make_heartbeat(self, worker, now):
+        """
+        Returns:
+         - The data of the next heartbeat message to send to the worker
+        """
+        data = {'sent_at': now}
+        if self.probe_every and \
+                worker.heartbeats_sent % self.probe_every == 1:
+            data['probe'] = 'x' * self.probe_size
+        worker.heartbeats_sent += 1
+        return data
+
+    def record_reply(self, worker, data, now):
+        """
+        Updates the worker's round trip time, or its bandwidth if the
+        heartbeat carried a probe, from the worker's echo of a heartbeat
+        """
+        round_trip = now - data['sent_at']
+        probe_size = data.get('probe_size', 0)
+        if not probe_size:
+            worker.rtt = moving_average(worker.rtt, round_trip)
+        elif worker.rtt is not None:
+            transfer_time = max(round_trip - worker.rtt, MIN_TRANSFER_TIME)
+            worker.bandwidth = moving_average(
+                worker.bandwidth, probe_size / transfer_time)
+
+    def is_silent(self, worker, now):
+        return now - worker.last_seen > self.timeout
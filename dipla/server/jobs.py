@@ -0,0 +1,284 @@
+"""
+This module lets a single server run the task graphs of many driver
+programs at once. Each submitted Job has its own TaskQueue, and the JobQueue
+presents all of them to the Server and Scheduler as if they were one
+TaskQueue.
+"""
+import asyncio
+from collections import OrderedDict
+
+from dipla.server.task_queue import TaskQueue, TaskQueueEmpty, Task
+from dipla.server.task_queue import DataSource, MachineType
+from dipla.server.result_verifier import ResultVerifier
+from dipla.server.server import BinaryManager, Server, ServerServices
+from dipla.shared import statistics, uid_generator
+
+
+class Job:
+
+    def __init__(self, uid, weight=1):
+        """
+        A job is one submitted task graph, which is run in its own
+        TaskQueue
+
+        uid is the unique identifier of the job. The uids of the job's
+        tasks and the names of its binaries are prefixed with it, so that
+        they do not clash with those of other jobs
+
+        weight is the job's share of the workers relative to the other
+        jobs. A job with a weight of 2 is given twice as many workers as a
+        job with a weight of 1 when both have input available
+        """
+        if weight <= 0:
+            raise ValueError("Job weights must be positive")
+        self.uid = uid
+        self.weight = weight
+        self.task_queue = TaskQueue()
+        self.result_task_uid = None
+        # Dictionary of the name of each of the job's binaries to the
+        # base64 encoded binary
+        self.binaries = {}
+
+    @staticmethod
+    def from_message(uid, message):
+        """
+        Creates a Job from the data of a submit_job message, which has the
+        keys:
+         - tasks: A list of tasks in the order they should be pushed. Each
+        is a dictionary with a 'uid', the 'instructions' naming the binary
+        to run, a list of 'sources', and optionally 'is_reduce' and
+        'reduce_group_size'. Each source is either {'values': [...]} or
+        {'task': uid of an earlier task}
+         - result_task: The uid of the task whose output is the result
+         - binaries: Optional, a dictionary of the name of each binary the
+        tasks run to the base64 encoded binary
+         - weight: Optional, see the Job constructor
+
+        Raises:
+         - ValueError if the message does not describe a valid job
+        """
+        try:
+            job = Job(uid, message.get('weight', 1))
+            for task_data in message['tasks']:
+                job.push_task(task_data)
+            job.result_task_uid = job.task_uid(message['result_task'])
+            job.task_queue.get_task(job.result_task_uid)
+            job.binaries = {
+                job.binary_name(name): binary
+                for name, binary in message.get('binaries', {}).items()}
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Invalid job description: " + str(e))
+        return job
+
+    def task_uid(self, uid):
+        return self.uid + "/" + uid
+
+    def binary_name(self, name):
+        return self.uid + "-" + name
+
+    def push_task(self, task_data):
+        task = Task(
+            self.task_uid(task_data['uid']),
+            self.binary_name(task_data['instructions']),
+            MachineType.client,
+            complete_check=lambda streamer: not streamer.has_available_data(),
+            signals={
+                'TERMINATE':
+                    lambda server, uid, _: server.terminate_task(uid),
+            },
+            is_reduce=task_data.get('is_reduce', False),
+            reduce_group_size=task_data.get('reduce_group_size', 2))
+        for i, source in enumerate(task_data['sources']):
+            source_uid = task.uid + "/" + str(i)
+            if 'task' in source:
+                source_task = self.task_queue.get_task(
+                    self.task_uid(source['task']))
+                task.add_data_source(DataSource.create_source_from_task(
+                    source_task, source_uid))
+            else:
+                task.add_data_source(DataSource.create_source_from_iterable(
+                    source['values'], source_uid))
+        self.task_queue.push_task(task)
+
+    def in_flight(self):
+        return sum(self.task_queue.get_task(task_uid).in_flight()
+                   for task_uid in self.task_queue.get_task_ids())
+
+    def is_finished(self):
+        return self.task_queue.is_inactive()
+
+    def results(self):
+        result_task = self.task_queue.get_task(self.result_task_uid)
+        if result_task.is_reduce:
+            # Only the last value of a reduce is the result
+            return result_task.task_output[-1:]
+        return result_task.task_output
+
+
+class JobQueue:
+    """
+    Routes the TaskQueue operations used by the Server and Scheduler to the
+    TaskQueue of the job that owns each task. Tasks are offered to the
+    scheduler job by job, starting with the job using the smallest share
+    of its weight, so that workers are split between jobs by weighted fair
+    share whichever SchedulingPolicy is used.
+    """
+
+    def __init__(self, binary_manager=None):
+        """
+        binary_manager is the BinaryManager that the binaries of jobs are
+        added to, which they are removed from when the job is removed
+        """
+        self.binary_manager = binary_manager
+        # A dictionary of job uid to Job, kept in submission order
+        self._jobs = OrderedDict()
+
+    def create_job(self, message):
+        """
+        Creates a Job from the data of a submit_job message and adds it to
+        the queue. See Job.from_message for the format of the message.
+
+        Returns:
+         - The new Job
+        """
+        job = Job.from_message(self.generate_job_uid(), message)
+        self.add_job(job)
+        return job
+
+    def add_job(self, job):
+        if job.uid in self._jobs:
+            raise ValueError("Job " + job.uid + " has already been added")
+        self._jobs[job.uid] = job
+
+    def remove_job(self, job_uid):
+        if job_uid not in self._jobs:
+            raise KeyError("Attempted to remove a job that is not running")
+        job = self._jobs.pop(job_uid)
+        if self.binary_manager is not None:
+            self.binary_manager.remove_binaries(job.binaries)
+
+    def get_job(self, job_uid):
+        return self._jobs[job_uid]
+
+    def generate_job_uid(self):
+        return uid_generator.generate_uid(
+            length=8, existing_uids=self._jobs.keys())
+
+    def _jobs_by_share(self):
+        # sorted() is stable, so jobs with equal shares stay in
+        # submission order
+        return sorted(self._jobs.values(),
+                      key=lambda job: job.in_flight() / job.weight)
+
+    def _queue_for_task(self, task_uid):
+        job_uid = task_uid.split("/", 1)[0]
+        if job_uid not in self._jobs:
+            raise KeyError("Task " + task_uid + " is not part of any job")
+        return self._jobs[job_uid].task_queue
+
+    def has_next_input(self, machine_type=None):
+        return any(job.task_queue.has_next_input(machine_type)
+                   for job in self._jobs.values())
+
+    def ready_task_uids(self, machine_type=None):
+        task_uids = []
+        for job in self._jobs_by_share():
+            task_uids.extend(job.task_queue.ready_task_uids(machine_type))
+        return task_uids
+
+    def pop_task_input(self, machine_type=None, task_uid=None, batch_size=1):
+        if task_uid is not None:
+            return self._queue_for_task(task_uid).pop_task_input(
+                machine_type, task_uid, batch_size)
+        for job in self._jobs_by_share():
+            if job.task_queue.has_next_input(machine_type):
+                return job.task_queue.pop_task_input(
+                    machine_type, batch_size=batch_size)
+        raise TaskQueueEmpty("No job has any input to pop")
+
+    def add_result(self, task_uid, result, num_inputs=1):
+        self._queue_for_task(task_uid).add_result(
+            task_uid, result, num_inputs)
+
+    def cancel_task(self, task_uid):
+        self._queue_for_task(task_uid).cancel_task(task_uid)
+
+    def fail_task(self, task_uid, error):
+        self._queue_for_task(task_uid).fail_task(task_uid, error)
+
+    def get_dependency_ids(self, task_uid):
+        return self._queue_for_task(task_uid).get_dependency_ids(task_uid)
+
+    def get_dependee_ids(self, task_uid):
+        return self._queue_for_task(task_uid).get_dependee_ids(task_uid)
+
+    def num_reduce_values(self, task_uid):
+        return self._queue_for_task(task_uid).num_reduce_values(task_uid)
+
+    def remaining_reduce_values(self, task_uid):
+        return self._queue_for_task(task_uid).remaining_reduce_values(
+            task_uid)
+
+    def set_reduce_group_size(self, task_uid, reduce_group_size):
+        self._queue_for_task(task_uid).set_reduce_group_size(
+            task_uid, reduce_group_size)
+
+    def get_task(self, task_uid):
+        return self._queue_for_task(task_uid).get_task(task_uid)
+
+    def get_task_by_id(self, task_uid):
+        return self._queue_for_task(task_uid).get_task_by_id(task_uid)
+
+    def is_task_complete(self, task_uid):
+        return self._queue_for_task(task_uid).is_task_complete(task_uid)
+
+    def is_task_finished(self, task_uid):
+        return self._queue_for_task(task_uid).is_task_finished(task_uid)
+
+    def is_subgraph_inactive(self, task_uid):
+        return self._queue_for_task(task_uid).is_subgraph_inactive(task_uid)
+
+    def is_inactive(self):
+        return all(job.is_finished() for job in self._jobs.values())
+
+    def get_task_ids(self):
+        task_uids = []
+        for job in self._jobs.values():
+            task_uids.extend(job.task_queue.get_task_ids())
+        return task_uids
+
+
+def create_job_server(scheduler=None):
+    """
+    Creates a Server that runs the jobs submitted to it with submit_job
+    messages, instead of a single task graph.
+    """
+    stat_updater = statistics.StatisticsUpdater({
+        "num_total_workers": 0,
+        "num_idle_workers": 0,
+        "start_time": "",
+        "num_results_from_clients": 0,
+    })
+    binary_manager = BinaryManager()
+    # Workers can connect before any jobs have been submitted, so they
+    # are given an empty set of binaries to begin with
+    binary_manager.add_encoded_binaries('.*', [])
+    server = Server(
+        task_queue=JobQueue(binary_manager),
+        services=ServerServices(binary_manager, stat_updater),
+        result_verifier=ResultVerifier(),
+        stats=stat_updater,
+        should_distribute_tasks=True,
+        scheduler=scheduler)
+    return server
+
+
+def start_job_server(address='0.0.0.0', port=8765, password=None):
+    """
+    Runs a job server until the process is stopped, e.g. with a
+    stop_server message.
+    """
+    server = create_job_server()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.listen(address, port, password))
+    loop.run_forever()
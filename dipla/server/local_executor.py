@@ -0,0 +1,281 @@
+"""
+This module runs the inputs of cheap client tasks in a pool of processes on
+the server, for tasks where sending the input to a worker and running it
+there takes longer than running it locally.
+
+The LocalExecutor measures how long each task takes per input on the
+workers, from when the input is sent until its results come back, and how
+long it takes in the local pool. A task is only run locally while its local
+time is clearly lower. Each measurement is an exponential moving average,
+and whichever way a task is not being run is tried again once its
+measurement is old, so the choice changes if either one does.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import dill
+
+from dipla.shared import broadcasts
+from dipla.shared.arguments import load_argument
+from dipla.shared.statistics import moving_average
+
+
+class TaskCosts:
+
+    def __init__(self):
+        """
+        The measured costs of running one task. Times are in seconds per
+        input, and are None until they have been measured
+        """
+        self.remote_time = None
+        self.local_time = None
+        # The average size of the JSON of one input sent to a worker
+        self.payload_size = None
+        self.remote_measured_at = None
+        self.local_measured_at = None
+        # The number of batches sent to workers or the local pool that
+        # have not finished yet
+        self.remote_pending = 0
+        self.local_pending = 0
+
+    def to_dict(self):
+        return {
+            'remote_time': self.remote_time,
+            'local_time': self.local_time,
+            'payload_size': self.payload_size,
+        }
+
+
+class LocalExecutor:
+
+    def __init__(self, max_workers=None, margin=2.0, revisit_after=5.0):
+        """
+        Params:
+         - max_workers: The number of processes in the pool, which is also
+        the most batches run locally at once. None uses the number of CPUs
+         - margin: How many times faster local execution must be measured
+        to be before a task is run locally
+         - revisit_after: The number of seconds after which the way a task
+        is not being run is measured again
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.margin = margin
+        self.revisit_after = revisit_after
+        self._pool = None
+        # Dictionary of task instructions to the list of dill'd functions
+        # that are applied, one after the other, to each input
+        self._functions = {}
+        # Dictionary of task uid to TaskCosts
+        self._costs = {}
+        self._num_running = 0
+
+    def add_function(self, instructions, functions):
+        """
+        Allows the tasks with the given instructions to be run locally, by
+        applying each function in turn to every input
+
+        Returns:
+         - True if the functions could be serialised, and so can be run
+           in the pool
+        """
+        try:
+            self._functions[instructions] = [
+                dill.dumps(function, recurse=True) for function in functions]
+        except Exception:
+            return False
+        return True
+
+    def can_run(self, instructions):
+        return instructions in self._functions
+
+    def has_capacity(self):
+        return self._num_running < self.max_workers
+
+    def _get_pool(self):
+        # The processes are only started once something is run locally
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.max_workers)
+        return self._pool
+
+    def get_costs(self, task_uid):
+        if task_uid not in self._costs:
+            self._costs[task_uid] = TaskCosts()
+        return self._costs[task_uid]
+
+    def should_run_locally(self, task_uid, now=None):
+        """
+        Returns True if the next input of a task should be run locally
+        rather than sent to a worker
+        """
+        if now is None:
+            now = time.monotonic()
+        costs = self.get_costs(task_uid)
+        if costs.remote_time is None:
+            # Tasks are always tried on the workers first
+            return False
+        if costs.local_time is None:
+            return costs.local_pending == 0
+        run_locally = costs.local_time * self.margin < costs.remote_time
+        if run_locally and costs.remote_pending == 0 and \
+                now - costs.remote_measured_at > self.revisit_after:
+            return False
+        if not run_locally and costs.local_pending == 0 and \
+                now - costs.local_measured_at > self.revisit_after:
+            return True
+        return run_locally
+
+    def record_sent(self, task_uid, num_inputs, payload_size):
+        """
+        Records that a batch of inputs was sent to a worker, with the size
+        of the JSON of its arguments
+        """
+        costs = self.get_costs(task_uid)
+        costs.remote_pending += 1
+        costs.payload_size = moving_average(
+            costs.payload_size, payload_size / max(num_inputs, 1))
+
+    def record_remote_run(self, task_uid, num_inputs, duration):
+        """
+        Records the time from sending a batch to a worker until its results
+        came back
+        """
+        costs = self.get_costs(task_uid)
+        costs.remote_pending = max(costs.remote_pending - 1, 0)
+        if num_inputs == 0:
+            return
+        costs.remote_time = moving_average(
+            costs.remote_time, duration / num_inputs)
+        costs.remote_measured_at = time.monotonic()
+
+    def record_local_run(self, task_uid, num_inputs, duration):
+        costs = self.get_costs(task_uid)
+        costs.local_pending = max(costs.local_pending - 1, 0)
+        if num_inputs == 0:
+            return
+        costs.local_time = moving_average(
+            costs.local_time, duration / num_inputs)
+        costs.local_measured_at = time.monotonic()
+
+    def run(self, task_input, broadcast_values, on_results):
+        """
+        Runs a TaskInput in the pool. Once it has finished on_results is
+        called on the event loop with the list of results and the signals
+        the functions sent, as a worker sends them, or with None and None
+        if running it failed, in which case the task is no longer run
+        locally
+
+        Params:
+         - task_input: The TaskInput to run
+         - broadcast_values: Dictionary of broadcast key to serialised
+        value, for the broadcasts the input refers to
+         - on_results: Function taking the results and the signals
+        """
+        task_uid = task_input.task_uid
+        num_inputs = len(task_input.values[0]) if task_input.values else 0
+
+        def read_broadcast(value):
+            key = broadcasts.get_reference_key(value)
+            return None if key is None else broadcast_values[key]
+        arguments = [[load_argument(value, read_broadcast)
+                      for value in argument_values]
+                     for argument_values in task_input.values]
+        costs = self.get_costs(task_uid)
+        costs.local_pending += 1
+        self._num_running += 1
+        started_at = time.perf_counter()
+        future = self._get_pool().submit(
+            run_batch, self._functions[task_input.task_instructions],
+            arguments)
+        loop = asyncio.get_event_loop()
+
+        def finished(future):
+            self._num_running -= 1
+            try:
+                results, signals = future.result()
+            except Exception:
+                costs.local_pending = max(costs.local_pending - 1, 0)
+                self._functions.pop(task_input.task_instructions, None)
+                on_results(None, None)
+                return
+            self.record_local_run(
+                task_uid, num_inputs, time.perf_counter() - started_at)
+            on_results(results, signals)
+
+        future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(finished, future))
+
+    def summary(self):
+        """
+        Returns:
+         - A dictionary of task uid to the measured costs of the task
+        """
+        return {task_uid: costs.to_dict()
+                for task_uid, costs in self._costs.items()}
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+# The functions that have been loaded in this process, by the hash of
+# their serialised form, so that each one is only loaded once
+_loaded_functions = {}
+
+
+def load_function(serialised):
+    key = hashlib.sha256(serialised).hexdigest()
+    if key not in _loaded_functions:
+        _loaded_functions[key] = dill.loads(serialised)
+    return _loaded_functions[key]
+
+
+# Dictionary of signal to its values, for the signals sent by the functions
+# run_batch is running in this process, or None while it is not running
+_signals = None
+
+
+def send_signal(signal, values):
+    """
+    Sends a signal, such as the one sent by Dipla.terminate_tasks, from a
+    function being run by run_batch, as the scripts run by workers do
+
+    Returns:
+     - False if no function is being run by run_batch in this process
+    """
+    if _signals is None:
+        return False
+    _signals[signal] = values
+    return True
+
+
+def run_batch(serialised_functions, arguments):
+    """
+    Runs in a pool process. Applies the functions in turn to each input,
+    passing values through JSON as they would be between a worker and the
+    server, and between the stages of a fused task
+
+    Returns:
+     - The list of results, one for each input, and the dictionary of
+       signal to values that the functions sent
+    """
+    global _signals
+    functions = [load_function(serialised)
+                 for serialised in serialised_functions]
+    results = []
+    _signals = {}
+    try:
+        for args in zip(*arguments):
+            value = functions[0](*args)
+            for function in functions[1:]:
+                value = function(json.loads(json.dumps(value)))
+            results.append(json.loads(json.dumps(value)))
+        return results, _signals
+    finally:
+        _signals = None
@@ -0,0 +1,145 @@
+"""
+This module fetches the values of objects kept on workers, for task inputs
+that refer to them but are run somewhere else. See dipla.shared.objects
+"""
+import json
+
+from dipla.shared import objects
+
+
+class ObjectFetcher:
+
+    def __init__(self, request_objects):
+        """
+        Params:
+         - request_objects: A function taking the uid of a worker and a
+        list of object ids, that asks the worker to send the objects. It
+        returns False if the worker is no longer connected
+        """
+        self._request_objects = request_objects
+        # Dictionary of object id to the uid of the worker it has been
+        # requested from, for objects that have not arrived yet
+        self._requested = {}
+        # Dictionary of object id to serialised value, for the objects
+        # that have arrived and are still waited for
+        self._fetched = {}
+        # A list of (object ids, values, worker uid, on_resolved, on_lost)
+        # tuples, one for each fetch that is waiting for objects
+        self._waiting = []
+
+    def fetch(self, values, worker_uid, on_resolved, on_lost):
+        """
+        Fetches the objects that values refers to, apart from the ones
+        held by the worker the values will be sent to. on_resolved is then
+        called with a copy of values where the references to the fetched
+        objects are swapped for their values. It is called straight away
+        if nothing needs to be fetched
+
+        Params:
+         - values: The values of a TaskInput
+         - worker_uid: The uid of the worker the values will be sent to, or
+        None if they are used on the server, so every object is fetched
+         - on_resolved: A function taking the resolved values
+         - on_lost: A function taking the list of the ids of objects that
+        could not be fetched, because the worker holding them has gone.
+        It is called instead of on_resolved
+        """
+        needed = {}
+        for reference in objects.find_references(values):
+            holder = reference.get('worker')
+            if holder != worker_uid:
+                needed[objects.get_object_id(reference)] = holder
+        if not needed:
+            on_resolved(values)
+            return
+        self._waiting.append(
+            (set(needed), values, worker_uid, on_resolved, on_lost))
+
+        requests = {}
+        for object_id, holder in needed.items():
+            if object_id in self._fetched or object_id in self._requested:
+                continue
+            requests.setdefault(holder, []).append(object_id)
+        lost = []
+        for holder, object_ids in requests.items():
+            if holder is not None and \
+                    self._request_objects(holder, object_ids):
+                for object_id in object_ids:
+                    self._requested[object_id] = holder
+            else:
+                lost.extend(object_ids)
+        self._lose(lost)
+        self._resolve_ready()
+
+    def add_objects(self, serialised_objects, missing=()):
+        """
+        Adds the objects a worker sent back, and resolves the fetches that
+        were waiting for them
+
+        Params:
+         - serialised_objects: Dictionary of object id to serialised value
+         - missing: The ids of requested objects the worker did not have
+        """
+        for object_id, serialised in serialised_objects.items():
+            if self._requested.pop(object_id, None) is not None:
+                self._fetched[object_id] = serialised
+        for object_id in missing:
+            self._requested.pop(object_id, None)
+        self._lose(missing)
+        self._resolve_ready()
+
+    def remove_holder(self, worker_uid):
+        """
+        Fails the fetches waiting for objects from a worker that has gone
+        """
+        lost = [object_id for object_id, holder in self._requested.items()
+                if holder == worker_uid]
+        for object_id in lost:
+            del self._requested[object_id]
+        self._lose(lost)
+
+    def num_waiting(self):
+        return len(self._waiting)
+
+    def _lose(self, object_ids):
+        lost = set(object_ids)
+        if not lost:
+            return
+        failed = [waiter for waiter in self._waiting if waiter[0] & lost]
+        self._waiting = [waiter for waiter in self._waiting
+                         if not waiter[0] & lost]
+        self._forget_unneeded()
+        for object_ids, _, _, _, on_lost in failed:
+            on_lost(sorted(object_ids & lost))
+
+    def _resolve_ready(self):
+        ready = []
+        waiting = []
+        for waiter in self._waiting:
+            if all(object_id in self._fetched for object_id in waiter[0]):
+                ready.append(waiter)
+            else:
+                waiting.append(waiter)
+        self._waiting = waiting
+        resolved = [(self._resolve(values, worker_uid), on_resolved)
+                    for _, values, worker_uid, on_resolved, _ in ready]
+        self._forget_unneeded()
+        # The callbacks are run last, as they can start more fetches
+        for values, on_resolved in resolved:
+            on_resolved(values)
+
+    def _resolve(self, values, worker_uid):
+        def replace(reference):
+            if reference.get('worker') == worker_uid:
+                return reference
+            return json.loads(
+                self._fetched[objects.get_object_id(reference)])
+        return objects.replace_references(values, replace)
+
+    def _forget_unneeded(self):
+        needed = set()
+        for waiter in self._waiting:
+            needed |= waiter[0]
+        for object_id in list(self._fetched):
+            if object_id not in needed:
+                del self._fetched[object_id]
@@ -0,0 +1,313 @@
+"""
+This module plans how the tasks a result depends on will be run, before the
+server starts running them. A QueryPlan is built from the TaskQueue, and
+holds an estimate of how much input each task will be given and what it
+will cost to run, which are used to choose batch sizes, reduce group sizes
+and priorities. Printing a plan shows these estimates, so that the reason a
+job is slow can be seen before it is run.
+
+Costs are in arbitrary units, where running a function on one input costs
+1 and sending one message to a worker and back costs MESSAGE_COST.
+"""
+import math
+
+from dipla.server.shuffle import Shuffle
+from dipla.server.task_queue import DataSource, MachineType, IteratorStream
+
+MESSAGE_COST = 10
+# Batch sizes are chosen so that each task is sent in about this many
+# messages, so that there are enough messages to share between workers
+TARGET_MESSAGES_PER_TASK = 64
+MAX_BATCH_SIZE = 32
+MAX_REDUCE_GROUP_SIZE = 32
+
+
+class PlanNode:
+
+    def __init__(self, task, dependency_uids):
+        """
+        The plan for one task
+
+        Params:
+         - task: The Task being planned
+         - dependency_uids: The uids of the planned tasks it reads from
+        """
+        self.uid = task.uid
+        self.instructions = task.instructions
+        self.machine_type = task.machine_type
+        self.is_reduce = task.is_reduce
+        self.dependency_uids = dependency_uids
+        self.batch_size = task.batch_size
+        self.reduce_group_size = task.reduce_group_size
+        # The number of values the task will read, the number of messages
+        # it will be sent in, and the number of values it will output.
+        # These are None when they cannot be estimated, e.g. for an
+        # iterator of unknown length
+        self.estimated_inputs = None
+        self.estimated_messages = None
+        self.estimated_outputs = None
+        self.estimated_cost = None
+        # The uid of the task this task will be fused into, if any
+        self.fused_into = None
+        self.priority = 0
+
+    @property
+    def retain_output(self):
+        """
+        True if the task's output will be stored on the server. The output
+        of a task that is fused into the task reading it is never stored
+        """
+        return self.fused_into is None
+
+    def to_dict(self):
+        return {
+            'uid': self.uid,
+            'instructions': self.instructions,
+            'machine_type': self.machine_type.name,
+            'is_reduce': self.is_reduce,
+            'dependencies': list(self.dependency_uids),
+            'estimated_inputs': self.estimated_inputs,
+            'estimated_messages': self.estimated_messages,
+            'estimated_outputs': self.estimated_outputs,
+            'estimated_cost': self.estimated_cost,
+            'batch_size': self.batch_size,
+            'reduce_group_size': self.reduce_group_size,
+            'retain_output': self.retain_output,
+            'fused_into': self.fused_into,
+            'priority': self.priority,
+        }
+
+
+class QueryPlan:
+
+    def __init__(self, target_uids, nodes, held_uids):
+        """
+        Params:
+         - target_uids: The uids of the tasks whose output was requested
+         - nodes: A list of PlanNodes for the target tasks and every task
+        they depend on, with each task after the tasks it reads from
+         - held_uids: The uids of the tasks in the queue that no target
+        depends on, which are not run
+        """
+        self.target_uids = target_uids
+        self.nodes = nodes
+        self.held_uids = held_uids
+
+    def get_node(self, task_uid):
+        for node in self.nodes:
+            if node.uid == task_uid:
+                return node
+        raise KeyError("Task " + task_uid + " is not part of the plan")
+
+    def estimated_cost(self):
+        """
+        Returns the total estimated cost of the plan, or None if the cost
+        of any task cannot be estimated
+        """
+        costs = [node.estimated_cost for node in self.nodes]
+        if None in costs:
+            return None
+        return sum(costs)
+
+    def apply(self, task_queue):
+        """
+        Holds the tasks the target does not depend on, and gives the
+        planned tasks their batch sizes, reduce group sizes and priorities.
+        Tasks that have been fused away since the plan was made are
+        skipped
+        """
+        task_queue.set_held_tasks(self.held_uids)
+        task_uids = set(task_queue.get_task_ids())
+        for node in self.nodes:
+            if node.uid not in task_uids:
+                continue
+            task = task_queue.get_task(node.uid)
+            task.batch_size = node.batch_size
+            task.priority = node.priority
+            if node.is_reduce and \
+                    node.reduce_group_size != task.reduce_group_size:
+                task_queue.set_reduce_group_size(
+                    node.uid, node.reduce_group_size)
+
+    def to_dict(self):
+        return {
+            'targets': list(self.target_uids),
+            'estimated_cost': self.estimated_cost(),
+            'tasks': [node.to_dict() for node in self.nodes],
+            'held': list(self.held_uids),
+        }
+
+    def __str__(self):
+        def show(value):
+            return "?" if value is None else str(value)
+
+        cost = self.estimated_cost()
+        lines = ["Plan for {} {} (estimated cost {})".format(
+            "task" if len(self.target_uids) == 1 else "tasks",
+            ", ".join(self.target_uids), show(cost))]
+        row = "{:<10} {:<24} {:>8} {:>6} {:>9} {:>8} {:>9}  {}"
+        lines.append(row.format("uid", "task", "inputs", "batch",
+                                "messages", "cost", "priority", "output"))
+        for node in self.nodes:
+            name = node.instructions
+            if node.is_reduce:
+                name += " (reduce by {})".format(node.reduce_group_size)
+            elif node.machine_type == MachineType.server:
+                name += " (server)"
+            output = "kept"
+            if not node.retain_output:
+                output = "fused into " + node.fused_into
+            lines.append(row.format(
+                node.uid, name, show(node.estimated_inputs),
+                show(node.batch_size), show(node.estimated_messages),
+                show(node.estimated_cost), node.priority, output))
+        if self.held_uids:
+            lines.append("Not needed, so not run: " +
+                         ", ".join(sorted(self.held_uids)))
+        return "\n".join(lines)
+
+
+def build_plan(task_queue, target_uids, can_fuse=None,
+               choose_batch_sizes=True, choose_group_sizes=(),
+               hold_unneeded=True):
+    """
+    Builds a QueryPlan for the target tasks and every task they depend on.
+    Tasks that more than one target depends on are only planned once
+
+    Params:
+     - task_queue: The TaskQueue holding the tasks
+     - target_uids: The uids of the tasks whose output is wanted
+     - can_fuse: A function taking the uids of a task and the task that
+    reads it, that returns True if the two will be fused into one. None
+    means no tasks are fused. Targets are never fused into the tasks that
+    read them, as their output is needed
+     - choose_batch_sizes: If True, batch sizes are chosen for client
+    tasks whose input size can be estimated
+     - choose_group_sizes: The uids of the reduce tasks whose group sizes
+    should be chosen by the plan, rather than kept as they are
+     - hold_unneeded: If True, the plan holds the tasks in the queue that
+    the target does not depend on
+
+    Returns:
+     - The QueryPlan
+    """
+    nodes = []
+    nodes_by_uid = {}
+
+    def visit(task_uid):
+        if task_uid in nodes_by_uid:
+            return
+        dependency_uids = task_queue.get_dependency_ids(task_uid)
+        for dependency_uid in dependency_uids:
+            visit(dependency_uid)
+        node = PlanNode(task_queue.get_task(task_uid), dependency_uids)
+        nodes_by_uid[task_uid] = node
+        nodes.append(node)
+
+    for target_uid in target_uids:
+        visit(target_uid)
+
+    for node in nodes:
+        if can_fuse is not None and len(node.dependency_uids) == 1 and \
+                node.dependency_uids[0] not in target_uids and \
+                can_fuse(node.dependency_uids[0], node.uid):
+            nodes_by_uid[node.dependency_uids[0]].fused_into = node.uid
+        _estimate_inputs(task_queue, node, nodes_by_uid)
+        if node.is_reduce and node.uid in choose_group_sizes and \
+                node.estimated_inputs is not None:
+            node.reduce_group_size = _choose_reduce_group_size(
+                node.estimated_inputs)
+        if choose_batch_sizes and not node.is_reduce and \
+                node.machine_type == MachineType.client and \
+                node.estimated_inputs is not None:
+            node.batch_size = _choose_batch_size(node.estimated_inputs)
+
+    # Fused tasks are sent as part of the task that reads them
+    for node in nodes:
+        _estimate_cost(node)
+    for node in nodes:
+        if node.fused_into is not None:
+            node.estimated_messages = 0
+            if node.estimated_cost is not None:
+                node.estimated_cost = node.estimated_inputs
+
+    # A task's priority is the cost of the longest chain of work from the
+    # start of the task to a target, so the critical path runs first
+    for node in reversed(nodes):
+        dependees = [other.priority for other in nodes
+                     if node.uid in other.dependency_uids]
+        node.priority = (node.estimated_cost or 0) + max(dependees or [0])
+
+    held_uids = []
+    if hold_unneeded:
+        held_uids = [task_uid for task_uid in task_queue.get_task_ids()
+                     if task_uid not in nodes_by_uid]
+    return QueryPlan(list(target_uids), nodes, held_uids)
+
+
+def _source_size(source, node, nodes_by_uid):
+    if isinstance(source.data_streamer.stream, Shuffle):
+        # Each partition of a shuffle is read as one value
+        return source.data_streamer.stream.num_partitions
+    if source.source_task_uid is not None:
+        return nodes_by_uid[source.source_task_uid].estimated_outputs
+    streamer = source.data_streamer
+    if streamer.read_function is not DataSource.read_one_value and \
+            node.machine_type != MachineType.server:
+        # Values read in other ways, e.g. a broadcast that is read again
+        # for every input, give no count. Server tasks read each value of
+        # their source once with the user's data source function
+        return None
+    if isinstance(streamer.stream, IteratorStream):
+        # Only the values pulled so far are known
+        return None
+    try:
+        return max(len(streamer.stream) - streamer.stream_location, 0)
+    except TypeError:
+        return None
+
+
+def _estimate_inputs(task_queue, node, nodes_by_uid):
+    task = task_queue.get_task(node.uid)
+    sizes = [_source_size(source, node, nodes_by_uid)
+             for source in task.data_instructions]
+    sizes = [size for size in sizes if size is not None]
+    if not sizes:
+        return
+    # A task reads one value from every source for each input, so the
+    # smallest source decides how many inputs it has
+    node.estimated_inputs = min(sizes)
+    if node.is_reduce:
+        node.estimated_outputs = min(node.estimated_inputs, 1)
+    else:
+        node.estimated_outputs = node.estimated_inputs
+
+
+def _estimate_cost(node):
+    inputs = node.estimated_inputs
+    if inputs is None:
+        return
+    if node.machine_type == MachineType.server:
+        node.estimated_messages = 0
+    elif node.is_reduce:
+        # Each run replaces a group of values with one value, so removes
+        # group size - 1 values until one is left
+        node.estimated_messages = math.ceil(
+            max(inputs - 1, 0) / (node.reduce_group_size - 1))
+        # The output of every run but the last is read again
+        inputs += max(node.estimated_messages - 1, 0)
+    else:
+        node.estimated_messages = math.ceil(inputs / (node.batch_size or 1))
+    node.estimated_cost = inputs + MESSAGE_COST * node.estimated_messages
+
+
+def _choose_batch_size(num_inputs):
+    return max(1, min(MAX_BATCH_SIZE,
+                      num_inputs // TARGET_MESSAGES_PER_TASK))
+
+
+def _choose_reduce_group_size(num_inputs):
+    # A group size around the square root of the number of values gives
+    # few runs while still letting the runs happen in parallel
+    return max(2, min(MAX_REDUCE_GROUP_SIZE,
+                      math.ceil(math.sqrt(num_inputs))))
@@ -0,0 +1,74 @@
+"""
+This module chooses the group sizes of reduce tasks while they run, so that
+the reduction tree is as wide and shallow as the workers allow.
+
+Each time a group is sent, its size is chosen so that the values waiting to
+be reduced are split between the idle workers, rather than always using
+the size the task was created with. Groups are kept short enough that one
+worker spends at most max_group_time seconds on each, from the measured
+time per value of the task's earlier groups.
+
+The last few levels of a reduction are trivial work, but each would still
+cost a worker a full round trip. Once no more than server_threshold values
+are left to reduce, the server reduces them itself.
+"""
+import math
+
+from dipla.shared.statistics import moving_average
+
+
+class ReduceSizer:
+
+    def __init__(self, server_threshold=16, max_group_time=5.0,
+                 max_group_size=10000):
+        """
+        Params:
+         - server_threshold: The number of values left to reduce, counting
+        the results of the groups being reduced by workers, below which
+        the server reduces them itself. 0 means the server never does
+         - max_group_time: The most seconds a worker should spend on a
+        group, once the task's time per value has been measured
+         - max_group_size: The most values in a group
+        """
+        if max_group_size < 2:
+            raise ValueError("Groups must be able to hold 2 values")
+        self.server_threshold = server_threshold
+        self.max_group_time = max_group_time
+        self.max_group_size = max_group_size
+        # Dictionary of task uid to the moving average of the seconds a
+        # worker took per value, including the round trip
+        self._value_times = {}
+
+    def record_run(self, task_uid, num_values, duration):
+        """
+        Records that a worker took duration seconds to reduce a group of
+        num_values values
+        """
+        if num_values < 1:
+            return
+        self._value_times[task_uid] = moving_average(
+            self._value_times.get(task_uid), duration / num_values)
+
+    def value_time(self, task_uid):
+        """
+        Returns:
+         - The measured seconds per value of a task, or None if it has not
+           been measured
+        """
+        return self._value_times.get(task_uid)
+
+    def choose_group_size(self, task_uid, num_values, num_idle_workers):
+        """
+        Returns:
+         - The size of the next group of a reduce task with num_values
+           values ready, that splits them between the idle workers
+        """
+        group_size = math.ceil(num_values / max(num_idle_workers, 1))
+        value_time = self._value_times.get(task_uid)
+        if value_time is not None and value_time > 0:
+            group_size = min(group_size,
+                             int(self.max_group_time / value_time))
+        return max(2, min(group_size, self.max_group_size))
+
+    def should_finish_on_server(self, num_remaining):
+        return 0 < num_remaining <= self.server_threshold
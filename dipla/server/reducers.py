@@ -0,0 +1,189 @@
+"""
+This module contains the built-in reducers, such as Dipla.reduce_sum, which
+the server runs itself on the values of a task as they arrive, instead of
+sending them to workers.
+
+Each reducer is a reduce function, which is applied to groups of values
+and to its own earlier results, so the values it reduces are either values
+of the task it reads or partial results. Where the two can look alike, e.g.
+for a mean, partial results are dictionaries with a reserved key, and the
+reducer's finish function turns the last one into the final value.
+
+Numbers and lists of numbers are accumulated with NumPy when it is
+installed, and with plain Python otherwise. Results are plain Python values
+either way, so they can be serialised as JSON.
+
+Approximate summaries, such as the most frequent values, are built and
+merged as sketches, see dipla.shared.sketches.
+"""
+import bisect
+import functools
+import operator
+
+from dipla.shared import sketches
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The most values a built-in reducer reduces in one go
+GROUP_SIZE = 1024
+
+MEAN_KEY = '__dipla_mean__'
+HISTOGRAM_KEY = '__dipla_histogram__'
+SKETCH_KEY = '__dipla_sketch__'
+
+
+def total(values):
+    """
+    Adds up numbers, or lists of numbers of the same shape element by
+    element
+    """
+    return _accumulate(values, 'add', operator.add)
+
+
+def minimum(values):
+    return _accumulate(values, 'minimum', min)
+
+
+def maximum(values):
+    return _accumulate(values, 'maximum', max)
+
+
+def mean(values):
+    """
+    Returns a partial mean of numbers, or lists of numbers of the same
+    shape, and earlier partial means. See finish_mean
+    """
+    sums = []
+    count = 0
+    for value in values:
+        if _is_partial(value, MEAN_KEY):
+            partial_sum, partial_count = value[MEAN_KEY]
+            sums.append(partial_sum)
+            count += partial_count
+        else:
+            sums.append(value)
+            count += 1
+    return {MEAN_KEY: [total(sums), count]}
+
+
+def finish_mean(partial):
+    partial_sum, count = partial[MEAN_KEY]
+    return _map(partial_sum, lambda value: value / count)
+
+
+class Histogram:
+
+    def __init__(self, edges):
+        """
+        A reducer counting how many numbers fall between each pair of
+        edges, as numpy.histogram does. Each value is a number, or a list
+        of numbers that are all counted. Numbers outside the edges are not
+        counted. See finish_histogram
+
+        Raises:
+         - ValueError if there are fewer than 2 edges or they are not in
+        increasing order
+        """
+        edges = list(edges)
+        if len(edges) < 2 or edges != sorted(edges):
+            raise ValueError(
+                "A histogram needs at least 2 edges in increasing order")
+        self.edges = edges
+
+    def __call__(self, values):
+        counts = [0] * (len(self.edges) - 1)
+        numbers = []
+        for value in values:
+            if _is_partial(value, HISTOGRAM_KEY):
+                counts = _combine(counts, value[HISTOGRAM_KEY], operator.add)
+            elif isinstance(value, list):
+                numbers.extend(value)
+            else:
+                numbers.append(value)
+        counts = _combine(counts, self._count(numbers), operator.add)
+        return {HISTOGRAM_KEY: counts}
+
+    def _count(self, numbers):
+        if numpy is not None:
+            return numpy.histogram(numbers, bins=self.edges)[0].tolist()
+        counts = [0] * (len(self.edges) - 1)
+        for number in numbers:
+            if number < self.edges[0] or number > self.edges[-1]:
+                continue
+            # The last bin includes its upper edge
+            index = min(bisect.bisect_right(self.edges, number) - 1,
+                        len(counts) - 1)
+            counts[index] += 1
+        return counts
+
+
+def finish_histogram(partial):
+    return partial[HISTOGRAM_KEY]
+
+
+class SketchReducer:
+
+    def __init__(self, make_sketch):
+        """
+        A reducer adding each value to a sketch made by calling make_sketch,
+        e.g. functools.partial(sketches.TopK, 10). See finish_sketch
+        """
+        self.make_sketch = make_sketch
+
+    def __call__(self, values):
+        sketch = self.make_sketch()
+        for value in values:
+            if _is_partial(value, SKETCH_KEY):
+                sketch.merge(sketches.decode(value[SKETCH_KEY]))
+            else:
+                sketch.add(value)
+        return {SKETCH_KEY: sketch.encode()}
+
+
+def merge_sketches(values):
+    """
+    A reducer merging sketches of the same kind, which are encoded as
+    strings by the workers that built them. See finish_sketch
+    """
+    encoded = [value[SKETCH_KEY] if _is_partial(value, SKETCH_KEY) else value
+               for value in values]
+    return {SKETCH_KEY: sketches.merge_encoded(encoded)}
+
+
+def finish_sketch(partial):
+    return sketches.decode(partial[SKETCH_KEY])
+
+
+def _is_partial(value, key):
+    return isinstance(value, dict) and key in value
+
+
+def _accumulate(values, ufunc_name, combine):
+    if numpy is not None:
+        try:
+            array = numpy.asarray(values)
+        except ValueError:
+            # The values have different shapes
+            array = None
+        if array is not None and array.dtype.kind in 'biuf':
+            return getattr(numpy, ufunc_name).reduce(array, axis=0).tolist()
+    return functools.reduce(
+        lambda first, second: _combine(first, second, combine), values)
+
+
+def _combine(first, second, combine):
+    if isinstance(first, list):
+        if not isinstance(second, list) or len(first) != len(second):
+            raise ValueError("Lists can only be reduced with lists of the "
+                             "same shape")
+        return [_combine(a, b, combine) for a, b in zip(first, second)]
+    return combine(first, second)
+
+
+def _map(value, function):
+    if isinstance(value, list):
+        return [_map(item, function) for item in value]
+    return function(value)
@@ -0,0 +1,209 @@
+"""
+This module stores the results of deterministic distributable functions on
+disk, so that rerunning a program with mostly unchanged inputs only sends
+the inputs that have not been seen before to the workers.
+
+Each result is keyed by a hash of the function's serialised code object and
+its arguments, so changing the function invalidates its old results.
+
+Lookups and stores are not written to disk one at a time, as they happen for
+every input. Stored results are committed by flush, which the server calls
+once per batch of results, and the uses of results that were looked up are
+written with the next flush, or once flush_after of them have built up.
+"""
+import hashlib
+import json
+import sqlite3
+
+from dipla.api_support.function_serialise import serialise_code_object
+
+
+def function_namespace(function):
+    """
+    Returns:
+     - A string identifying the code of the function, which changes
+       whenever the function's code changes
+    """
+    code = serialise_code_object(function.__code__)
+    return hashlib.sha256(code).hexdigest()
+
+
+def make_key(namespace, values):
+    """
+    Creates the key for one input of a task
+
+    namespace is the function_namespace of the task's function
+
+    values is a list with one list per argument, as read from each of the
+    task's data sources
+
+    Returns:
+     - The key as a string, or None if the input cannot be cached. This
+       is the case when a source gave more or less than one value, or a
+       value is not JSON serialisable, refers to part of a file whose
+       contents could change, or refers to an object kept on a worker
+    """
+    if any(len(argument) != 1 for argument in values):
+        return None
+    try:
+        canonical = json.dumps([argument[0] for argument in values],
+                               sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+    if '"__dipla_file_split__"' in canonical or \
+            '"__dipla_object__"' in canonical:
+        return None
+    digest = hashlib.sha256()
+    digest.update(namespace.encode('utf-8'))
+    digest.update(canonical.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, path, max_size=256 * 1024 * 1024, flush_after=1000):
+        """
+        A cache of results stored in an SQLite database. When the results
+        take up more than max_size bytes the least recently used ones are
+        removed
+
+        Params:
+         - path: The file the database is stored in, which is created if
+        it does not exist. ':memory:' keeps the cache in memory
+         - max_size: The maximum total size of the serialised results in
+        bytes
+         - flush_after: The number of lookups and stores after which they
+        are written to disk, if flush has not been called before then
+        """
+        self.max_size = max_size
+        self.flush_after = flush_after
+        self.hits = 0
+        self.misses = 0
+        # Dictionary of the key of each result looked up since the last
+        # flush to the time it was last used, and the number of lookups
+        # and stores since then
+        self._uses = {}
+        self._num_unflushed = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, "
+            "last_used INTEGER)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_by_use "
+            "ON results (last_used)")
+        self._connection.commit()
+        row = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) "
+            "FROM results").fetchone()
+        self._total_size, self._clock = row
+
+    def _tick(self):
+        # A counter is used rather than the time, so that uses within the
+        # resolution of the clock are still ordered
+        self._clock += 1
+        return self._clock
+
+    def get(self, key):
+        """
+        Returns:
+         - The result stored for the key
+
+        Raises:
+         - KeyError if there is no result for the key
+        """
+        row = self._connection.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._uses[key] = self._tick()
+        self._count_unflushed()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Stores a result for the key, then removes the least recently used
+        results until the cache is no larger than max_size. Results that
+        are not JSON serialisable are not stored. The result is only
+        committed to disk by the next flush
+        """
+        try:
+            serialised = json.dumps(value)
+        except (TypeError, ValueError):
+            return
+        size = len(serialised.encode('utf-8'))
+        if size > self.max_size:
+            return
+        old = self._connection.execute(
+            "SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+        if old is not None:
+            self._total_size -= old[0]
+        self._connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, serialised, size, self._tick()))
+        self._uses.pop(key, None)
+        self._total_size += size
+        if self._total_size > self.max_size:
+            self._evict()
+        self._count_unflushed()
+
+    def flush(self):
+        """
+        Writes the uses of the results looked up since the last flush, and
+        commits the results stored since then
+        """
+        self._write_uses()
+        self._connection.commit()
+        self._num_unflushed = 0
+
+    def _count_unflushed(self):
+        self._num_unflushed += 1
+        if self._num_unflushed >= self.flush_after:
+            self.flush()
+
+    def _write_uses(self):
+        if not self._uses:
+            return
+        self._connection.executemany(
+            "UPDATE results SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in self._uses.items()])
+        self._uses = {}
+
+    def _evict(self):
+        # The least recently used results can only be found once the uses
+        # that have not been written yet are
+        self._write_uses()
+        rows = self._connection.execute(
+            "SELECT key, size FROM results ORDER BY last_used")
+        evicted = []
+        for key, size in rows:
+            if self._total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            self._total_size -= size
+        self._connection.executemany(
+            "DELETE FROM results WHERE key = ?", evicted)
+
+    def hit_ratio(self):
+        """
+        Returns:
+         - The fraction of lookups that found a result, or 0 if there have
+           been no lookups
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0
+        return self.hits / lookups
+
+    def close(self):
+        """
+        Flushes the cache and closes its database. Closing a cache that is
+        already closed does nothing
+        """
+        if self._connection is None:
+            return
+        self.flush()
+        self._connection.close()
+        self._connection = None
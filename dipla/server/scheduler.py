@@ -0,0 +1,446 @@
+"""
+This module contains the Scheduler, which decides which task input is sent
+to which worker, and the SchedulingPolicy implementations it can delegate
+those decisions to.
+
+The Scheduler runs as a single coroutine on the server's event loop. Rather
+than being called directly whenever something happens, it is woken up by
+events (a worker joining, a result arriving, new input being pushed) and
+then runs a scheduling pass over the server.
+"""
+import asyncio
+import bisect
+import hashlib
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+from dipla.server.task_queue import MachineType
+from dipla.shared import broadcasts
+
+# The most a batch is multiplied by for a worker with a long round trip time
+MAX_LATENCY_FACTOR = 8
+
+
+class Scheduler:
+
+    def __init__(self, policy=None, timing_history=1000, latency_target=0.05):
+        """
+        policy is the SchedulingPolicy used to choose the task, batch size
+        and worker for each dispatch. If this is not provided a FifoPolicy
+        is used.
+
+        timing_history is the number of recent per-decision timings that
+        are kept in decision_times
+
+        latency_target is the round trip time in seconds above which
+        workers are sent bigger batches than the policy chose, so that
+        they spend less of their time waiting for input. A worker whose
+        round trip time is n times the target gets batches n times bigger,
+        up to MAX_LATENCY_FACTOR times
+        """
+        if policy is None:
+            policy = FifoPolicy()
+        self.policy = policy
+        self.latency_target = latency_target
+        self._wake_event = asyncio.Event()
+
+        # Timings are in seconds and only measure the time spent by the
+        # policy choosing, not the time spent sending messages
+        self.decision_times = deque(maxlen=timing_history)
+        self.num_decisions = 0
+        self.total_decision_time = 0.0
+        self.max_decision_time = 0.0
+        self._retry_handle = None
+
+    def wake(self):
+        """
+        Wake the scheduler so that it runs another scheduling pass. This
+        should be called whenever something happens that could make a new
+        dispatch possible, e.g. a worker becoming available or new task
+        input arriving.
+        """
+        self._wake_event.set()
+
+    async def run(self, server):
+        """
+        Run the scheduler forever, running a scheduling pass on the server
+        every time it is woken up. An error raised by a pass is given to
+        server.fail_scheduling_pass, so that the next pass still runs
+        """
+        while True:
+            await self._wake_event.wait()
+            self._wake_event.clear()
+            try:
+                server.distribute_tasks()
+            except Exception as e:
+                server.fail_scheduling_pass(e)
+
+    def decide(self, task_queue, worker_group):
+        """
+        Ask the policy for the next client dispatch.
+
+        Returns:
+         - A SchedulingDecision, or None if nothing can be dispatched
+        """
+        if not worker_group.has_available_worker():
+            return None
+        if not task_queue.has_next_input(MachineType.client):
+            return None
+
+        started_at = time.perf_counter()
+        decision = self.policy.choose(task_queue, worker_group)
+        self._record_decision_time(time.perf_counter() - started_at)
+        if decision is None:
+            self._wake_later(self.policy.retry_after())
+        else:
+            self._scale_for_latency(decision, worker_group)
+        return decision
+
+    def _scale_for_latency(self, decision, worker_group):
+        rtt = worker_group.get_worker(decision.worker_uid).rtt
+        if rtt is None or rtt <= self.latency_target:
+            return
+        factor = min(MAX_LATENCY_FACTOR, rtt / self.latency_target)
+        decision.batch_size = math.ceil(decision.batch_size * factor)
+
+    def _wake_later(self, delay):
+        # A policy that holds input back for a while, e.g. to wait for a
+        # busy worker, is asked again once the wait is over, even if
+        # nothing else wakes the scheduler
+        if delay is None:
+            return
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            # There is no event loop in this thread
+            return
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+        self._retry_handle = loop.call_later(delay, self.wake)
+
+    def timing_summary(self):
+        """
+        Returns:
+         - A dictionary describing the time spent making scheduling
+           decisions so far
+        """
+        mean = 0.0
+        if self.num_decisions > 0:
+            mean = self.total_decision_time / self.num_decisions
+        return {
+            'num_decisions': self.num_decisions,
+            'total_decision_time': self.total_decision_time,
+            'mean_decision_time': mean,
+            'max_decision_time': self.max_decision_time,
+        }
+
+    def _record_decision_time(self, duration):
+        self.decision_times.append(duration)
+        self.num_decisions += 1
+        self.total_decision_time += duration
+        self.max_decision_time = max(self.max_decision_time, duration)
+
+
+class SchedulingDecision:
+
+    def __init__(self, task_uid, worker_uid, batch_size=1):
+        """
+        The choice made by a SchedulingPolicy for a single dispatch
+
+        task_uid is the uid of the task that input should be popped from
+
+        worker_uid is the uid of the available worker that should be
+        leased to run the input
+
+        batch_size is the maximum number of inputs that should be sent to
+        the worker in one message
+        """
+        self.task_uid = task_uid
+        self.worker_uid = worker_uid
+        self.batch_size = batch_size
+
+
+# This is an interface that all scheduling policies must implement.
+class SchedulingPolicy(ABC):
+
+    def __init__(self, batch_size=1):
+        """
+        batch_size is the maximum number of inputs that are sent to a
+        worker in a single run_instructions message
+        """
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1")
+        self.batch_size = batch_size
+
+    # Choose the task to pop input from and the worker to send it to.
+    #
+    # This is only called when there is at least one available worker
+    # and at least one client task with input. Return None to leave the
+    # workers idle.
+    @abstractmethod
+    def choose(self, task_queue, worker_group):
+        pass
+
+    def retry_after(self):
+        """
+        Returns:
+         - The number of seconds after which the policy should be asked
+           again when it has just returned None, or None if it only needs
+           to be asked when something changes
+        """
+        return None
+
+    def _best_worker(self, worker_group):
+        return min(worker_group.available_workers())
+
+    def _capable_workers(self, task_queue, task_uid, workers):
+        # Only the workers with the resources a task requires can be sent
+        # its input
+        requirements = task_queue.get_task(task_uid).requirements
+        if not requirements:
+            return workers
+        return [worker for worker in workers
+                if worker.satisfies(requirements)]
+
+    def _first_runnable(self, task_queue, task_uids, workers):
+        # Returns the decision to send input from the first task in
+        # task_uids that one of the workers, sorted best first, can run
+        for task_uid in task_uids:
+            capable = self._capable_workers(task_queue, task_uid, workers)
+            if capable:
+                return SchedulingDecision(
+                    task_uid, capable[0].uid,
+                    self._batch_size_for(task_queue, task_uid))
+        return None
+
+    def _batch_size_for(self, task_queue, task_uid):
+        # A batch size chosen for the task itself, e.g. by a QueryPlan,
+        # takes the place of the policy's
+        batch_size = task_queue.get_task(task_uid).batch_size
+        if batch_size is None:
+            return self.batch_size
+        return batch_size
+
+
+class FifoPolicy(SchedulingPolicy):
+    """
+    Sends input from the first ready task, in the order given by the task
+    queue's PriorityMode, to the highest quality available worker. With
+    the default PriorityMode this is the task that was pushed first.
+    """
+
+    def choose(self, task_queue, worker_group):
+        task_uids = task_queue.ready_task_uids(MachineType.client)
+        return self._first_runnable(
+            task_queue, task_uids, sorted(worker_group.available_workers()))
+
+
+class LocalityPolicy(SchedulingPolicy):
+    """
+    Prefers to give workers more input for the task they last ran, so
+    that anything the worker has cached for that task (e.g. the loaded
+    binary) is reused. Falls back to the FIFO choice otherwise.
+    """
+
+    def choose(self, task_queue, worker_group):
+        task_uids = task_queue.ready_task_uids(MachineType.client)
+        if not task_uids:
+            return None
+        workers = sorted(worker_group.available_workers())
+        for worker in workers:
+            for task_uid in task_uids:
+                task = task_queue.get_task(task_uid)
+                if task.instructions == worker.current_task_instr and \
+                        self._capable_workers(task_queue, task_uid, [worker]):
+                    return SchedulingDecision(
+                        task_uid, worker.uid,
+                        self._batch_size_for(task_queue, task_uid))
+        return self._first_runnable(task_queue, task_uids, workers)
+
+
+class FairSharePolicy(SchedulingPolicy):
+    """
+    Shares workers between tasks in proportion to their weights, by
+    sending input from the task that currently has the fewest results
+    outstanding relative to its weight.
+    """
+
+    def __init__(self, batch_size=1, weights=None):
+        """
+        weights is a dictionary of task uid to a positive number. Tasks
+        that are not present have a weight of 1
+        """
+        super().__init__(batch_size)
+        self.weights = weights or {}
+
+    def set_weight(self, task_uid, weight):
+        if weight <= 0:
+            raise ValueError("Fair share weights must be positive")
+        self.weights[task_uid] = weight
+
+    def choose(self, task_queue, worker_group):
+        task_uids = task_queue.ready_task_uids(MachineType.client)
+        if not task_uids:
+            return None
+
+        def share_used(task_uid):
+            in_flight = task_queue.get_task(task_uid).in_flight()
+            return in_flight / self.weights.get(task_uid, 1)
+
+        # sorted() keeps equal values in order, so ties are broken in FIFO
+        # order
+        return self._first_runnable(
+            task_queue, sorted(task_uids, key=share_used),
+            sorted(worker_group.available_workers()))
+
+
+class AffinityPolicy(SchedulingPolicy):
+    """
+    Sends input from the first ready task to the available worker that has
+    the most of what the task needs already, so that less is sent again and
+    more of what workers have cached is reused. A worker scores for
+    holding results of a task this task reads, which are kept on workers
+    (see dipla.shared.objects), for each broadcast value of the task it
+    has been sent, for having run the task's binary before, and for being
+    the task's home worker.
+
+    The home worker is chosen by consistent hashing of the task's key, which
+    is its instructions unless set with set_key, so the same work keeps
+    going to the same workers and only moves when workers join or leave.
+
+    If a worker that scores higher than every available one is busy, the
+    task waits up to locality_wait seconds for it, while input from other
+    tasks is still sent, before falling back to the best available worker.
+    """
+
+    # How much each kind of affinity adds to a worker's score
+    UPSTREAM_SCORE = 4
+    BROADCAST_SCORE = 2
+    BINARY_SCORE = 1
+    HOME_SCORE = 1
+
+    def __init__(self, batch_size=1, locality_wait=1.0, replicas=64):
+        """
+        locality_wait is the number of seconds a task waits for a busy
+        worker with a better score. 0 means input is always sent to the
+        best available worker
+
+        replicas is the number of points each worker has on the consistent
+        hashing ring, where more points spread keys more evenly
+        """
+        super().__init__(batch_size)
+        if locality_wait < 0:
+            raise ValueError("Locality wait must not be negative")
+        self.locality_wait = locality_wait
+        self.replicas = replicas
+        # Dictionary of task uid to the key hashed to choose its home
+        # worker, for tasks whose key is not their instructions
+        self.keys = {}
+        # Dictionary of task uid to the time.monotonic() time it started
+        # waiting for a busy worker
+        self._waiting_since = {}
+        self._ring_uids = frozenset()
+        self._ring = []
+
+    def set_key(self, task_uid, key):
+        """
+        Sets the key that is hashed to choose the task's home worker, e.g.
+        the partition of the data the task reads
+        """
+        self.keys[task_uid] = key
+
+    def choose(self, task_queue, worker_group):
+        task_uids = task_queue.ready_task_uids(MachineType.client)
+        if not task_uids:
+            return None
+        now = time.monotonic()
+        for task_uid in list(self._waiting_since):
+            if task_uid not in task_uids:
+                del self._waiting_since[task_uid]
+        workers = worker_group.get_all_workers()
+        available = sorted(worker_group.available_workers())
+        for task_uid in task_uids:
+            capable = self._capable_workers(task_queue, task_uid, available)
+            if not capable:
+                continue
+            scores = self._scores(task_queue, task_uid, self._capable_workers(
+                task_queue, task_uid, workers))
+            # sorted() puts the best quality workers first, and max() keeps
+            # the first of any equal scores
+            worker = max(capable, key=lambda worker: scores[worker.uid])
+            if scores[worker.uid] >= max(scores.values()):
+                self._waiting_since.pop(task_uid, None)
+            elif now - self._waiting_since.setdefault(task_uid, now) < \
+                    self.locality_wait:
+                continue
+            # Once a task has waited, it keeps using any worker until it
+            # can be sent to its best worker again
+            return SchedulingDecision(
+                task_uid, worker.uid,
+                self._batch_size_for(task_queue, task_uid))
+        return None
+
+    def retry_after(self):
+        now = time.monotonic()
+        remaining = [self.locality_wait - (now - since)
+                     for since in self._waiting_since.values()
+                     if now - since < self.locality_wait]
+        if not remaining:
+            return None
+        return min(remaining)
+
+    def home_worker_uid(self, key, worker_uids):
+        """
+        Returns:
+         - The uid of the worker that key hashes to on the consistent
+           hashing ring of the given workers
+        """
+        if frozenset(worker_uids) != self._ring_uids:
+            self._ring_uids = frozenset(worker_uids)
+            self._ring = sorted(
+                (_hash("{}#{}".format(uid, replica)), uid)
+                for uid in worker_uids for replica in range(self.replicas))
+        index = bisect.bisect(self._ring, (_hash(key),))
+        return self._ring[index % len(self._ring)][1]
+
+    def _scores(self, task_queue, task_uid, workers):
+        task = task_queue.get_task(task_uid)
+        dependency_uids = set(task_queue.get_dependency_ids(task_uid))
+        broadcast_keys = _broadcast_keys(task)
+        home_uid = self.home_worker_uid(
+            str(self.keys.get(task_uid, task.instructions)),
+            [worker.uid for worker in workers])
+        scores = {}
+        for worker in workers:
+            score = 0
+            if dependency_uids & worker.kept_task_uids:
+                score += self.UPSTREAM_SCORE
+            score += self.BROADCAST_SCORE * len(
+                broadcast_keys & worker.broadcast_keys)
+            if task.instructions in worker.instructions_run:
+                score += self.BINARY_SCORE
+            if worker.uid == home_uid:
+                score += self.HOME_SCORE
+            scores[worker.uid] = score
+        return scores
+
+
+def _hash(key):
+    # Python's hash() of a string changes between runs, so a stable hash is
+    # used to keep keys on the same workers across programs
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _broadcast_keys(task):
+    # A broadcast argument is read from a source that gives the same
+    # reference to the broadcast value for every input
+    keys = set()
+    for source in task.data_instructions:
+        stream = source.data_streamer.stream
+        if isinstance(stream, list) and len(stream) == 1:
+            key = broadcasts.get_reference_key(stream[0])
+            if key is not None:
+                keys.add(key)
+    return keys
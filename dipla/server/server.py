@@ -4,16 +4,27 @@ import json
 import asyncio
 import websockets
 import random
+import time
 
+from collections import deque
 from datetime import datetime
 from dipla.server.task_queue import MachineType
+from dipla.server.scheduler import Scheduler
 from dipla.server.worker_group import WorkerGroup, Worker
 from dipla.server.server_services import ServerServices, ServiceParams
+from dipla.server.object_fetcher import ObjectFetcher
 from dipla.shared.services import ServiceError
 from dipla.shared.message_generator import generate_message
+from dipla.shared import broadcasts, objects
 from dipla.shared.error_codes import ErrorCodes
 from base64 import b64encode
 
+# The number of inputs of a server task given to the server pool at once
+SERVER_POOL_BATCH_SIZE = 32
+# Inputs whose JSON is at least this many bytes are sent to the available
+# worker with the most bandwidth
+LARGE_PAYLOAD_SIZE = 1024 * 1024
+
 
 class BinaryManager:
 
@@ -39,6 +50,21 @@ class BinaryManager:
         self._check_task_list(task_list)
         self.platform_re_list.append((re.compile(platform_re), task_list))
 
+    def remove_binaries(self, task_names):
+        """
+        Removes the binaries of the tasks with the given names, for every
+        platform
+        """
+        task_names = set(task_names)
+        kept = []
+        for platform_re, task_list in self.platform_re_list:
+            remaining = [task_tuple for task_tuple in task_list
+                         if task_tuple[0] not in task_names]
+            # A platform left with no binaries by the removal is dropped
+            if remaining or not task_list:
+                kept.append((platform_re, remaining))
+        self.platform_re_list = kept
+
     def _check_task_list(self, task_list):
         for task_tuple in task_list:
             if not isinstance(task_tuple, tuple):
@@ -59,11 +85,13 @@ class BinaryManager:
         generic binaries to be mixed with platform specific ones.
         """
         full_task_list = []
+        matched = False
         for platform_re, task_list in self.platform_re_list:
             if platform_re.match(platform):
                 full_task_list.extend(task_list)
+                matched = True
 
-        if full_task_list:
+        if matched:
             return full_task_list
         raise KeyError('No matching binaries found for this platform')
 
@@ -76,7 +104,12 @@ class Server:
                  result_verifier,
                  worker_group=None,
                  stats=None,
-                 should_distribute_tasks=False):
+                 should_distribute_tasks=False,
+                 scheduler=None,
+                 local_executor=None,
+                 server_pool=None,
+                 heartbeat_monitor=None,
+                 reduce_sizer=None):
         """
         task_queue is a TaskQueue object that tasks to be run are taken from
 
@@ -93,6 +126,29 @@ class Server:
         used to update information on the current runtime status of the
         project.
 
+        scheduler is the Scheduler used to decide which task inputs are
+        sent to which workers. If this is not provided a Scheduler using
+        the default FIFO policy is used.
+
+        local_executor is a LocalExecutor used to run the inputs of cheap
+        client tasks on the server, when that is measured to be quicker
+        than sending them to workers. If this is not provided every client
+        task input is sent to a worker.
+
+        server_pool is a ServerTaskPool that the functions of server tasks
+        are run on, so that they do not hold up the event loop. If this is
+        not provided they are run on the event loop.
+
+        heartbeat_monitor is a HeartbeatMonitor used to send heartbeats to
+        workers, measuring their round trip times and bandwidths and
+        removing workers that go silent. If this is not provided workers
+        are only removed when their connection closes.
+
+        reduce_sizer is a ReduceSizer that chooses the group sizes of
+        reduce tasks while they run, and when the server reduces their
+        last values itself. If this is not provided reduce tasks keep
+        their group sizes and every group is sent to a worker.
+
         This constructor creates variables used in verifying inputs,
         where whether or not verification is performed is decided
         probabilistically using the verify_probability ratio
@@ -117,10 +173,60 @@ class Server:
         self.verify_inputs = {}
 
         self.should_distribute_tasks = should_distribute_tasks
+        self.password = None
+
+        # A dictionary of broadcast key to the serialised broadcast value
+        self.broadcasts = {}
+
+        self.scheduler = scheduler
+        if not self.scheduler:
+            self.scheduler = Scheduler()
+
+        self.local_executor = local_executor
+        # TaskInputs that failed to run locally, or whose worker went
+        # before returning their results, which are sent to the next
+        # available workers that can run them
+        self._requeued_inputs = deque()
+        self.heartbeat_monitor = heartbeat_monitor
+        self.reduce_sizer = reduce_sizer
+
+        self.server_pool = server_pool
+        # Dictionary of task uid to the numbers of its batches running on
+        # the server pool, in the order their values were read, and of
+        # batch number to the results of those that have finished, so that
+        # results are added in the order their values were read even when
+        # the batches finish in another order
+        self._pool_batches = {}
+        self._pool_results = {}
+        self._num_pool_batches = 0
+
+        # Dictionary of uid to Worker for every connected worker, including
+        # those that are not in the worker group while they are sent new
+        # binaries
+        self._connected_workers = {}
+        # Fetches the values of objects kept on workers, for task inputs
+        # that are run somewhere else
+        self.object_fetcher = ObjectFetcher(self._request_objects)
+
+        # Uids of tasks that have been terminated, but not yet cancelled
+        # in the task queue
+        self._pending_cancellations = set()
+        # The uid of the task the current scheduling pass is popping or
+        # running input of, which is failed if the pass raises an error
+        self._scheduling_task_uid = None
+
+        # A list of (condition, future) tuples. Each future is resolved
+        # at the end of the first scheduling pass where its condition
+        # function returns True
+        self._waiters = []
+        self._websocket_server = None
+        self._scheduler_future = None
+        self._heartbeat_future = None
 
     async def websocket_handler(self, websocket, path):
         user_id = self.worker_group.generate_uid()
         worker = Worker(user_id, websocket)
+        self._connected_workers[user_id] = worker
         try:
             # recv() raises a ConnectionClosed exception when the client
             # disconnects, which breaks out of the while True loop.
@@ -130,6 +236,7 @@ class Server:
                     # back the response.
                     message = self._decode_message(
                         await worker.websocket.recv())
+                    worker.last_seen = time.monotonic()
                     service = self.services.get_service(message['label'])
                     response_data = service(
                         message['data'], params=ServiceParams(self, worker))
@@ -152,90 +259,482 @@ class Server:
         except websockets.exceptions.ConnectionClosed as e:
             print(worker.uid + " has closed the connection")
         finally:
-            if worker.uid in self.worker_group.worker_uids():
-                self.worker_group.remove_worker(worker.uid)
+            self._remove_worker(worker)
 
-    def _get_distributable_task_input(self):
-        """
-        Used to get the next task input for either distributing to
-        clients or running on the server. This will consider whether
-        there are any available workers, and if not will only get server
-        side tasks. This is an implementation detail of at least the
-        distribute_tasks method.
-        """
-        if not self.worker_group.has_available_worker():
-            if self.task_queue.has_next_input(MachineType.server):
-                return self.task_queue.pop_task_input(MachineType.server)
-            return None
-        return self.task_queue.pop_task_input()
-
-    def _add_verify_input_data(self, inputs, task_instr, worker_id, task_id):
+    def _remove_worker(self, worker):
+        if worker.disconnected:
+            return
+        worker.disconnected = True
+        self._connected_workers.pop(worker.uid, None)
+        if worker.uid in self.worker_group.worker_uids():
+            self.worker_group.remove_worker(worker.uid)
+        # The objects the worker kept are gone with it, and the input it
+        # was running is given to another worker
+        self.object_fetcher.remove_holder(worker.uid)
+        if worker.in_flight_input is not None:
+            self._requeued_inputs.append(worker.in_flight_input)
+            worker.in_flight_input = None
+        self.scheduler.wake()
+
+    def _add_verify_input_data(self, inputs, task_instr, worker_id, task_id,
+                               requirements=None):
         self.verify_inputs[worker_id + "-" + task_id] = {
             "task_instructions": task_instr,
             "inputs": inputs,
-            "original_worker_uid": worker_id
+            "original_worker_uid": worker_id,
+            "requirements": requirements,
         }
 
     def distribute_tasks(self):
+        """
+        Run a single scheduling pass. Server task inputs are run straight
+        away, and client task inputs are sent to workers for as long as
+        the scheduler can find a task input and a worker to send it to.
+
+        This is normally run by the scheduler coroutine when it is woken
+        up, rather than being called directly.
+        """
         if not self.should_distribute_tasks:
             return
 
-        # By leasing workers without specifying an id, we get the
-        # highest quality worker for the task
-        while self.task_queue.has_next_input():
-            # If workers are connected pop any kind of task input. If no
-            # workers are connected we must only get server task input
+        self._cancel_terminated_tasks()
+        self._finish_reduces_on_server()
+        while True:
+            self._scheduling_task_uid = None
+            # Server tasks never need a worker, so run them first
+            server_task_uid = self._next_server_task_uid()
+            if server_task_uid is not None:
+                self._scheduling_task_uid = server_task_uid
+                self._run_server_task_input(server_task_uid)
+            elif self._send_requeued_input():
+                pass
+            elif self._run_next_local_input():
+                pass
+            else:
+                decision = self.scheduler.decide(
+                    self.task_queue, self.worker_group)
+                if decision is None:
+                    break
+                self._scheduling_task_uid = decision.task_uid
+                self._size_reduce_group(decision.task_uid)
+                task_input = self.task_queue.pop_task_input(
+                    task_uid=decision.task_uid,
+                    batch_size=decision.batch_size)
+                self._update_cache_statistics(task_input)
+                if not task_input.is_empty():
+                    worker = self.worker_group.lease_worker(
+                        self._choose_worker_uid(
+                            task_input, decision.worker_uid))
+                    self._send_task_input(task_input, worker)
 
-            task_input = self._get_distributable_task_input()
-            if task_input is None:  # Happens when no input can be used
+            if self.task_queue.is_inactive():
                 break
 
-            if task_input.machine_type == MachineType.client:
-                task_instructions = task_input.task_instructions
-                # Create the message and send it
-                data = {}
-                data['task_instructions'] = task_instructions
-                data['task_uid'] = task_input.task_uid
-                data['arguments'] = task_input.values
-                data['signals'] = [x for x in task_input.signals]
-                # TODO(Update the documentation with this)
-                worker = self.worker_group.lease_worker()
-                worker.current_task_instr = task_instructions
-                self.send(worker.websocket, 'run_instructions', data)
-
-                if self.result_verifier.has_verifier(task_instructions):
-                    # Store the inputs to be verified with the results later
-                    worker.last_inputs = task_input.values
-
-                if(random.random() < self.verify_probability):
-                    # This stores the input values in the worker and also in
-                    # the server's verify_inputs dict. HOWEVER, only one copy
-                    # of the data is actually stored in memory because
-                    # verify_inputs only has a reference to worker.last_inputs.
-                    #
-                    # This can be seen with:
-                    # assert(worker.last_inputs is inner_dict_thing['inputs'])
-                    worker.last_inputs = task_input.values
-                    self._add_verify_input_data(
-                        worker.last_inputs,
-                        worker.current_task_instr,
-                        worker.uid,
-                        task_input.task_uid)
-            elif task_input.machine_type == MachineType.server:
-                # Server side tasks do not have any maching binaries, so
-                # we skip the send-to-client stage and move the read
-                # data straight to the results. All server side tasks
-                # have one argument, so extract the values for that lone
-                # argument
-                task_values = task_input.values[0]
-                for result in task_values:
-                    self.task_queue.add_result(task_input.task_uid, result)
+        self._scheduling_task_uid = None
+        self._check_waiters()
 
-            if self.task_queue.is_inactive():
-                # Kill the server
-                # TODO(cianlr): This kills things unceremoniously, there may be
-                # a better way.
-                asyncio.get_event_loop().stop()
+    def fail_scheduling_pass(self, error):
+        """
+        Called by the scheduler when a scheduling pass raises an error. The
+        task whose input was being popped or run is cancelled, as it would
+        most likely raise the same error on every pass, and the other tasks
+        carry on being scheduled
+        """
+        task_uid = self._scheduling_task_uid
+        self._scheduling_task_uid = None
+        if task_uid is None:
+            print("Scheduling pass had an error: {!r}".format(error))
+        else:
+            print("Task {} had an error while being scheduled: {!r}".format(
+                task_uid, error))
+            self.task_queue.cancel_task(task_uid)
+            self.scheduler.wake()
+        self._check_waiters()
+
+    def _finish_reduces_on_server(self):
+        # A reduce task with few values left is turned into a server task,
+        # which reduces them with the task's function instead of sending
+        # each of the last levels to a worker
+        if self.reduce_sizer is None:
+            return
+        for task_uid in self.task_queue.ready_task_uids(MachineType.client):
+            task = self.task_queue.get_task(task_uid)
+            if not task.is_reduce or task.reduce_function is None or \
+                    task.requirements or \
+                    self.result_verifier.has_verifier(task.instructions):
+                continue
+            remaining = self.task_queue.remaining_reduce_values(task_uid)
+            if remaining is None or \
+                    not self.reduce_sizer.should_finish_on_server(remaining):
+                continue
+            if task.adaptive_group_size:
+                self.task_queue.set_reduce_group_size(
+                    task_uid, max(2, remaining))
+            task.machine_type = MachineType.server
+            task.server_function = task.reduce_function
+
+    def _size_reduce_group(self, task_uid):
+        task = self.task_queue.get_task(task_uid)
+        if self.reduce_sizer is None or not task.is_reduce or \
+                not task.adaptive_group_size:
+            return
+        num_idle_workers = len(self._capable_workers(
+            task, self.worker_group.available_workers()))
+        self.task_queue.set_reduce_group_size(
+            task_uid, self.reduce_sizer.choose_group_size(
+                task_uid, self.task_queue.num_reduce_values(task_uid),
+                num_idle_workers))
+
+    def _send_requeued_input(self):
+        """
+        Sends the first requeued TaskInput to the best available worker
+        that can run it
+
+        Returns:
+         - True if an input was taken from the requeued inputs
+        """
+        if not self._requeued_inputs:
+            return False
+        task_input = self._requeued_inputs[0]
+        task = self.task_queue.get_task(task_input.task_uid)
+        if task.cancelled:
+            self._requeued_inputs.popleft()
+            return True
+        capable = self._capable_workers(
+            task, self.worker_group.available_workers())
+        if not capable:
+            return False
+        self._scheduling_task_uid = task_input.task_uid
+        self._requeued_inputs.popleft()
+        self._send_task_input(
+            task_input, self.worker_group.lease_worker(min(capable).uid))
+        return True
+
+    def _capable_workers(self, task, workers):
+        if not task.requirements:
+            return workers
+        return [worker for worker in workers
+                if worker.satisfies(task.requirements)]
+
+    def _choose_worker_uid(self, task_input, worker_uid):
+        # The worker chosen by the scheduler is swapped for one holding
+        # the objects the input refers to, or for the one with the most
+        # bandwidth if the input is large
+        holder_uid = self._holding_worker_uid(task_input, worker_uid)
+        if holder_uid != worker_uid:
+            return holder_uid
+        return self._fastest_worker_uid(task_input, worker_uid)
+
+    def _fastest_worker_uid(self, task_input, worker_uid):
+        measured = [worker for worker in self._capable_workers(
+                        self.task_queue.get_task(task_input.task_uid),
+                        self.worker_group.available_workers())
+                    if worker.bandwidth is not None]
+        if not measured or \
+                len(json.dumps(task_input.values)) < LARGE_PAYLOAD_SIZE:
+            return worker_uid
+        return max(measured, key=lambda worker: worker.bandwidth).uid
+
+    def _holding_worker_uid(self, task_input, worker_uid):
+        # Input that refers to objects kept on workers is sent to the
+        # available worker holding the most of them by size, so that
+        # less has to be fetched. Otherwise it goes to the given worker
+        references = objects.find_references(task_input.values)
+        if not references:
+            return worker_uid
+        sizes = {worker_uid: 0}
+        for reference in references:
+            holder = reference.get('worker')
+            sizes[holder] = sizes.get(holder, 0) + reference['size']
+        available = [worker.uid for worker in self._capable_workers(
+                         self.task_queue.get_task(task_input.task_uid),
+                         self.worker_group.available_workers())
+                     if worker.uid in sizes]
+        return max(available, key=lambda uid: (sizes[uid], uid == worker_uid),
+                   default=worker_uid)
+
+    def _send_task_input(self, task_input, worker):
+        # The objects the input refers to that the worker does not hold
+        # are fetched from the workers holding them first
+        self.object_fetcher.fetch(
+            task_input.values, worker.uid,
+            lambda values: self._send_resolved_input(
+                task_input, values, worker),
+            lambda object_ids: self._fail_fetch(
+                task_input.task_uid, object_ids, worker))
+
+    def _send_resolved_input(self, task_input, values, worker):
+        if worker.disconnected:
+            # The worker went while the objects were being fetched
+            self._requeued_inputs.append(task_input)
+            self.scheduler.wake()
+            return
+        task_instructions = task_input.task_instructions
+        # Create the message and send it
+        data = {}
+        data['task_instructions'] = task_instructions
+        data['task_uid'] = task_input.task_uid
+        data['arguments'] = values
+        data['signals'] = [x for x in task_input.signals]
+        if task_input.keep_results:
+            data['keep_results'] = True
+        if task_input.combiner is not None:
+            data['combiner'] = task_input.combiner
+        self.attach_broadcasts(data, worker)
+        # TODO(Update the documentation with this)
+        worker.current_task_instr = task_instructions
+        worker.instructions_run.add(task_instructions)
+        worker.last_cache_keys = task_input.cache_keys
+        worker.sent_at = time.perf_counter()
+        worker.in_flight_input = task_input
+        if self.local_executor is not None and \
+                self.local_executor.can_run(task_instructions):
+            self.local_executor.record_sent(
+                task_input.task_uid,
+                len(task_input.values[0]) if task_input.values else 0,
+                len(json.dumps(values)))
+        self.send(worker.websocket, 'run_instructions', data)
+
+        if self.result_verifier.has_verifier(task_instructions):
+            # Store the inputs to be verified with the results later
+            worker.last_inputs = values
+
+        # References to objects kept on workers can only be used by the
+        # worker holding them, and results kept on a worker or combined
+        # cannot be compared with another's, so such inputs are not
+        # verified
+        if task_input.keep_results or task_input.combiner is not None or \
+                objects.find_references(values):
+            return
+        if(random.random() < self.verify_probability):
+            # This stores the input values in the worker and also in
+            # the server's verify_inputs dict. HOWEVER, only one copy
+            # of the data is actually stored in memory because
+            # verify_inputs only has a reference to worker.last_inputs.
+            #
+            # This can be seen with:
+            # assert(worker.last_inputs is inner_dict_thing['inputs'])
+            worker.last_inputs = values
+            self._add_verify_input_data(
+                worker.last_inputs,
+                worker.current_task_instr,
+                worker.uid,
+                task_input.task_uid,
+                self.task_queue.get_task(task_input.task_uid).requirements)
+
+    def _next_server_task_uid(self):
+        # Tasks whose function runs on the server pool wait while the
+        # pool is busy, rather than reading input that cannot be used yet
+        for task_uid in self.task_queue.ready_task_uids(MachineType.server):
+            task = self.task_queue.get_task(task_uid)
+            if task.is_reduce and task.in_flight() > 0:
+                # A reduce finished on the server waits for the groups
+                # still on workers, rather than reducing what it has in
+                # several goes
+                continue
+            if task.is_reduce and \
+                    self.task_queue.num_reduce_values(task_uid) < 2 and \
+                    self.task_queue.remaining_reduce_values(task_uid) is None:
+                # A lone value would only be reduced on its own again, so
+                # it waits for more values unless it is the last
+                continue
+            if task.server_function is None or self.server_pool is None or \
+                    self.server_pool.has_capacity():
+                return task_uid
+        return None
+
+    def _run_server_task_input(self, task_uid):
+        # Server side tasks do not have any maching binaries, so
+        # we skip the send-to-client stage and move the read
+        # data straight to the results, after applying the task's
+        # function if it has one. All server side tasks have one
+        # argument, so extract the values for that lone argument.
+        # The values of objects kept on workers are fetched first
+        function = self.task_queue.get_task(task_uid).server_function
+        batch_size = 1
+        if function is not None and self.server_pool is not None:
+            batch_size = SERVER_POOL_BATCH_SIZE
+        task_input = self.task_queue.pop_task_input(
+            task_uid=task_uid, batch_size=batch_size)
+        self.object_fetcher.fetch(
+            task_input.values, None,
+            lambda values: self._apply_server_function(
+                task_uid, function, values[0]),
+            lambda object_ids: self._fail_fetch(task_uid, object_ids))
+
+    def _apply_server_function(self, task_uid, function, task_values):
+        if function is not None and self.server_pool is not None:
+            batch = self._num_pool_batches
+            self._num_pool_batches += 1
+            self._pool_batches.setdefault(task_uid, deque()).append(batch)
+            self.server_pool.run(
+                function, task_values,
+                lambda results: self._finish_pool_batch(
+                    task_uid, batch, results),
+                lambda error: self._fail_pool_batch(task_uid, batch, error))
+            return
+        if function is not None:
+            try:
+                task_values = [function(value) for value in task_values]
+            except Exception as e:
+                self._fail_server_task(task_uid, e)
+                return
+        self._add_server_results(task_uid, task_values)
+
+    def _finish_pool_batch(self, task_uid, batch, results):
+        self._pool_results[batch] = results
+        batches = self._pool_batches[task_uid]
+        while batches and batches[0] in self._pool_results:
+            self._add_server_results(
+                task_uid, self._pool_results.pop(batches.popleft()))
+        if not batches:
+            del self._pool_batches[task_uid]
+
+    def _fail_pool_batch(self, task_uid, batch, error):
+        # The batches after the one that failed are not held back by it
+        self._fail_server_task(task_uid, error)
+        self._finish_pool_batch(task_uid, batch, [])
+
+    def _add_server_results(self, task_uid, results):
+        for result in results:
+            self.task_queue.add_result(task_uid, result)
+        self.scheduler.wake()
+
+    def _fail_server_task(self, task_uid, error):
+        # The inputs that failed will never have results, so the task is
+        # cancelled to let the tasks reading it finish
+        print("Server task {} had an error: {!r}".format(task_uid, error))
+        self.task_queue.cancel_task(task_uid)
+        self.scheduler.wake()
+
+    def _fail_fetch(self, task_uid, object_ids, worker=None):
+        # Objects are not kept anywhere else, so once the worker holding
+        # them has gone the task reading them cannot finish
+        print("Task {} reads objects {} from a worker that has gone".format(
+            task_uid, ", ".join(object_ids)))
+        if worker is not None:
+            self.worker_group.return_worker(worker.uid)
+        self.task_queue.cancel_task(task_uid)
+        self.scheduler.wake()
+
+    def _request_objects(self, worker_uid, object_ids):
+        if worker_uid not in self._connected_workers:
+            return False
+        self.send(self._connected_workers[worker_uid].websocket,
+                  'fetch_objects', {'object_ids': object_ids})
+        return True
+
+    def add_fetched_objects(self, serialised_objects, missing):
+        """
+        Adds the objects a worker sent back after being asked for them
+        with a fetch_objects message
+        """
+        self.object_fetcher.add_objects(serialised_objects, missing)
+        self.scheduler.wake()
+
+    def _run_next_local_input(self):
+        """
+        Runs the next input of a client task on the local executor, if
+        there is a task that is measured to be quicker to run locally
+
+        Returns:
+         - True if input was popped from the task queue
+        """
+        if self.local_executor is None or \
+                not self.local_executor.has_capacity():
+            return False
+        for task_uid in self.task_queue.ready_task_uids(MachineType.client):
+            task = self.task_queue.get_task(task_uid)
+            # Tasks that require resources are left to workers that have
+            # them
+            if task.requirements or \
+                    not self.local_executor.can_run(task.instructions) or \
+                    not self.local_executor.should_run_locally(task_uid):
+                continue
+            self._scheduling_task_uid = task_uid
+            task_input = self.task_queue.pop_task_input(
+                task_uid=task_uid,
+                batch_size=task.batch_size or self.scheduler.policy.batch_size)
+            self._update_cache_statistics(task_input)
+            if not task_input.is_empty():
+                self.object_fetcher.fetch(
+                    task_input.values, None,
+                    lambda values, task_input=task_input:
+                        self._run_local_input(task_input, values),
+                    lambda object_ids, task_uid=task_uid:
+                        self._fail_fetch(task_uid, object_ids))
+            return True
+        return False
+
+    def _run_local_input(self, task_input, values):
+        task_input.values = values
+        self.local_executor.run(
+            task_input, self.broadcasts,
+            lambda results, signals: self._add_local_results(
+                task_input, results, signals))
+
+    def _add_local_results(self, task_input, results, signals):
+        if results is None:
+            self._requeued_inputs.append(task_input)
+        else:
+            self.handle_signals(task_input.task_uid, signals)
+            for result in results:
+                self.task_queue.add_result(task_input.task_uid, result)
+            if task_input.cache_keys is not None:
+                self.cache_results(
+                    task_input.task_uid, task_input.cache_keys, results)
+        self.scheduler.wake()
+
+    def record_client_run(self, worker, task_uid, num_results):
+        """
+        Records how long a worker took to return the results of the input
+        it was last sent, so that the local executor can compare it with
+        running the task locally, and the reduce sizer knows how long a
+        reduce task takes per value
+        """
+        if worker.sent_at is None:
+            return
+        duration = time.perf_counter() - worker.sent_at
+        worker.sent_at = None
+        if self.local_executor is not None:
+            self.local_executor.record_remote_run(
+                task_uid, num_results, duration)
+        task_input = worker.in_flight_input
+        if self.reduce_sizer is not None and task_input is not None and \
+                task_input.task_uid == task_uid and \
+                self.task_queue.get_task(task_uid).is_reduce:
+            # A reduce input is a single group of values
+            self.reduce_sizer.record_run(
+                task_uid, len(task_input.values[0][0]), duration)
+
+    async def _send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_monitor.interval)
+            self.check_heartbeats()
+
+    def check_heartbeats(self, now=None):
+        """
+        Removes the workers that have been silent for longer than the
+        heartbeat timeout, and sends a heartbeat to every other worker
+        """
+        if now is None:
+            now = time.monotonic()
+        for worker in list(self._connected_workers.values()):
+            if self.heartbeat_monitor.is_silent(worker, now):
+                print(worker.uid + " has stopped responding")
+                self._remove_worker(worker)
+                asyncio.ensure_future(worker.websocket.close())
+            else:
+                self.send(worker.websocket, 'heartbeat',
+                          self.heartbeat_monitor.make_heartbeat(worker, now))
+
+    def record_heartbeat(self, worker, data):
+        """
+        Records a worker's echo of a heartbeat
+        """
+        if self.heartbeat_monitor is not None:
+            self.heartbeat_monitor.record_reply(
+                worker, data, time.monotonic())
 
     def _decode_message(self, message):
         message_dict = json.loads(message)
@@ -248,26 +747,197 @@ class Server:
         message = generate_message(label, data)
         await socket.send(json.dumps(message))
 
+    def handle_signals(self, task_uid, signals):
+        """
+        Calls the task's handler of each signal that was sent while running
+        its input, with each of the signal's values
+
+        Params:
+         - task_uid: The uid of the task whose input was run
+         - signals: Dictionary of signal to the list of its values
+        """
+        task_signals = self.task_queue.get_task(task_uid).signals
+        for signal in signals:
+            if signal not in task_signals:
+                continue
+            for values in signals[signal]:
+                task_signals[signal](self, task_uid, values)
+
     def terminate_task(self, task_uid):
-        # Notify all the workers that a task's been terminated
+        # Notify all the workers that a task's been terminated, so that
+        # any inputs they are running for it are abandoned
         for worker in self.worker_group.get_all_workers():
             self.send(
                 worker.websocket,
                 'terminate_task',
                 {'task_uid': task_uid})
+        # This is usually called from a signal handler while the results
+        # of the same message are still to be added, so the task is only
+        # cancelled in the queue on the next scheduling pass
+        self._pending_cancellations.add(task_uid)
+        self.scheduler.wake()
+
+    def _cancel_terminated_tasks(self):
+        while self._pending_cancellations:
+            task_uid = self._pending_cancellations.pop()
+            self.task_queue.cancel_task(task_uid)
+
+    def _update_cache_statistics(self, task_input):
+        if task_input.cache_keys is None or \
+                self.__statistics_updater is None:
+            return
+        cache = self.task_queue.get_task(task_input.task_uid).result_cache
+        self.__statistics_updater.overwrite("num_cache_hits", cache.hits)
+        self.__statistics_updater.overwrite("num_cache_misses", cache.misses)
+        self.__statistics_updater.overwrite(
+            "cache_hit_ratio", cache.hit_ratio())
+
+    def cache_results(self, task_uid, cache_keys, results):
+        """
+        Stores the results a client returned in the result cache of their
+        task. cache_keys is the list of keys of the inputs the results
+        were computed from, in the same order as the results
+        """
+        cache = self.task_queue.get_task(task_uid).result_cache
+        for key, result in zip(cache_keys, results):
+            # A reference to an object kept on a worker is not stored, as
+            # the object is gone once the worker is
+            if key is not None and objects.get_object_id(result) is None:
+                cache.put(key, result)
+        # The whole batch is committed at once
+        cache.flush()
+
+    def add_broadcast(self, key, serialised_value):
+        """
+        Makes a broadcast value available to be sent to workers whose
+        input refers to it. See dipla.shared.broadcasts
+        """
+        self.broadcasts[key] = serialised_value
+
+    def attach_broadcasts(self, data, worker):
+        """
+        Adds the broadcast values that are referred to in data['arguments']
+        and that the worker has not been sent yet to data['broadcasts'],
+        so that each worker is sent each value at most once
+        """
+        new_broadcasts = {}
+        for argument_values in data['arguments']:
+            for value in argument_values:
+                key = broadcasts.get_reference_key(value)
+                if key is None or key in worker.broadcast_keys:
+                    continue
+                new_broadcasts[key] = self.broadcasts[key]
+                worker.broadcast_keys.add(key)
+        if new_broadcasts:
+            data['broadcasts'] = new_broadcasts
+
+    def add_binaries(self, platform_re, task_list):
+        """
+        Adds encoded binaries that can be requested by workers, and sends
+        them to the workers that are already connected. Workers are not
+        given any more task input until they confirm they have received
+        them, and busy workers are updated once they return a result.
+        Workers keep the binaries they were sent before, so they are only
+        sent the new ones.
+
+        platform_re and task_list are as in
+        BinaryManager.add_encoded_binaries
+        """
+        self.services.binary_manager.add_encoded_binaries(
+            platform_re, task_list)
+        for worker in self.worker_group.get_all_workers():
+            worker.stale_binaries = True
+            worker.pending_binaries.update(
+                task_name for task_name, _ in task_list)
+        for worker in self.worker_group.available_workers():
+            self.refresh_worker_binaries(worker)
+
+    def refresh_worker_binaries(self, worker):
+        """
+        Sends a worker the binaries for its platform that were added since
+        it last received any, and that have not been removed since. The
+        worker is taken out of the worker group until it replies with
+        binaries_received, which adds it back as a ready worker.
+        """
+        self.worker_group.remove_worker(worker.uid)
+        binaries = self.services.binary_manager.get_binaries(worker.platform)
+        data = {
+            'base64_binaries': {
+                task_name: binary for task_name, binary in binaries
+                if task_name in worker.pending_binaries},
+        }
+        worker.stale_binaries = False
+        worker.pending_binaries = set()
+        self.send(worker.websocket, 'get_binaries', data)
+
+    def wait_until(self, condition):
+        """
+        Returns a future that is resolved at the end of the first
+        scheduling pass where condition, a function taking no arguments,
+        returns True
+        """
+        future = asyncio.Future()
+        self._waiters.append((condition, future))
+        self._check_waiters()
+        return future
+
+    def _check_waiters(self):
+        waiting = []
+        for condition, future in self._waiters:
+            if future.done():
+                continue
+            if condition():
+                future.set_result(None)
+            else:
+                waiting.append((condition, future))
+        self._waiters = waiting
 
     def send(self, socket, label, data):
         asyncio.ensure_future(self._send_message(socket, label, data))
 
-    def start(self, address='0.0.0.0', port=8765, password=None):
+    async def listen(self, address='0.0.0.0', port=8765, password=None):
+        """
+        Start accepting workers and distributing tasks on the running
+        event loop. This returns once the server is listening, use
+        wait_until to wait for the work to be done.
+        """
         self.__statistics_updater.overwrite("start_time",
                                             datetime.utcnow().isoformat())
-        server = websockets.serve(
+        self.password = password
+        self._websocket_server = await websockets.serve(
             self.websocket_handler,
             address,
             port)
-        self.password = password
+        self._scheduler_future = asyncio.ensure_future(
+            self.scheduler.run(self))
+        if self.heartbeat_monitor is not None:
+            self._heartbeat_future = asyncio.ensure_future(
+                self._send_heartbeats())
+        self.scheduler.wake()
+
+    def close(self):
+        """
+        Stop accepting workers and stop distributing tasks
+        """
+        if self._scheduler_future is not None:
+            self._scheduler_future.cancel()
+            self._scheduler_future = None
+        if self._heartbeat_future is not None:
+            self._heartbeat_future.cancel()
+            self._heartbeat_future = None
+        if self._websocket_server is not None:
+            self._websocket_server.close()
+            self._websocket_server = None
+        if self.local_executor is not None:
+            self.local_executor.shutdown()
+        if self.server_pool is not None:
+            self.server_pool.shutdown()
 
-        asyncio.get_event_loop().run_until_complete(server)
-        asyncio.get_event_loop().call_soon(self.distribute_tasks)
-        asyncio.get_event_loop().run_forever()
+    def start(self, address='0.0.0.0', port=8765, password=None):
+        """
+        Run the server until there are no more active tasks in the queue
+        """
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.listen(address, port, password))
+        loop.run_until_complete(self.wait_until(self.task_queue.is_inactive))
+        self.close()
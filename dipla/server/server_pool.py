@@ -0,0 +1,89 @@
+"""
+This module runs the functions of server tasks, such as the function given
+to Dipla.data_source, on a pool of threads or processes. This keeps the
+server's event loop free to talk to workers while data is being loaded.
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import dill
+
+from dipla.server.local_executor import load_function
+
+
+class ServerTaskPool:
+
+    def __init__(self, kind='thread', max_workers=None):
+        """
+        Params:
+         - kind: 'thread' to run the functions on threads, which suits
+        functions that wait on files or the network, or 'process' to run
+        them in other processes, which suits functions that use the CPU
+         - max_workers: The number of threads or processes, which defaults
+        to the number of CPUs
+        """
+        if kind not in ('thread', 'process'):
+            raise ValueError("kind must be 'thread' or 'process'")
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.kind = kind
+        self.max_workers = max_workers
+        self._pool = None
+        self._num_running = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.kind == 'thread':
+                self._pool = ThreadPoolExecutor(self.max_workers)
+            else:
+                self._pool = ProcessPoolExecutor(self.max_workers)
+        return self._pool
+
+    def has_capacity(self):
+        """
+        Returns True if fewer batches are running than there are threads
+        or processes, so that input is only read as it can be used
+        """
+        return self._num_running < self.max_workers
+
+    def run(self, function, values, on_results, on_error):
+        """
+        Applies the function to each value on the pool. Once it has
+        finished on_results is called on the event loop with the list of
+        results, or on_error is called with the exception the function
+        raised
+        """
+        if self.kind == 'thread':
+            future = self._get_pool().submit(apply_to_each, function, values)
+        else:
+            future = self._get_pool().submit(
+                apply_serialised_to_each, dill.dumps(function, recurse=True),
+                values)
+        self._num_running += 1
+        loop = asyncio.get_event_loop()
+
+        def finished(future):
+            self._num_running -= 1
+            try:
+                results = future.result()
+            except Exception as error:
+                on_error(error)
+                return
+            on_results(results)
+
+        future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(finished, future))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+def apply_to_each(function, values):
+    return [function(value) for value in values]
+
+
+def apply_serialised_to_each(serialised_function, values):
+    return apply_to_each(load_function(serialised_function), values)
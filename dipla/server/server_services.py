@@ -2,6 +2,7 @@ import sys
 from dipla.shared.logutils import LogUtils
 from dipla.shared.services import ServiceError
 from dipla.shared.error_codes import ErrorCodes
+from dipla.shared import objects
 from dipla.server import control
 
 
@@ -30,7 +31,10 @@ class ServerServices:
             'runtime_error': self._handle_runtime_error,
             'verify_inputs_result': self._handle_verify_inputs,
             'start_server': self._handle_start_server,
-            'stop_server': self._handle_stop_server
+            'stop_server': self._handle_stop_server,
+            'submit_job': self._handle_submit_job,
+            'fetched_objects': self._handle_fetched_objects,
+            'heartbeat': self._handle_heartbeat,
         }
         self.binary_manager = binary_manager
         self.__statistics_updater = stats
@@ -46,8 +50,7 @@ class ServerServices:
     def _handle_stop_server(self, message, params):
         control.stop_server(sys.exit)
 
-    def _handle_get_binaries(self, message, params):
-        # Check if the worker has provided the correct password
+    def _check_password(self, message, params):
         if params.server.password is not None:
             if 'password' not in message:
                 raise ServiceError('Password required by server',
@@ -55,10 +58,44 @@ class ServerServices:
             elif message['password'] != params.server.password:
                 raise ServiceError('Incorrect password provided',
                                    ErrorCodes.invalid_password)
+
+    def _handle_submit_job(self, message, params):
+        # Jobs can only be run by a server whose task queue is a JobQueue
+        self._check_password(message, params)
+        server = params.server
+        if not hasattr(server.task_queue, 'create_job'):
+            raise ServiceError('This server does not accept jobs',
+                               ErrorCodes.jobs_not_supported)
+        try:
+            job = server.task_queue.create_job(message)
+        except ValueError as e:
+            raise ServiceError(e, ErrorCodes.invalid_job)
+
+        # Only the new job's binaries are sent to the workers, which keep
+        # those of the jobs before it
+        server.add_binaries('.*', list(job.binaries.items()))
+
+        def send_results(future):
+            server.task_queue.remove_job(job.uid)
+            data = {
+                'job_uid': job.uid,
+                'results': job.results(),
+            }
+            server.send(params.worker.websocket, 'job_result', data)
+
+        server.wait_until(job.is_finished).add_done_callback(send_results)
+        server.scheduler.wake()
+        return {'job_uid': job.uid}
+
+    def _handle_get_binaries(self, message, params):
+        # Check if the worker has provided the correct password
+        self._check_password(message, params)
         # Set the workers quality
         params.worker.set_quality(message['quality'])
         # Find the correct binary for the worker
         platform = message['platform']
+        params.worker.platform = platform
+        params.worker.resources = message.get('resources', {})
         try:
             encoded_bins = self.binary_manager.get_binaries(platform)
         except KeyError as e:
@@ -79,8 +116,7 @@ class ServerServices:
         # assign it to this worker, as it should be the only ready one
         # If there are other workers it is okay to distribute tasks to
         # them too
-
-        params.server.distribute_tasks()
+        params.server.scheduler.wake()
         return None
 
     def _send_verify_inputs(self, server, results, worker_id, task_id):
@@ -97,12 +133,20 @@ class ServerServices:
         # with both the inputs and the results
         verify_data['results'] = results
 
-        # Send the verify inputs request to a client
-        leased_worker = server.worker_group.lease_worker()
+        # Send the verify inputs request to a client that has the
+        # resources the task requires
+        requirements = verify_data.get('requirements')
+        capable = [worker for worker in
+                   server.worker_group.available_workers()
+                   if not requirements or worker.satisfies(requirements)]
+        if not capable:
+            return
+        leased_worker = server.worker_group.lease_worker(min(capable).uid)
         data = {}
         data['task_instructions'] = verify_data['task_instructions']
         data['task_uid'] = task_id
         data['arguments'] = verify_data['inputs']
+        server.attach_broadcasts(data, leased_worker)
         server.send(leased_worker.websocket, 'verify_inputs', data)
 
         # Add the verification input / results data back to the map
@@ -112,11 +156,26 @@ class ServerServices:
 
     def _handle_client_result(self, message, params):
         task_id = message['task_uid']
-        results = message['results']
         server = params.server
         worker = params.worker
+        # The references to results kept by the worker are given its uid,
+        # so that input reading them can be sent back to it
+        results = [objects.set_holder(result, worker.uid)
+                   for result in message['results']]
+        if any(objects.get_object_id(result) is not None
+               for result in results):
+            worker.kept_task_uids.add(task_id)
+        # A task with a combiner gets one result for a whole batch
+        inputs_per_result = message.get('combined', 1)
         self.__statistics_updater.adjust("num_results_from_clients",
                                          len(results))
+        server.record_client_run(worker, task_id,
+                                 len(results) * inputs_per_result)
+        worker.in_flight_input = None
+
+        cache_keys = None
+        if worker.last_cache_keys is not None:
+            cache_keys = list(worker.last_cache_keys)
 
         t_instr = worker.current_task_instr
         if server.result_verifier.has_verifier(t_instr):
@@ -149,27 +208,39 @@ class ServerServices:
 
             for x in remove_indices[::-1]:
                 results.pop(x)
+                if cache_keys is not None:
+                    cache_keys.pop(x)
 
         if "signals" in message:
-            message_signals = message["signals"]
-            task_uid = message["task_uid"]
-            task_signals = server.task_queue.get_task(task_uid).signals
-            for signal in message_signals:
-                if signal not in task_signals:
-                    continue
-                for values in message_signals[signal]:
-                    task_signals[signal](server, task_uid, values)
-            server.distribute_tasks()
+            server.handle_signals(message["task_uid"], message["signals"])
 
         # TODO remove results if not verified
-        for result in results:
-            server.task_queue.add_result(task_id, result)
+        if inputs_per_result > 1:
+            for result in results:
+                server.task_queue.add_result(
+                    task_id, result, num_inputs=inputs_per_result)
+        else:
+            for result in results:
+                server.task_queue.add_result(task_id, result)
+        if cache_keys is not None:
+            server.cache_results(task_id, cache_keys, results)
 
         # We need to send verify_inputs before returning the worker so
         # that we dont send it to the original worker
         self._send_verify_inputs(server, results, worker.uid, task_id)
         server.worker_group.return_worker(worker.uid)
-        server.distribute_tasks()
+        if worker.stale_binaries:
+            server.refresh_worker_binaries(worker)
+        server.scheduler.wake()
+        return None
+
+    def _handle_fetched_objects(self, message, params):
+        params.server.add_fetched_objects(
+            message['objects'], message.get('missing', []))
+        return None
+
+    def _handle_heartbeat(self, message, params):
+        params.server.record_heartbeat(params.worker, message)
         return None
 
     def _handle_runtime_error(self, message, params):
@@ -194,6 +265,9 @@ class ServerServices:
         else:
             original_worker.correctness_score += 0.05
             params.server.worker_group.return_worker(params.worker.uid)
+            if params.worker.stale_binaries:
+                params.server.refresh_worker_binaries(params.worker)
+            params.server.scheduler.wake()
 
         del params.server.verify_inputs[verify_inputs_key]
 
@@ -0,0 +1,225 @@
+"""
+This module groups the output of a task by key, so that the values of each
+key can be reduced together, see Dipla.reduce_by_key.
+
+Each value of the task is a list of [key, value] pairs, or a dictionary of
+key to value. As the values arrive the pairs are sent to one of a number of
+partitions by a hash of their key, which is the same for a key on every
+run. Once the task has finished, each partition is handed out as a single
+input, holding a [key, values] group for every key in it, so that the
+partitions are reduced by different workers at the same time.
+
+A partition that holds more than spill_after values writes them, sorted by
+key, to a new file on the server's disk. When a partition with files is
+handed out, its files are merged and read back a few keys at a time, so it
+is handed out as several inputs of at most spill_after values each, except
+that the values of a key are never split between inputs.
+"""
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+
+class Shuffle:
+
+    def __init__(self, source, is_finished, num_partitions=16,
+                 spill_after=None, can_consume=None):
+        """
+        Params:
+         - source: The list that the output of the task being shuffled is
+        added to
+         - is_finished: A function returning True once the task will never
+        add any more output to source
+         - num_partitions: The number of partitions
+         - spill_after: The most values a partition holds in memory before
+        writing them to disk. None means values are never written to disk
+         - can_consume: A function returning True if values can be removed
+        from source as they are read, which is only the case while nothing
+        else reads it. None means they are never removed
+        """
+        if num_partitions < 1:
+            raise ValueError("There must be at least 1 partition")
+        if spill_after is not None and spill_after < 1:
+            raise ValueError("Partitions must hold at least 1 value")
+        self.source = source
+        self.is_finished = is_finished
+        self.num_partitions = num_partitions
+        self.spill_after = spill_after
+        self.can_consume = can_consume
+        self._location = 0
+        self._partitions = [[] for _ in range(num_partitions)]
+        # Dictionary of partition index to the paths of the files its
+        # spilled values are in, each sorted by key
+        self._spill_paths = {}
+        self._num_spills = 0
+        self._spill_directory = None
+        # The indexes of the partitions still to be handed out, once the
+        # task being shuffled has finished
+        self._ready = None
+        # The groups of the spilled partition being handed out, a batch at
+        # a time, and the next batch to hand out
+        self._batches = None
+        self._next_batch = None
+
+    def partition_of(self, key):
+        encoded = _encode_key(key).encode('utf-8')
+        digest = hashlib.md5(encoded).digest()[:8]
+        return int.from_bytes(digest, 'little') % self.num_partitions
+
+    def __len__(self):
+        # The number of partitions that can be handed out right now
+        self._read_source()
+        if self._ready is None:
+            if not self.is_finished():
+                return 0
+            # Empty partitions would give the task reading them nothing
+            # to return, so they are never handed out
+            self._ready = [index for index in range(self.num_partitions)
+                           if self._partitions[index] or
+                           index in self._spill_paths]
+        return len(self._ready) + (self._next_batch is not None)
+
+    def pop(self, index=0):
+        """
+        Returns:
+         - The next partition, as a list of [key, values] groups in the
+           order their keys were first seen, or the next batch of groups of
+           a spilled partition, in the order of their encoded keys
+        """
+        if index != 0:
+            raise IndexError("Partitions can only be popped from the front")
+        if len(self) == 0:
+            raise IndexError("No partitions are ready to be popped")
+        if self._next_batch is None:
+            partition = self._ready.pop(0)
+            if partition not in self._spill_paths:
+                groups = _group(self._partitions[partition])
+                self._partitions[partition] = []
+                return groups
+            # The values still in memory are merged with the others too
+            if self._partitions[partition]:
+                self._spill(partition)
+            self._batches = self._read_spilled(partition)
+            self._next_batch = next(self._batches)
+        batch = self._next_batch
+        self._next_batch = next(self._batches, None)
+        if self._next_batch is None:
+            self._batches = None
+            if not self._spill_paths and self._spill_directory is not None:
+                shutil.rmtree(self._spill_directory, ignore_errors=True)
+                self._spill_directory = None
+        return batch
+
+    def read_partition(stream, location):
+        return [stream.pop(0)]
+
+    def any_partition_ready(stream, location):
+        return len(stream) > 0
+
+    def _read_source(self):
+        if self.can_consume is not None and self.can_consume():
+            # The values read before nothing else read the source are
+            # removed too
+            del self.source[:self._location]
+            self._location = 0
+            while self.source:
+                self._add_pairs(self.source.pop(0))
+            return
+        while self._location < len(self.source):
+            self._add_pairs(self.source[self._location])
+            self._location += 1
+
+    def _add_pairs(self, value):
+        # A value that is not pairs has already failed the task reading the
+        # shuffle when it was added, see check_pairs
+        if isinstance(value, dict):
+            value = value.items()
+        elif not _is_pairs(value):
+            return
+        for key, pair_value in value:
+            partition = self.partition_of(key)
+            self._partitions[partition].append([key, pair_value])
+            if self.spill_after is not None and \
+                    len(self._partitions[partition]) > self.spill_after:
+                self._spill(partition)
+
+    def _spill(self, partition):
+        # Each line is a pair's encoded key and encoded value, separated
+        # by a tab, which JSON escapes everywhere else
+        if self._spill_directory is None:
+            self._spill_directory = tempfile.mkdtemp(prefix='dipla_shuffle')
+        path = os.path.join(self._spill_directory, str(self._num_spills))
+        self._num_spills += 1
+        self._spill_paths.setdefault(partition, []).append(path)
+        # sorted() keeps the values of a key in the order they arrived
+        lines = sorted(
+            ((_encode_key(key), json.dumps(value))
+             for key, value in self._partitions[partition]),
+            key=lambda line: line[0])
+        with open(path, 'w') as f:
+            for encoded_key, encoded_value in lines:
+                f.write(encoded_key + '\t' + encoded_value + '\n')
+        self._partitions[partition] = []
+
+    def _read_spilled(self, partition):
+        # Yields the groups of a spilled partition in batches of at most
+        # spill_after values, merging its files a line at a time
+        paths = self._spill_paths.pop(partition)
+        files = [open(path) for path in paths]
+        try:
+            lines = heapq.merge(
+                *files, key=lambda line: line.split('\t', 1)[0])
+            batch = []
+            size = 0
+            for encoded_key, key_lines in itertools.groupby(
+                    lines, key=lambda line: line.split('\t', 1)[0]):
+                values = [json.loads(line.split('\t', 1)[1])
+                          for line in key_lines]
+                if batch and size + len(values) > self.spill_after:
+                    yield batch
+                    batch = []
+                    size = 0
+                batch.append([json.loads(encoded_key), values])
+                size += len(values)
+            yield batch
+        finally:
+            for f in files:
+                f.close()
+            for path in paths:
+                os.remove(path)
+
+
+def check_pairs(value):
+    """
+    Raises:
+     - ValueError if value is neither a list of [key, value] pairs nor a
+    dictionary, so cannot be grouped by key
+    """
+    if not isinstance(value, dict) and not _is_pairs(value):
+        raise ValueError("Values can only be grouped by key if they are "
+                         "lists of [key, value] pairs or dictionaries")
+
+
+def _is_pairs(value):
+    return isinstance(value, list) and \
+        all(isinstance(pair, (list, tuple)) and len(pair) == 2
+            for pair in value)
+
+
+def _encode_key(key):
+    return json.dumps(key, sort_keys=True)
+
+
+def _group(pairs):
+    groups = OrderedDict()
+    for key, value in pairs:
+        encoded_key = _encode_key(key)
+        if encoded_key not in groups:
+            groups[encoded_key] = [key, []]
+        groups[encoded_key][1].append(value)
+    return list(groups.values())
@@ -3,10 +3,15 @@ This module is a queue implementation for organising distributable tasks
 using information such as the task identifier and input data
 """
 
+import asyncio
 import queue  # needed to inherit exception from
 import sys
+from collections import deque
 from enum import Enum
 
+from dipla.server.result_cache import make_key
+from dipla.shared.logutils import LogUtils
+
 
 class TaskQueue:
     """
@@ -32,6 +37,80 @@ class TaskQueue:
         # structure. The keys of the dictionary are the task ids and
         # the values are the TaskQueueNode objects
         self._nodes = {}
+        # _task_order is the list of the ids of the tasks in _nodes, in the
+        # order they were pushed, as dictionaries do not keep their order
+        # on every supported version of Python
+        self._task_order = []
+        # _priority_mode decides the order that active tasks are
+        # considered in when popping input. _priority_order caches that
+        # order as a list of task ids, and is reset whenever the shape
+        # of the task graph changes
+        self._priority_mode = PriorityMode.insertion
+        self._priority_order = None
+        # _held_tasks are the ids of tasks that are left out when popping
+        # input and when checking if the queue is inactive, because what
+        # is currently being run does not need them
+        self._held_tasks = set()
+
+    def set_priority_mode(self, mode):
+        """
+        Changes the order in which active tasks are considered when input
+        is popped from the queue
+
+        mode is an instance of the PriorityMode enum
+        """
+        self._priority_mode = mode
+        self._priority_order = None
+
+    def set_held_tasks(self, task_uids):
+        """
+        Holds the given tasks, and releases any that were held before. No
+        input is popped for held tasks, and the queue is inactive when
+        every task that is not held is inactive
+        """
+        self._held_tasks = set(task_uids)
+        self._priority_order = None
+
+    def set_reduce_group_size(self, task_uid, reduce_group_size):
+        """
+        Changes the maximum number of values given to each run of a reduce
+        task
+        """
+        node = self._nodes[task_uid]
+        if not node.task_item.is_reduce:
+            raise ValueError("Only reduce tasks have a group size")
+        if reduce_group_size <= 1:
+            raise ValueError("Reduce group sizes must be greater than 1")
+        node.task_item.reduce_group_size = reduce_group_size
+        node.reduce_group_size = reduce_group_size
+
+    def num_reduce_values(self, task_uid):
+        """
+        Returns the number of values a reduce task can read right now
+        """
+        node = self._nodes[task_uid]
+        if not node.task_item.is_reduce:
+            raise ValueError("Only reduce tasks have values to reduce")
+        return node.dependencies[0].data_streamer.num_available()
+
+    def remaining_reduce_values(self, task_uid):
+        """
+        Returns the number of values a reduce task has left to reduce,
+        counting one for each group whose result has not come back yet,
+        or None if the task it reads may still add more
+        """
+        node = self._nodes[task_uid]
+        streamer = node.dependencies[0].data_streamer
+        num_values = self.num_reduce_values(task_uid)
+        if streamer.is_waiting() or \
+                isinstance(streamer.stream, IteratorStream) and \
+                not streamer.stream.exhausted:
+            return None
+        for dependency_uid in self.get_dependency_ids(task_uid):
+            if dependency_uid in self._nodes and \
+                    not self._nodes[dependency_uid].task_item.complete:
+                return None
+        return num_values + node.task_item.in_flight()
 
     def push_task(self, item):
         """
@@ -48,6 +127,8 @@ class TaskQueue:
         """
         if item.uid is None:
             raise AttributeError("Added task to TaskQueue with no id")
+        if item.uid not in self._nodes:
+            self._task_order.append(item.uid)
         if item.is_reduce:
             group_size = item.reduce_group_size
             self._nodes[item.uid] = ReduceTaskQueueNode(item, group_size)
@@ -57,6 +138,13 @@ class TaskQueue:
         # Add this task as a dependant of all its prerequisite tasks
         active = True
         for instruction in item.data_instructions:
+            stream = instruction.data_streamer.stream
+            if isinstance(stream, AsyncIteratorStream):
+                # An async iterator that raises can never finish the task
+                # reading it, so the task fails with its error
+                stream.on_error = \
+                    lambda error: self.fail_task(item.uid, error)
+
             # If instruction is from an iterable then it wont be a task
             # and wont have a task id
             if instruction.source_task_uid is None:
@@ -69,6 +157,43 @@ class TaskQueue:
                 active = False
         if active:
             self._active_tasks.add(item.uid)
+        self._priority_order = None
+
+    def fuse_tasks(self, upstream_uid, downstream_uid, instructions):
+        """
+        Replaces a task and the one task that reads its output with a
+        single task, which reads the upstream task's sources and runs the
+        given instructions on them. The downstream task keeps its uid and
+        its dependees, and the upstream task is removed from the queue, so
+        its output is never stored
+
+        Raises:
+         - ValueError if the downstream task reads anything other than the
+        upstream task, or something else reads the upstream task
+        """
+        upstream = self._nodes[upstream_uid]
+        downstream = self._nodes[downstream_uid]
+        if upstream.dependees != [downstream_uid] or \
+                len(downstream.dependencies) != 1 or \
+                downstream.dependencies[0].source_task_uid != upstream_uid:
+            raise ValueError(
+                "Only a task and its only dependee can be fused")
+
+        # The node shares its dependencies list with its task, so the
+        # list is changed in place
+        downstream.dependencies[:] = upstream.dependencies
+        downstream.task_item.instructions = instructions
+        for dependency_uid in self.get_dependency_ids(downstream_uid):
+            dependees = self._nodes[dependency_uid].dependees
+            dependees[dependees.index(upstream_uid)] = downstream_uid
+        del self._nodes[upstream_uid]
+        self._task_order.remove(upstream_uid)
+
+        self._active_tasks.discard(downstream_uid)
+        if upstream_uid in self._active_tasks:
+            self._active_tasks.remove(upstream_uid)
+            self._active_tasks.add(downstream_uid)
+        self._priority_order = None
 
     def push_task_input(self, task_id, inputs):
         """
@@ -108,7 +233,7 @@ class TaskQueue:
         """
         if machine_type is None:
             machine_type = MachineType.any_machine
-        for task_uid in self._active_tasks:
+        for task_uid in self._active_tasks - self._held_tasks:
             if not self._nodes[task_uid].is_machine_type(machine_type):
                 continue
 
@@ -117,9 +242,82 @@ class TaskQueue:
 
         return False
 
+    def ready_task_uids(self, machine_type=None):
+        """
+        Returns a list of the uids of the active tasks that have input
+        that can be popped right now, in the order the tasks were pushed
+        into the queue
+
+        machine_type is an instance of the MachineType enum. If
+        specified, only tasks of this type are returned
+        """
+        if machine_type is None:
+            machine_type = MachineType.any_machine
+        ready = []
+        for task_uid in self._active_task_uids_by_priority():
+            node = self._nodes[task_uid]
+            if node.is_machine_type(machine_type) and node.has_next_input():
+                ready.append(task_uid)
+        return ready
+
+    def _active_task_uids_by_priority(self):
+        if self._priority_order is None:
+            self._priority_order = self._compute_priority_order()
+        return [x for x in self._priority_order
+                if x in self._active_tasks and x not in self._held_tasks]
+
+    def _compute_priority_order(self):
+        task_uids = list(self._task_order)
+        if self._priority_mode == PriorityMode.insertion:
+            return task_uids
+        if self._priority_mode == PriorityMode.planned:
+            # sorted() is stable, so equal priorities keep insertion order
+            return sorted(task_uids,
+                          key=lambda uid: -self._nodes[uid].task_item.priority)
+
+        depths = {}
+        heights = {}
+        if self._priority_mode == PriorityMode.downstream_first:
+            def rank(uid):
+                return self._task_depth(uid, depths)
+        else:
+            # Tasks with the longest chain of work left after them are
+            # on the critical path. Ties go to the most downstream task
+            def rank(uid):
+                return (self._task_height(uid, heights),
+                        self._task_depth(uid, depths))
+        # sorted() is stable, so equally ranked tasks keep insertion order
+        return sorted(task_uids, key=rank, reverse=True)
+
+    def _task_depth(self, task_uid, depths):
+        """
+        The length of the longest chain of tasks that feed into this task
+        """
+        if task_uid not in depths:
+            depth = 0
+            for dependency in self._nodes[task_uid].dependencies:
+                if dependency.source_task_uid is None:
+                    continue
+                depth = max(depth, 1 + self._task_depth(
+                    dependency.source_task_uid, depths))
+            depths[task_uid] = depth
+        return depths[task_uid]
+
+    def _task_height(self, task_uid, heights):
+        """
+        The length of the longest chain of tasks that depend on this task
+        """
+        if task_uid not in heights:
+            height = 0
+            for dependee_uid in self._nodes[task_uid].dependees:
+                height = max(height, 1 + self._task_height(
+                    dependee_uid, heights))
+            heights[task_uid] = height
+        return heights[task_uid]
+
     # TODO(StefanKennedy) Add fallback in case popped values are lost
     # and we need to redistribute them
-    def pop_task_input(self, machine_type=None):
+    def pop_task_input(self, machine_type=None, task_uid=None, batch_size=1):
         """
         Returns a TaskInput object that can be used to run a task as a
         These values will be taken from a task with its id present in
@@ -130,6 +328,13 @@ class TaskQueue:
         on the specified machine.) If this parameter is None it will
         have MachineType.any_machine assigned to it
 
+        task_uid is the uid of the task that the input should be popped
+        from. If this is None the first task with available input is
+        used
+
+        batch_size is the maximum number of inputs that will be read into
+        the returned TaskInput. Reduce tasks always read one group
+
         Raises:
          - TaskQueueEmpty exception is there's no available tasks or
         no data available to return for any of the available tasks
@@ -141,24 +346,47 @@ class TaskQueue:
         if machine_type is None:
             machine_type = MachineType.any_machine
 
+        if task_uid is not None:
+            if task_uid not in self._active_tasks or \
+                    task_uid in self._held_tasks or \
+                    not self._nodes[task_uid].has_next_input():
+                raise TaskQueueEmpty(
+                    "Task had no input available to pop", task_uid)
+            return self._pop_node_input(task_uid, batch_size)
+
         if not self.has_next_input(machine_type):
             raise TaskQueueEmpty("Queue was empty and could not pop input")
 
-        for task_uid in self._active_tasks:
+        for task_uid in self._active_task_uids_by_priority():
             if not self._nodes[task_uid].is_machine_type(machine_type):
                 continue
 
             if self._nodes[task_uid].has_next_input():
                 # Read some data from this task, and if check if we've
                 # completed it
-                return self._nodes[task_uid].next_input()
-
-    def add_result(self, task_id, result):
+                return self._pop_node_input(task_uid, batch_size)
+
+    def _pop_node_input(self, task_uid, batch_size):
+        task_input = self._nodes[task_uid].next_input(batch_size)
+        # Inputs whose results were found in the task's cache are never
+        # handed out, so their results are added straight away
+        task = self._nodes[task_uid].task_item
+        for result in task_input.cached_results:
+            task.inc_expected_results_by(1)
+            self.add_result(task_uid, result)
+        return task_input
+
+    def add_result(self, task_id, result, num_inputs=1):
         if task_id not in self._nodes:
             raise KeyError(
                 "Attempted to add result for a task not present in the queue")
+        if self._nodes[task_id].task_item.cancelled:
+            # Results for input that was handed out before the task was
+            # cancelled are of no use to anything anymore
+            return
 
-        self._nodes[task_id].task_item.add_result(result)
+        self._nodes[task_id].task_item.add_result(result, num_inputs)
+        self._check_result(task_id, result)
         if self._nodes[task_id].task_item.is_reduce:
             # This task has been marked as a reduce task, so outputs should be
             # put back into the same task as an input.
@@ -175,9 +403,128 @@ class TaskQueue:
         if self.is_task_complete(task_id):
             self._active_tasks.remove(task_id)
 
+    def cancel_task(self, task_uid):
+        """
+        Stops a task from receiving any more input. Its unread input is
+        discarded and any results still to come back for it are ignored.
+        Tasks that depend on it can still use the results it has already
+        produced, and are completed once they have used them up
+
+        Raises:
+         - KeyError if the task is not in the queue
+        """
+        if task_uid not in self._nodes:
+            raise KeyError(
+                "Attempted to cancel a task that is not in the queue")
+        self._nodes[task_uid].task_item.cancel()
+        self._active_tasks.discard(task_uid)
+        self._complete_drained_dependees(task_uid)
+
+    def fail_task(self, task_uid, error):
+        """
+        Cancels a task that cannot carry on because of an error, which is
+        logged and kept as the task's error
+
+        Raises:
+         - KeyError if the task is not in the queue
+        """
+        LogUtils.error("Task {} failed".format(task_uid), error)
+        self.cancel_task(task_uid)
+        self._nodes[task_uid].task_item.error = error
+
+    def _check_result(self, task_uid, result):
+        # A result that a task reading this one cannot read fails the
+        # reading task as soon as it arrives
+        checks = self._nodes[task_uid].task_item.result_checks
+        for reader_uid, check in list(checks.items()):
+            if self._nodes[reader_uid].task_item.cancelled:
+                continue
+            try:
+                check(result)
+            except ValueError as e:
+                self.fail_task(reader_uid, e)
+
+    def remove_tasks(self, task_uids):
+        """
+        Removes finished tasks from the queue, along with their output, so
+        that tasks which are no longer needed do not keep their results in
+        memory
+
+        Raises:
+         - ValueError if a task is still active or has input in flight, or
+        a task that is not being removed reads one of the tasks
+        """
+        task_uids = set(task_uids)
+        for task_uid in task_uids:
+            node = self._nodes[task_uid]
+            if task_uid in self._active_tasks or \
+                    node.task_item.in_flight() > 0:
+                raise ValueError("Only finished tasks can be removed")
+            if not set(node.dependees) <= task_uids:
+                raise ValueError(
+                    "Tasks that are read by other tasks cannot be removed")
+        for task_uid in task_uids:
+            for dependency_uid in self.get_dependency_ids(task_uid):
+                if dependency_uid in task_uids:
+                    continue
+                self._nodes[dependency_uid].dependees.remove(task_uid)
+                self._nodes[dependency_uid].task_item.result_checks.pop(
+                    task_uid, None)
+        for task_uid in task_uids:
+            del self._nodes[task_uid]
+        self._task_order = [task_uid for task_uid in self._task_order
+                            if task_uid not in task_uids]
+        self._held_tasks -= task_uids
+        self._priority_order = None
+
+    def _complete_drained_dependees(self, task_uid):
+        # A dependee with nothing left to read and nothing in flight will
+        # never receive input from this task again, so it is finished
+        for dependee_uid in self._nodes[task_uid].dependees:
+            node = self._nodes[dependee_uid]
+            if node.task_item.complete:
+                continue
+            if node.has_next_input() or node.task_item.in_flight() > 0:
+                continue
+            node.task_item.complete = True
+            self._active_tasks.discard(dependee_uid)
+            self._complete_drained_dependees(dependee_uid)
+
     def get_task(self, task_uid):
         return self._nodes[task_uid].task_item
 
+    def get_dependee_ids(self, task_uid):
+        """
+        Returns a list of the ids of the tasks that read the output of
+        the given task
+        """
+        if task_uid not in self._nodes:
+            raise KeyError(
+                "Attempted to get dependees of a task not in the queue")
+        return list(self._nodes[task_uid].dependees)
+
+    def is_subgraph_inactive(self, task_uid):
+        """
+        Returns True if neither the given task nor any of the tasks it
+        reads from, directly or indirectly, are active
+        """
+        if task_uid in self._active_tasks:
+            return False
+        return all(self.is_subgraph_inactive(dependency_uid)
+                   for dependency_uid in self.get_dependency_ids(task_uid))
+
+    def get_dependency_ids(self, task_uid):
+        """
+        Returns a list of the ids of the tasks whose output is read by
+        the given task
+        """
+        if task_uid not in self._nodes:
+            raise KeyError(
+                "Attempted to get dependencies of a task not in the queue")
+        return [dependency.source_task_uid
+                for dependency in self._nodes[task_uid].dependencies
+                if dependency.source_task_uid is not None]
+
     def activate_new_tasks(self, ids):
         """
         Checks the tasks using the set of ids to try to move some more
@@ -218,8 +565,30 @@ class TaskQueue:
                 "Tried to check if task was complete that is not in the queue")
         return self._nodes[task_uid].task_item.complete
 
+    def is_task_finished(self, task_uid):
+        """
+        Returns True if a task will never have any more results, because
+        it is complete, none of its input is left to read or waiting on a
+        worker, and the same is true of every task it depends on. Unlike
+        is_task_complete, this is never True of a task that completed
+        before the tasks it reads had finished
+        """
+        node = self._nodes[task_uid]
+        task = node.task_item
+        if task.cancelled:
+            return True
+        if not task.complete or task.in_flight() > 0:
+            return False
+        for dependency in node.dependencies:
+            if dependency.data_streamer.has_available_data() or \
+                    dependency.data_streamer.is_waiting():
+                return False
+        return all(self.is_task_finished(dependency_uid)
+                   for dependency_uid in self.get_dependency_ids(task_uid)
+                   if dependency_uid in self._nodes)
+
     def is_inactive(self):
-        return len(self._active_tasks) == 0
+        return len(self._active_tasks - self._held_tasks) == 0
 
     def get_task_ids(self):
         return self._nodes.keys()
@@ -249,32 +618,82 @@ class TaskQueueNode:
     def add_dependee(self, dependee_uid):
         self.dependees.append(dependee_uid)
 
-    def next_input(self):
+    def next_input(self, batch_size=1):
+        """
+        Reads up to batch_size inputs for the task. If the task has a
+        result cache, inputs with a cached result are not counted towards
+        the batch, and their results are put in the TaskInput's
+        cached_results instead, so the TaskInput's values can be empty
+        """
         if not self.dependencies[0].data_streamer.has_available_data():
             raise DataStreamerEmpty(
                 "Attempted to read input from an empty source")
 
-        arguments = []
-        for dependency in self.dependencies:
-            argument_id = dependency.source_uid
-            arg = dependency.data_streamer.read()
-            # Client expects a list of arguments
-            if not isinstance(arg, list):
-                arg = [arg]
-            arguments.append(arg)
-
-        # Not very pretty, but expect a result for every element in the args
-        self.task_item.inc_expected_results_by(len(arguments[0]))
+        arguments = [[] for _ in self.dependencies]
+        cache_keys = None
+        if self.task_item.result_cache is not None:
+            cache_keys = []
+        cached_results = []
+        num_read = 0
+        while num_read < batch_size:
+            # Only read more values while every argument has one and the
+            # task is below its limit of results in flight
+            if (num_read > 0 or cached_results) and \
+                    not self._has_next_uncached_input(len(cached_results)):
+                break
+            values = []
+            for dependency in self.dependencies:
+                arg = dependency.data_streamer.read()
+                # Client expects a list of arguments
+                if not isinstance(arg, list):
+                    arg = [arg]
+                values.append(arg)
+            if cache_keys is not None:
+                key = self.task_item.cached_result_key(values)
+                if key is not None:
+                    try:
+                        cached_results.append(
+                            self.task_item.result_cache.get(key))
+                        continue
+                    except KeyError:
+                        pass
+                cache_keys.extend([key] * len(arg))
+            for argument, arg in zip(arguments, values):
+                argument.extend(arg)
+            # Not very pretty, but expect a result for every element in
+            # the args. This is counted as we go so that has_next_input
+            # sees the values already in this batch
+            self.task_item.inc_expected_results_by(len(arg))
+            num_read += 1
         return TaskInput(
             self.task_item.uid,
             self.task_item.instructions,
             self.task_item.machine_type,
             arguments,
-            signals=list(self.task_item.signals))
+            signals=list(self.task_item.signals),
+            cache_keys=cache_keys,
+            cached_results=cached_results,
+            keep_results=self.task_item.keep_on_worker,
+            combiner=self.task_item.combiner)
+
+    def _has_next_uncached_input(self, num_cached_results):
+        # Cached results are only added to the output once the input has
+        # been read, so they count towards the output buffer here
+        if num_cached_results > 0:
+            max_buffered_output = self.task_item.max_buffered_output
+            if max_buffered_output is not None and \
+                    len(self.task_item.task_output) + num_cached_results >= \
+                    max_buffered_output:
+                return False
+        return self.has_next_input()
 
     def has_next_input(self):
         if len(self.dependencies) == 0:
             return False
+        if self.task_item.in_flight_capacity() <= 0:
+            return False
+        if self.task_item.is_output_full():
+            return False
 
         for dependency in self.dependencies:
             if not dependency.data_streamer.has_available_data():
@@ -293,7 +712,9 @@ class ReduceTaskQueueNode(TaskQueueNode):
         super().__init__(task_item)
         self.reduce_group_size = reduce_group_size
 
-    def next_input(self):
+    def next_input(self, batch_size=1):
+        # A reduce task always reads a single group of up to
+        # reduce_group_size values, so batch_size is not used here
         if not self.dependencies[0].data_streamer.has_available_data():
             raise DataStreamerEmpty(
                 "Attempted to read input from an empty source")
@@ -320,7 +741,8 @@ class ReduceTaskQueueNode(TaskQueueNode):
             self.task_item.instructions,
             self.task_item.machine_type,
             arguments,
-            signals=list(self.task_item.signals))
+            signals=list(self.task_item.signals),
+            keep_results=self.task_item.keep_on_worker)
 
 
 class DataStreamerEmpty(Exception):
@@ -349,6 +771,28 @@ class DataSource:
     def move_by_one(stream, current_location):
         return current_location + 1
 
+    def read_from_iterator(stream, location):
+        return [stream.pop(0)]
+
+    def any_iterator_data_available(stream, location):
+        return len(stream) > 0
+
+    @staticmethod
+    def create_source_from_iterator(iterator, source_uid, prefetch=100):
+        """
+        Creates a source that pulls values from an iterator or an async
+        iterator only as they are needed, holding at most prefetch values
+        that have been pulled but not read yet
+        """
+        if hasattr(iterator, '__aiter__'):
+            stream = AsyncIteratorStream(iterator, prefetch)
+        else:
+            stream = IteratorStream(iterator, prefetch)
+        return DataSource(source_uid, None, DataStreamer(
+            stream,
+            DataSource.read_from_iterator,
+            DataSource.any_iterator_data_available))
+
     @staticmethod
     def create_source_from_task(
             task,
@@ -434,10 +878,40 @@ class DataStreamer:
         self.availability_check = availability_check
         self.stream_location_changer = stream_location_changer
         self.stream_location = 0
+        self.closed = False
 
     def has_available_data(self):
+        if self.closed:
+            return False
         return self.availability_check(self.stream, self.stream_location)
 
+    def num_available(self):
+        """
+        Returns the number of values that can be read right now, for
+        streams that are read one value at a time
+        """
+        if self.closed:
+            return 0
+        return max(len(self.stream) - self.stream_location, 0)
+
+    def close(self):
+        """
+        Stop any more values being read from this DataStreamer, discarding
+        whatever has not been read yet
+        """
+        self.closed = True
+
+    def is_waiting(self):
+        """
+        Returns True if there may be more data in the future even though
+        there is none available now, because the stream is still being
+        filled in the background
+        """
+        if self.closed:
+            return False
+        return isinstance(self.stream, AsyncIteratorStream) and \
+            not self.stream.exhausted
+
     def read(self):
         if not self.has_available_data():
             raise DataStreamerEmpty("Attempted to read unavailable data")
@@ -458,6 +932,121 @@ class DataStreamer:
         self.stream.extend(inputs)
 
 
+class IteratorStream:
+
+    def __init__(self, iterator, prefetch=100):
+        """
+        A stream that can be used in place of a list by a DataStreamer,
+        where the values are pulled from an iterator as they are needed,
+        so that the whole input never has to be held in memory
+
+        iterator is any iterable, e.g. a generator
+
+        prefetch is the most values that are pulled from the iterator
+        before they are read from the stream
+        """
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        self._iterator = iter(iterator)
+        self._buffer = deque()
+        self.prefetch = prefetch
+        self.exhausted = False
+
+    def _fill(self):
+        while not self.exhausted and len(self._buffer) < self.prefetch:
+            try:
+                self._buffer.append(next(self._iterator))
+            except StopIteration:
+                self.exhausted = True
+
+    def __len__(self):
+        # The number of values that can be popped right now
+        self._fill()
+        return len(self._buffer)
+
+    def __iter__(self):
+        self._fill()
+        return iter(list(self._buffer))
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError("Values can only be popped from the front")
+        self._fill()
+        return self._buffer.popleft()
+
+
+class AsyncIteratorStream(IteratorStream):
+    """
+    An IteratorStream for async iterators, e.g. async generators. Values
+    are pulled in the background on the running event loop, and
+    on_available is called whenever more become available so that the
+    server can be woken up to distribute them.
+
+    The last value pulled is held back until the iterator is known to be
+    exhausted, so that the task reading it is not marked complete while
+    the iterator could still produce more values.
+    """
+
+    def __init__(self, iterator, prefetch=100, on_available=None,
+                 on_error=None):
+        super().__init__([], prefetch)
+        self._async_iterator = iterator.__aiter__()
+        self._space_available = asyncio.Event()
+        self._filler = None
+        self.on_available = on_available
+        # Called with the exception the iterator raised, if it raises,
+        # which is also kept as error
+        self.on_error = on_error
+        self.error = None
+
+    def _fill(self):
+        if self._filler is None and not self.exhausted:
+            self._filler = asyncio.ensure_future(self._fill_in_background())
+
+    async def _fill_in_background(self):
+        try:
+            async for value in self._async_iterator:
+                self._buffer.append(value)
+                self._notify()
+                while len(self._buffer) > self.prefetch:
+                    self._space_available.clear()
+                    await self._space_available.wait()
+        except Exception as e:
+            # Nothing awaits this coroutine, so the error is passed on
+            # rather than raised, and the values pulled before it are
+            # still read
+            self.error = e
+            self.exhausted = True
+            self._notify()
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        self.exhausted = True
+        self._notify()
+
+    def _notify(self):
+        if self.on_available is not None:
+            self.on_available()
+
+    def __len__(self):
+        self._fill()
+        if self.exhausted:
+            return len(self._buffer)
+        return max(len(self._buffer) - 1, 0)
+
+    def __iter__(self):
+        return iter(list(self._buffer)[:len(self)])
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError("Values can only be popped from the front")
+        if len(self) == 0:
+            raise IndexError("No values are available to pop")
+        value = self._buffer.popleft()
+        self._space_available.set()
+        return value
+
+
 class TaskInput:
 
     def __init__(self,
@@ -465,7 +1054,11 @@ class TaskInput:
                  task_instructions,
                  machine_type,
                  values,
-                 signals={}):
+                 signals={},
+                 cache_keys=None,
+                 cached_results=None,
+                 keep_results=False,
+                 combiner=None):
         """
         This is what is given out by the task queue when some values
         are requested from a pop/peek etc. The values attribute
@@ -486,12 +1079,37 @@ class TaskInput:
         source) to a list of the actual data values
 
         signals is a list of reserved signal keywords for this input
+
+        cache_keys is a list of the result cache key for each value sent
+        to the client, with None for values that cannot be cached. It is
+        None if the task does not have a result cache
+
+        cached_results is a list of the results for inputs that were read
+        but found in the task's result cache, so are not in values
+
+        keep_results is True if the worker should keep the results and
+        only send back references to them. See dipla.shared.objects
+
+        combiner is the instructions of the reduce function the worker
+        applies to the results before sending them back, or None. See
+        Task
         """
         self.task_uid = task_uid
         self.task_instructions = task_instructions
         self.machine_type = machine_type
         self.values = values
         self.signals = signals
+        self.cache_keys = cache_keys
+        self.cached_results = cached_results or []
+        self.keep_results = keep_results
+        self.combiner = combiner
+
+    def is_empty(self):
+        """
+        Returns True if there are no values to send to a client, because
+        all of the inputs that were read had cached results
+        """
+        return all(len(argument) == 0 for argument in self.values)
 
 
 # Abstraction of the information necessary to represent a task
@@ -515,7 +1133,19 @@ class Task:
             complete_check=lambda x: False,
             signals={},
             is_reduce=False,
-            reduce_group_size=2):
+            reduce_group_size=2,
+            max_in_flight=None,
+            max_buffered_output=None,
+            result_cache=None,
+            cache_namespace=None,
+            batch_size=None,
+            priority=0,
+            server_function=None,
+            keep_on_worker=False,
+            requirements=None,
+            combiner=None,
+            reduce_function=None,
+            adaptive_group_size=False):
         """
         Initalises the Task
 
@@ -542,23 +1172,91 @@ class Task:
         in the output of the task as signals and sent to the server for
         processing. The values are the functions that should be used to
         process that inputs from that signal
+         - max_in_flight: The maximum number of results this task can be
+        waiting on at once. No more input is popped for the task while it
+        is at this limit. None means there is no limit
+         - max_buffered_output: The maximum number of values that can be
+        held in task_output. No more input is popped for the task while
+        it holds this many, so this only bounds memory if something
+        consumes the values from task_output. None means there is no
+        limit
+         - result_cache: A ResultCache holding results of this task's
+        function. Inputs with a cached result are not sent to clients.
+        None means results are not cached
+         - cache_namespace: The function_namespace of this task's
+        function, used to create the result cache keys of its inputs
+         - batch_size: The maximum number of inputs sent to a worker in
+        one message, which is used instead of the SchedulingPolicy's batch
+        size. None means the policy's batch size is used
+         - priority: The priority of the task when the TaskQueue uses
+        PriorityMode.planned. Higher priorities are run first
+         - server_function: A function taking one value, that a server
+        task applies to each of its inputs to make its results. None
+        means a server task's inputs are its results
+         - keep_on_worker: If True, the results of a client task are kept
+        by the workers that computed them, and task_output only holds
+        references to them. See dipla.shared.objects
+         - requirements: A dictionary of the resources a worker must have
+        to be sent this task's input, e.g. {'mem_mb': 2000}. See
+        Worker.satisfies. None means any worker can run it
+         - combiner: The instructions of a reduce function, which a client
+        applies to the results of each batch of this task's input before
+        sending them back, so that one value comes back for the batch. The
+        function must be associative, and return the same type of value
+        it reduces. None means every result is sent back
+         - reduce_function: For a reduce task, the function taking a list
+        of values that the task's instructions run. The server uses it to
+        reduce the last few values itself, see dipla.server.reduce_sizer.
+        None means every group is sent to workers
+         - adaptive_group_size: If True, the server changes the group size
+        of a reduce task while it runs, to split the values between the
+        idle workers
         """
         self.uid = uid
         self.instructions = task_instructions
         self.machine_type = machine_type
         self.is_reduce = is_reduce
         self.reduce_group_size = reduce_group_size
+        self.max_in_flight = max_in_flight
+        self.max_buffered_output = max_buffered_output
+        self.result_cache = result_cache
+        self.cache_namespace = cache_namespace
+        self.batch_size = batch_size
+        self.priority = priority
+        self.server_function = server_function
+        self.keep_on_worker = keep_on_worker
+        self.requirements = requirements
+        self.combiner = combiner
+        self.reduce_function = reduce_function
+        self.adaptive_group_size = adaptive_group_size
         self.data_instructions = []
 
         self.open_check = open_check
         self.open = False
         self.complete_check = complete_check
         self.complete = False
+        self.cancelled = False
         self.num_expected_results = 0
         self.num_seen_results = 0
 
         self.signals = signals
         self.task_output = []
+        # Dictionary of the uid of a task reading this one to a function
+        # raising ValueError for a result that task cannot read, which is
+        # called on each result as it is added
+        self.result_checks = {}
+        # The error that made the task fail, see TaskQueue.fail_task
+        self.error = None
+        # For the task of a distributable, the list of ids of the functions
+        # it applies one after the other, and the (function, arguments) it
+        # was created from, so that it can be fused with the task reading
+        # it and made again. See Dipla._fuse_map_chains
+        self.stages = None
+        self.application = None
+        # For a reduce task whose results are partial, e.g. of
+        # Dipla.reduce_mean, the function turning its last result into the
+        # value returned for it
+        self.finish = None
 
     def inputs_exhausted(self):
         for source in self.data_instructions:
@@ -567,9 +1265,13 @@ class Task:
                 return True
         return False
 
-    def add_result(self, result):
+    def add_result(self, result, num_inputs=1):
+        """
+        Adds a result, which was computed from num_inputs inputs. This is
+        more than 1 when the inputs' results were combined, see combiner
+        """
         self.task_output.append(result)
-        self.num_seen_results += 1
+        self.num_seen_results += num_inputs
         # If our inputs have nothing left in them and we've recieved the
         # number of results we expect then this task is complete
         self.complete = (self.inputs_exhausted() and
@@ -577,6 +1279,13 @@ class Task:
         if self.open_check(result):
             self._open_task()
 
+    def cached_result_key(self, values):
+        """
+        Returns the result cache key of an input, or None if the input
+        cannot be cached. See result_cache.make_key
+        """
+        return make_key(self.cache_namespace, values)
+
     def add_data_source(self, source):
         """
         The order in which data sources are added is important because
@@ -588,10 +1297,63 @@ class Task:
     def _open_task(self):
         self.open = True
 
+    def cancel(self):
+        """
+        Marks this task as cancelled and complete, and closes all of its
+        data sources so that no more input is read for it
+        """
+        self.cancelled = True
+        self.complete = True
+        for source in self.data_instructions:
+            source.data_streamer.close()
+
     def inc_expected_results_by(self, count):
         # Increase the number of results we should expect
         self.num_expected_results += count
 
+    def in_flight(self):
+        """
+        Returns the number of results that have been handed out as input
+        but not yet received back
+        """
+        return self.num_expected_results - self.num_seen_results
+
+    def is_output_full(self):
+        """
+        Returns True if task_output holds max_buffered_output values
+        """
+        if self.max_buffered_output is None:
+            return False
+        return len(self.task_output) >= self.max_buffered_output
+
+    def in_flight_capacity(self):
+        """
+        Returns how many more results this task can wait on before it
+        reaches max_in_flight, or infinity if it has no limit
+        """
+        if self.max_in_flight is None:
+            return float('inf')
+        return self.max_in_flight - self.in_flight()
+
+
+class PriorityMode(Enum):
+    """
+    An enum used to choose the order in which the TaskQueue considers its
+    active tasks when popping input
+
+    insertion considers tasks in the order they were pushed.
+    downstream_first prefers the tasks furthest down the task graph, so
+    data flows through a pipeline instead of building up between stages.
+    critical_path prefers the tasks with the longest chain of dependent
+    tasks still to run after them.
+    planned prefers the tasks with the highest priority attribute, which
+    is set by a QueryPlan.
+    """
+    insertion = 1
+    downstream_first = 2
+    critical_path = 3
+    planned = 4
+
 
 class MachineType(Enum):
     """
@@ -4,6 +4,7 @@ intended for this file to contain the code to manage the workers.
 """
 import heapq
 import operator
+import time
 
 from dipla.shared import uid_generator
 
@@ -79,22 +80,41 @@ class WorkerGroup:
 
         raise KeyError("No worker was found with the ID: " + uid)
 
-    def lease_worker(self):
+    def lease_worker(self, uid=None):
         """
         Choose a worker to mark leased so that this will not be used by another
         task at the same time. This must be returned later using return_worker
         so that the worker can be reused.
 
+        Params:
+         - uid: The uid of the available worker to lease. If this is None the
+           highest quality available worker is leased.
+
+        Raises:
+         - IndexError if there are no available workers
+         - KeyError if a uid is given that doesn't match an available worker
+
         Returns:
-         - The highest quality available Worker
+         - The highest quality available Worker, or the requested Worker
         """
         if len(self.ready_workers) == 0:
             raise IndexError("No workers available to lease")
-        chosen = heapq.heappop(self.ready_workers)
+        if uid is None:
+            chosen = heapq.heappop(self.ready_workers)
+        else:
+            chosen = self._pop_ready_worker(uid)
         self.busy_workers[chosen.uid] = chosen
         self.__statistics_updater.decrement('num_idle_workers')
         return chosen
 
+    def _pop_ready_worker(self, uid):
+        for i in range(len(self.ready_workers)):
+            if self.ready_workers[i].uid == uid:
+                chosen = self.ready_workers.pop(i)
+                heapq.heapify(self.ready_workers)
+                return chosen
+        raise KeyError("No available worker was found with the ID: " + uid)
+
     def return_worker(self, uid):
         """
         Indicate that a leased Worker is no longer needed and can now be used
@@ -127,6 +147,13 @@ class WorkerGroup:
         """
         return len(self.ready_workers) > 0
 
+    def available_workers(self):
+        """
+        Returns:
+         - A list of the workers that are available to be leased
+        """
+        return list(self.ready_workers)
+
     def get_worker(self, uid):
         """
         Params:
@@ -187,6 +214,62 @@ class Worker:
         self.correctness_score = 1.0
         self.current_task_instr = None
         self.last_inputs = None
+        # The result cache keys of the inputs last sent to this worker,
+        # or None if their task's results are not cached
+        self.last_cache_keys = None
+        # The platform string the worker gave when requesting binaries
+        self.platform = None
+        # True if binaries have been added to the server since this worker
+        # last received them, and the task names of those binaries
+        self.stale_binaries = False
+        self.pending_binaries = set()
+        # The keys of the broadcast values this worker has been sent
+        self.broadcast_keys = set()
+        # The instructions of every task this worker has been sent input
+        # for, and the uids of the tasks whose results it keeps
+        self.instructions_run = set()
+        self.kept_task_uids = set()
+        # The resources the worker reported, e.g. {'cpu': 4}. See
+        # dipla.client.resources
+        self.resources = {}
+        # The TaskInput the worker is running, which is given to another
+        # worker if this one goes
+        self.in_flight_input = None
+        # The time.monotonic() time the worker last sent a message, and
+        # its round trip time in seconds and bandwidth in bytes per second
+        # as measured by heartbeats, which are None until measured. See
+        # dipla.server.heartbeat
+        self.last_seen = time.monotonic()
+        self.rtt = None
+        self.bandwidth = None
+        self.heartbeats_sent = 0
+        # True once the worker has disconnected or been removed for being
+        # silent
+        self.disconnected = False
+        # The time.perf_counter() time the worker was last sent input, or
+        # None if it has returned the results since
+        self.sent_at = None
+
+    def satisfies(self, requirements):
+        """
+        Params:
+         - requirements: A dictionary of resource name to the least amount
+           of it a task needs, or True for a resource it needs to have
+
+        Returns:
+         - True if the worker reported enough of every required resource.
+           A resource the worker did not report is not enough
+        """
+        for name, required in requirements.items():
+            available = self.resources.get(name)
+            if available is None:
+                return False
+            if isinstance(required, bool):
+                if required and not available:
+                    return False
+            elif available < required:
+                return False
+        return True
 
     def set_quality(self, quality):
         """
@@ -0,0 +1,44 @@
+""" Arguments
+
+Task arguments can refer to values that are not sent with them: broadcast
+values, and parts of files, which are sent either as a reference to a file
+that can be read where the task runs, or as the base64 of their contents.
+This module turns an argument back into the value the task is applied to,
+both in the scripts that workers run and on the server.
+
+The scripts run without the dipla package, so the source of this module is
+copied into them, see script_templates, and it only imports modules from
+the standard library.
+"""
+
+import json
+from base64 import b64decode
+
+
+def load_argument(value, read_broadcast):
+    """
+    Params:
+     - value: The argument as it was sent
+     - read_broadcast: A function taking a dictionary and returning the JSON
+    of the broadcast value it refers to, or None if it does not refer to one
+
+    Returns:
+     - The value the task is applied to
+    """
+    if not isinstance(value, dict):
+        return value
+    serialised = read_broadcast(value)
+    if serialised is not None:
+        return json.loads(serialised)
+    if '__dipla_file_split__' in value:
+        path, offset, length = value['__dipla_file_split__']
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    elif '__dipla_file_bytes__' in value:
+        data = b64decode(value['__dipla_file_bytes__'])
+    else:
+        return value
+    if value['encoding'] is None:
+        return data
+    return data.decode(value['encoding'])
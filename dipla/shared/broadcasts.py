@@ -0,0 +1,37 @@
+""" Broadcasts
+
+Broadcasts are values that are sent to each worker at most once, rather
+than with every input that uses them. Task arguments refer to a broadcast
+with a reference containing the broadcast's key, which is the hash of its
+serialised value.
+"""
+
+import hashlib
+import json
+
+REFERENCE_KEY = '__dipla_broadcast__'
+
+
+def serialise(value):
+    """
+    Returns:
+     - A tuple of the key for the value, and the value serialised as JSON
+    """
+    serialised = json.dumps(value, sort_keys=True)
+    key = hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+    return key, serialised
+
+
+def make_reference(key):
+    return {REFERENCE_KEY: key}
+
+
+def get_reference_key(value):
+    """
+    Returns:
+     - The key of the broadcast that value refers to, or None if value is
+       not a reference to a broadcast
+    """
+    if isinstance(value, dict) and REFERENCE_KEY in value:
+        return value[REFERENCE_KEY]
+    return None
@@ -21,6 +21,14 @@ class ErrorCodes(IntEnum):
     the password on the server
     5 - No Binaries Present. This occurs if the key -> binary map does
     not exist on a machine
+    6 - Jobs Not Supported. This occurs when a job is submitted to a
+    server that only runs its own task graph, rather than a job server
+    7 - Invalid Job. This occurs when a submitted job does not describe a
+    valid task graph
+    8 - Missing Broadcast. This occurs when a client is given input that
+    refers to a broadcast value it has not been sent
+    9 - Missing Object. This occurs when a client is given input that
+    refers to an object it does not hold
     """
     user_id_already_taken = 0
     server_websocket_loop = 1
@@ -28,3 +36,7 @@ class ErrorCodes(IntEnum):
     password_required = 3
     invalid_password = 4
     no_binaries_present = 5
+    jobs_not_supported = 6
+    invalid_job = 7
+    missing_broadcast = 8
+    missing_object = 9
@@ -0,0 +1,81 @@
+""" Worker-resident objects
+
+The results of a task that keeps its results on workers are stored by the
+worker that computed them, and the server is only sent a reference to each
+one, holding the object's id and the size of its serialised value. The
+server adds the uid of the worker holding the object to each reference.
+
+A task input that contains references is sent preferably to the worker
+holding them. Otherwise the values are fetched from the workers holding
+them first, as they are for server tasks such as the one collecting the
+result of Dipla.get.
+"""
+
+import json
+import uuid
+
+REFERENCE_KEY = '__dipla_object__'
+
+
+def serialise(value):
+    """
+    Returns:
+     - A tuple of a new id for the value, and the value serialised as JSON
+    """
+    return uuid.uuid4().hex, json.dumps(value)
+
+
+def make_reference(object_id, size, worker_uid=None):
+    reference = {REFERENCE_KEY: object_id, 'size': size}
+    if worker_uid is not None:
+        reference['worker'] = worker_uid
+    return reference
+
+
+def get_object_id(value):
+    """
+    Returns:
+     - The id of the object that value refers to, or None if value is not
+       a reference to an object
+    """
+    if isinstance(value, dict) and REFERENCE_KEY in value:
+        return value[REFERENCE_KEY]
+    return None
+
+
+def set_holder(value, worker_uid):
+    """
+    Returns:
+     - The reference with the uid of the worker holding the object, or
+       value unchanged if it is not a reference
+    """
+    if get_object_id(value) is None:
+        return value
+    return make_reference(value[REFERENCE_KEY], value['size'], worker_uid)
+
+
+def find_references(value):
+    """
+    Returns:
+     - A list of the references in value, which is searched through lists
+       as reduce tasks are given their values in a list
+    """
+    if get_object_id(value) is not None:
+        return [value]
+    if isinstance(value, list):
+        return [reference for item in value
+                for reference in find_references(item)]
+    return []
+
+
+def replace_references(value, replace):
+    """
+    Returns:
+     - A copy of value where each reference is swapped for the result of
+       calling replace with it
+    """
+    if get_object_id(value) is not None:
+        return replace(value)
+    if isinstance(value, list):
+        return [replace_references(item, replace) for item in value]
+    return value
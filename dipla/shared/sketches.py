@@ -0,0 +1,467 @@
+""" Mergeable sketches
+
+A sketch is a small, fixed size summary of a large number of items, that
+answers one question about them approximately, within a bounded error. Two
+sketches of the same kind can be merged into one summarising the items of
+both, so a reduce can combine the sketches of each part of its input
+instead of the items themselves.
+
+Each sketch has a compact binary encoding, which encode turns into a string
+so that it can be passed between the server and workers as JSON. Workers
+can build sketches in distributables and merge them in reduce functions by
+importing this module, and the server can build and merge them itself, see
+Dipla.reduce_top_k and Dipla.merge_sketches.
+
+Items are hashed through their JSON serialisation, so any JSON value can be
+counted by CountMin and HyperLogLog, and the same item gives the same hash
+on every machine. TopK keys its counters by item, so its items must also be
+hashable, e.g. strings or numbers.
+"""
+
+import base64
+import hashlib
+import heapq
+import json
+import math
+import random
+import struct
+import sys
+from abc import ABC, abstractmethod
+from array import array
+
+TOP_K_TAG = 1
+COUNT_MIN_TAG = 2
+HYPER_LOG_LOG_TAG = 3
+RESERVOIR_TAG = 4
+
+
+# This is an interface that all sketches must implement.
+class Sketch(ABC):
+
+    # The byte at the start of the encodings of this kind of sketch
+    tag = None
+
+    @abstractmethod
+    def add(self, item, count=1):
+        pass
+
+    @abstractmethod
+    def merge(self, other):
+        """
+        Adds the items summarised by another sketch of the same kind to
+        this one
+
+        Returns:
+         - This sketch
+        """
+        pass
+
+    # Encode the sketch, starting with its tag, so that from_bytes can
+    # decode it
+    @abstractmethod
+    def to_bytes(self):
+        pass
+
+    def update(self, items):
+        """
+        Adds each of the items. If items is a dictionary, each key is added
+        as many times as its value, for the sketches that count items
+        """
+        if isinstance(items, dict):
+            for item, count in items.items():
+                self.add(item, count)
+        else:
+            for item in items:
+                self.add(item)
+        return self
+
+    def encode(self):
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    def _check_kind(self, other):
+        if type(other) is not type(self):
+            raise ValueError("Only sketches of the same kind can be merged")
+
+
+class TopK(Sketch):
+
+    tag = TOP_K_TAG
+
+    def __init__(self, k, counters=None):
+        """
+        Finds the k most frequent items with the space-saving algorithm,
+        which counts at most counters items at once. When a new item
+        arrives while every counter is in use, it takes over the counter of
+        the least frequent item, and its count starts from that item's.
+        Each count is therefore an overestimate, by at most the total
+        number of items added divided by counters
+
+        Params:
+         - k: The number of items returned by top
+         - counters: The number of items counted, 4 * k by default. More
+        counters give smaller errors
+        """
+        if counters is None:
+            counters = 4 * k
+        if k < 1 or counters < k:
+            raise ValueError("There must be at least k counters, and k > 0")
+        self.k = k
+        self.counters = counters
+        self.total = 0
+        # Dictionaries of item to its estimated count, and to the most
+        # the estimate may be over by
+        self._counts = {}
+        self._errors = {}
+
+    def add(self, item, count=1):
+        self.total += count
+        if item in self._counts:
+            self._counts[item] += count
+        elif len(self._counts) < self.counters:
+            self._counts[item] = count
+            self._errors[item] = 0
+        else:
+            smallest = min(self._counts, key=self._counts.get)
+            floor = self._counts.pop(smallest)
+            del self._errors[smallest]
+            self._counts[item] = floor + count
+            self._errors[item] = floor
+
+    def merge(self, other):
+        self._check_kind(other)
+        # An item missing from a full sketch may have been counted up to
+        # its smallest count before being evicted
+        own_floor = self._floor()
+        other_floor = other._floor()
+        counts = {}
+        errors = {}
+        for item in set(self._counts) | set(other._counts):
+            counts[item] = self._counts.get(item, own_floor) + \
+                other._counts.get(item, other_floor)
+            errors[item] = self._errors.get(item, own_floor) + \
+                other._errors.get(item, other_floor)
+        kept = heapq.nlargest(self.counters, counts, key=counts.get)
+        self._counts = {item: counts[item] for item in kept}
+        self._errors = {item: errors[item] for item in kept}
+        self.total += other.total
+        return self
+
+    def top(self):
+        """
+        Returns:
+         - A list of [item, estimated count] pairs for the k items with
+           the largest estimated counts, largest first
+        """
+        items = heapq.nlargest(self.k, self._counts, key=self._counts.get)
+        return [[item, self._counts[item]] for item in items]
+
+    def estimate(self, item):
+        """
+        Returns:
+         - An upper bound on the number of times item was added
+        """
+        return self._counts.get(item, self._floor())
+
+    def error(self, item):
+        """
+        Returns:
+         - The most estimate(item) may be over by
+        """
+        return self._errors.get(item, self._floor())
+
+    def _floor(self):
+        if len(self._counts) < self.counters:
+            return 0
+        return min(self._counts.values())
+
+    def to_bytes(self):
+        parts = [struct.pack('<BIIQI', self.tag, self.k, self.counters,
+                             self.total, len(self._counts))]
+        for item, count in self._counts.items():
+            data = _item_bytes(item)
+            parts.append(struct.pack('<QQI', count, self._errors[item],
+                                     len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, k, counters, total, num_items = struct.unpack_from('<BIIQI', data)
+        sketch = cls(k, counters)
+        sketch.total = total
+        offset = struct.calcsize('<BIIQI')
+        for _ in range(num_items):
+            count, error, size = struct.unpack_from('<QQI', data, offset)
+            offset += struct.calcsize('<QQI')
+            item = json.loads(data[offset:offset + size].decode('utf-8'))
+            offset += size
+            sketch._counts[item] = count
+            sketch._errors[item] = error
+        return sketch
+
+
+class CountMin(Sketch):
+
+    tag = COUNT_MIN_TAG
+
+    def __init__(self, width=1024, depth=4):
+        """
+        Estimates how many times any item was added, from depth rows of
+        width counters. Each item adds to one counter in every row, chosen
+        by its hash, and its estimate is the smallest of those counters.
+        Estimates are never under, and are over by more than
+        e / width * total with a probability of at most e ** -depth
+
+        Params:
+         - width: The number of counters in each row
+         - depth: The number of rows
+        """
+        if width < 1 or depth < 1:
+            raise ValueError("The width and depth must be at least 1")
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._table = array('Q', [0]) * (width * depth)
+
+    def add(self, item, count=1):
+        self.total += count
+        for position in self._positions(item):
+            self._table[position] += count
+
+    def estimate(self, item):
+        return min(self._table[position]
+                   for position in self._positions(item))
+
+    def merge(self, other):
+        self._check_kind(other)
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError(
+                "Only count-min sketches of the same size can be merged")
+        for position, count in enumerate(other._table):
+            self._table[position] += count
+        self.total += other.total
+        return self
+
+    def _positions(self, item):
+        # Each row's counter is chosen by combining two hashes of the item
+        digest = _digest(item, 16)
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def to_bytes(self):
+        header = struct.pack('<BIIQ', self.tag, self.width, self.depth,
+                             self.total)
+        return header + _to_little_endian(self._table).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, width, depth, total = struct.unpack_from('<BIIQ', data)
+        sketch = cls(width, depth)
+        sketch.total = total
+        table = array('Q')
+        table.frombytes(data[struct.calcsize('<BIIQ'):])
+        sketch._table = _to_little_endian(table)
+        return sketch
+
+
+class HyperLogLog(Sketch):
+
+    tag = HYPER_LOG_LOG_TAG
+
+    def __init__(self, precision=12):
+        """
+        Estimates the number of distinct items added, using 2 ** precision
+        one byte registers. The relative standard error of the estimate is
+        about 1.04 / sqrt(2 ** precision), e.g. 1.6% for the default
+
+        Params:
+         - precision: Between 4 and 16
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("The precision must be between 4 and 16")
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, item, count=1):
+        # Repeats of an item never change the estimate, so count is only
+        # taken so that dictionaries of counts can be given to update
+        hashed = int.from_bytes(_digest(item, 8), 'little')
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def count(self):
+        """
+        Returns:
+         - The estimated number of distinct items added
+        """
+        num_registers = len(self._registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            num_registers, 0.7213 / (1 + 1.079 / num_registers))
+        estimate = alpha * num_registers ** 2 / sum(
+            2.0 ** -rank for rank in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * num_registers and zeros:
+            # Small counts are more accurate from the empty registers
+            estimate = num_registers * math.log(num_registers / zeros)
+        return round(estimate)
+
+    def merge(self, other):
+        self._check_kind(other)
+        if other.precision != self.precision:
+            raise ValueError(
+                "Only HyperLogLogs of the same precision can be merged")
+        self._registers = bytearray(
+            max(pair) for pair in zip(self._registers, other._registers))
+        return self
+
+    def to_bytes(self):
+        return struct.pack('<BB', self.tag, self.precision) + \
+            bytes(self._registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, precision = struct.unpack_from('<BB', data)
+        sketch = cls(precision)
+        sketch._registers = bytearray(data[struct.calcsize('<BB'):])
+        return sketch
+
+
+class Reservoir(Sketch):
+
+    tag = RESERVOIR_TAG
+
+    def __init__(self, size=100, seed=None):
+        """
+        Keeps a uniform random sample of up to size of the items added,
+        without replacement. Merging two reservoirs gives a uniform sample
+        of the items added to either
+
+        Params:
+         - size: The most items kept
+         - seed: Seeds the random choices, for repeatable samples
+        """
+        if size < 1:
+            raise ValueError("The size must be at least 1")
+        self.size = size
+        self.seen = 0
+        self.sample = []
+        self._random = random.Random(seed)
+
+    def add(self, item, count=1):
+        for _ in range(count):
+            self.seen += 1
+            if len(self.sample) < self.size:
+                self.sample.append(item)
+            else:
+                index = self._random.randrange(self.seen)
+                if index < self.size:
+                    self.sample[index] = item
+
+    def update(self, items):
+        # A dictionary's keys are sampled, rather than counted
+        for item in items:
+            self.add(item)
+        return self
+
+    def merge(self, other):
+        self._check_kind(other)
+        if other.size != self.size:
+            raise ValueError(
+                "Only reservoirs of the same size can be merged")
+        # Each item of the merged sample comes from one of the two samples
+        # in proportion to the number of items each has seen
+        remaining = [self.seen, other.seen]
+        taken = [0, 0]
+        for _ in range(min(self.size, self.seen + other.seen)):
+            side = 0
+            if self._random.randrange(remaining[0] + remaining[1]) >= \
+                    remaining[0]:
+                side = 1
+            remaining[side] -= 1
+            taken[side] += 1
+        self.sample = self._random.sample(self.sample, taken[0]) + \
+            self._random.sample(other.sample, taken[1])
+        self._random.shuffle(self.sample)
+        self.seen += other.seen
+        return self
+
+    def to_bytes(self):
+        return struct.pack('<BIQ', self.tag, self.size, self.seen) + \
+            json.dumps(self.sample, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, size, seen = struct.unpack_from('<BIQ', data)
+        sketch = cls(size)
+        sketch.seen = seen
+        sketch.sample = json.loads(
+            data[struct.calcsize('<BIQ'):].decode('utf-8'))
+        return sketch
+
+
+_SKETCH_TYPES = {
+    sketch_type.tag: sketch_type
+    for sketch_type in (TopK, CountMin, HyperLogLog, Reservoir)
+}
+
+
+def from_bytes(data):
+    """
+    Returns:
+     - The sketch encoded in data, by the to_bytes method of any kind of
+       sketch
+
+    Raises:
+     - ValueError if data does not start with the tag of a kind of sketch
+    """
+    if not data or data[0] not in _SKETCH_TYPES:
+        raise ValueError("Data is not an encoded sketch")
+    return _SKETCH_TYPES[data[0]].from_bytes(data)
+
+
+def decode(text):
+    """
+    Returns:
+     - The sketch encoded in text, by the encode method of any kind of
+       sketch
+    """
+    return from_bytes(base64.b64decode(text))
+
+
+def merge_encoded(encoded_sketches):
+    """
+    Merges sketches of the same kind given as encoded strings, e.g. the
+    values given to a reduce function
+
+    Returns:
+     - The merged sketch, encoded as a string
+    """
+    merged = None
+    for text in encoded_sketches:
+        sketch = decode(text)
+        merged = sketch if merged is None else merged.merge(sketch)
+    if merged is None:
+        raise ValueError("There are no sketches to merge")
+    return merged.encode()
+
+
+def _item_bytes(item):
+    return json.dumps(item, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _digest(item, size):
+    return hashlib.sha256(_item_bytes(item)).digest()[:size]
+
+
+def _to_little_endian(table):
+    # Encoded counters are always little endian, whatever the machine
+    if sys.byteorder == 'big':
+        table = array('Q', table)
+        table.byteswap()
+    return table
@@ -1,3 +1,7 @@
+# The weight given to the newest measurement in moving averages
+SMOOTHING = 0.3
+
+
 class StatisticsUpdater:
     """
     A class to update and modify statistics.
@@ -54,3 +58,15 @@ def check_statistic_exists(statistic, statistics):
     if statistic not in statistics:
         error_message = "Statistic {} does not exist".format(statistic)
         raise StatisticsError(error_message)
+
+
+def moving_average(average, value):
+    """
+    Returns:
+     - The exponential moving average after a new measurement, value, is
+       added to average, the moving average so far. An average of None
+       means nothing has been measured yet, so value is returned
+    """
+    if average is None:
+        return value
+    return SMOOTHING * value + (1 - SMOOTHING) * average
@@ -6,6 +6,7 @@ import urllib
 sys.path.append(path.abspath('../dipla'))
 
 from dipla.api import Dipla
+from dipla.shared.sketches import decode
 
 # This program finds the word with the most vowels from the opening of the Communist Manifesto
 
@@ -37,40 +38,26 @@ with open('examples/mapreduce/stopwords.txt', 'r') as f:
 @Dipla.distributable()
 def tokenise(doc):
     import re
+    from dipla.shared.sketches import TopK
     words = re.split(r"[^a-z']", doc.lower())
-    d = {}
+    # The 100 most frequent words are kept, with bounded error, in a
+    # sketch that stays the same size however many words it has seen
+    top_words = TopK(100)
     for word in words:
-        if word == '':
-            continue
-        if word in d:
-            d[word] += 1
-        else:
-            d[word] = 1
-    return d
+        if word != '':
+            top_words.add(word)
+    return top_words.encode()
 
-@Dipla.reduce_distributable(n=2)
-def combine_dicts(d):
-    max_dict_size = 100
-    comb = {}
-    for e in d:
-        for w in e:
-            if w in comb:
-                comb[w] += e[w]
-            else:
-                comb[w] = e[w]
-    if len(comb) > max_dict_size:
-        sorted_keys = sorted(comb, key = lambda x: comb[x], reverse=True)
-        small_comb = {}
-        for k in sorted_keys[:max_dict_size]:
-            small_comb[k] = comb[k]
-        return small_comb
-    return comb
+@Dipla.reduce_distributable(n=2, combine=True)
+def combine_sketches(sketches):
+    from dipla.shared.sketches import merge_encoded
+    return merge_encoded(sketches)
 
 start_time = time()
 
 d = Dipla.apply_distributable(tokenise, splits)
-e = Dipla.apply_distributable(combine_dicts, d)
-f = e.get()
+e = Dipla.apply_distributable(combine_sketches, d)
+f = dict(decode(e.get()).top())
 end_time = time()
 print('Distributed work took {} seconds'.format(end_time - start_time))
 
@@ -1,9 +1,15 @@
 import unittest
 from unittest.mock import call, Mock
 
-from dipla.api import Dipla, UnsupportedInput
-from dipla.server.task_queue import Task
-from dipla.shared import uid_generator
+from dipla.api import Dipla, ResultStream, Session, UnsupportedInput
+from dipla.server.result_verifier import ResultVerifier
+from dipla.server.task_queue import Task, TaskQueue, PriorityMode
+from dipla.server.task_queue import DataSource, MachineType
+from dipla.shared import uid_generator, sketches
+
+# DiplaAPITest replaces generate_uid with a Mock, which tests using a real
+# TaskQueue need to undo
+real_generate_uid = uid_generator.generate_uid
 
 
 class DiplaAPITest(unittest.TestCase):
@@ -230,5 +236,420 @@ class DiplaAPITest(unittest.TestCase):
         promise = result1.distribute(add, result2)
         self.assertIsNotNone(promise.task_uid)
 
+    def test_apply_distributable_with_broadcast_argument(self):
+        @Dipla.distributable()
+        def func(input_value, table):
+            return table[input_value]
+
+        table = Dipla.broadcast({"a": 1})
+        promised = Dipla.apply_distributable(func, ["a", "a"], table)
+        self.assertIsNotNone(promised.task_uid)
+        self.assertEqual({table.key: table.serialised}, Dipla._broadcasts)
+        self.mock_task_queue.push_task.assert_called_with(
+            DiplaAPITest.TaskWithNSources(2))
+
+    def test_apply_distributable_rejects_only_broadcast_arguments(self):
+        @Dipla.distributable()
+        def func(table):
+            return table
+
+        with self.assertRaises(UnsupportedInput):
+            Dipla.apply_distributable(func, Dipla.broadcast([1, 2]))
+
+    def tearDown(self):
+        Dipla._task_creators = dict()
+        Dipla._broadcasts = dict()
+
+
+class MapFusionTest(unittest.TestCase):
+
+    def setUp(self):
+        Dipla.task_queue = TaskQueue()
+        Dipla.result_verifier = ResultVerifier()
+        # Functions are registered by id, which can be reused by a reduce
+        # function from an earlier test
+        Dipla._reduce_task_group_sizes = dict()
+        uid_generator.generate_uid = real_generate_uid
+
+        @Dipla.distributable()
+        def double(value):
+            return value * 2
+
+        @Dipla.distributable()
+        def increment(value):
+            return value + 1
+
+        self.double = double
+        self.increment = increment
+
+    def test_chained_distributables_are_fused(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        incremented = doubled.distribute(self.increment)
+        get_task = Dipla._create_get_task(incremented)
+
+        self.assertEqual({incremented.task_uid, get_task.uid},
+                         set(Dipla.task_queue.get_task_ids()))
+        task = Dipla.task_queue.get_task(incremented.task_uid)
+        self.assertEqual("double+increment", task.instructions)
+        self.assertEqual(
+            [[1, 2]], Dipla.task_queue.pop_task_input(batch_size=2).values)
+        self.assertEqual(["double+increment"],
+                         [name for name, _ in Dipla._encode_pipelines(
+                             Dipla._fused_pipelines)])
+
+    def test_values_read_by_two_tasks_are_not_fused(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        incremented = doubled.distribute(self.increment)
+        doubled.distribute(self.increment)
+        Dipla._create_get_task(incremented)
+
+        self.assertIn(doubled.task_uid, Dipla.task_queue.get_task_ids())
+        self.assertEqual(
+            "increment",
+            Dipla.task_queue.get_task(incremented.task_uid).instructions)
+
+    def test_tasks_of_functions_kept_on_worker_keep_their_results(self):
+        @Dipla.distributable(keep_on_worker=True)
+        def square(value):
+            return value * value
+
+        squared = Dipla.apply_distributable(square, [1, 2])
+        doubled = squared.distribute(self.double)
+        self.assertTrue(
+            Dipla.task_queue.get_task(squared.task_uid).keep_on_worker)
+        self.assertFalse(
+            Dipla.task_queue.get_task(doubled.task_uid).keep_on_worker)
+        with self.assertRaises(ValueError):
+            Dipla.distributable(cache=True, keep_on_worker=True)
+
+    def test_tasks_are_given_the_requirements_of_their_function(self):
+        @Dipla.distributable(mem_mb=2000, numpy=True)
+        def invert(value):
+            return value
+
+        inverted = Dipla.apply_distributable(invert, [1, 2])
+        doubled = inverted.distribute(self.double)
+        Dipla._create_get_task(doubled)
+        self.assertEqual(
+            {"mem_mb": 2000, "numpy": True},
+            Dipla.task_queue.get_task(inverted.task_uid).requirements)
+        # Tasks with different requirements are not fused
+        self.assertIsNone(
+            Dipla.task_queue.get_task(doubled.task_uid).requirements)
+
+    def test_combining_reduce_is_run_by_the_task_it_reads(self):
+        @Dipla.reduce_distributable(n=2, combine=True)
+        def add(values):
+            return sum(values)
+
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        incremented = doubled.distribute(self.increment)
+        Dipla._create_get_task(incremented.distribute(add))
+        task = Dipla.task_queue.get_task(incremented.task_uid)
+        self.assertEqual("double+increment", task.instructions)
+        self.assertEqual("add", task.combiner)
+
+        # Another function reading the values would see them combined
+        with self.assertRaises(ValueError):
+            incremented.distribute(add)
+
+    def test_reduce_tasks_can_be_finished_on_the_server(self):
+        @Dipla.reduce_distributable()
+        def add(values):
+            return sum(values)
+
+        @Dipla.reduce_distributable(n=4)
+        def largest(values):
+            return max(values)
+
+        added = Dipla.task_queue.get_task(
+            Dipla.apply_distributable(add, [1, 2]).task_uid)
+        self.assertIs(add, added.reduce_function)
+        self.assertTrue(added.adaptive_group_size)
+        self.assertFalse(Dipla.task_queue.get_task(Dipla.apply_distributable(
+            largest, [1, 2]).task_uid).adaptive_group_size)
+
+    def test_fused_task_is_made_again_when_needed(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        Dipla._create_get_task(doubled.distribute(self.increment))
+        self.assertNotIn(doubled.task_uid, Dipla.task_queue.get_task_ids())
+
+        doubled.distribute(self.increment)
+        task = Dipla.task_queue.get_task(doubled.task_uid)
+        self.assertEqual("double", task.instructions)
+
+    def test_fused_promise_can_be_streamed(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        Dipla._create_get_task(doubled.distribute(self.increment))
+
+        self.assertIsInstance(Dipla.stream(doubled), ResultStream)
+        self.assertIn(doubled.task_uid, Dipla.task_queue.get_task_ids())
+
+    def test_fused_promise_can_be_limited(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        Dipla._create_get_task(doubled.distribute(self.increment))
+
+        Dipla.limit_in_flight(doubled, 3)
+        self.assertEqual(
+            3, Dipla.task_queue.get_task(doubled.task_uid).max_in_flight)
+
+    def test_promises_got_together_are_not_fused(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        incremented = doubled.distribute(self.increment)
+        get_tasks = Dipla._create_get_tasks([doubled, incremented])
+
+        self.assertEqual(
+            "increment",
+            Dipla.task_queue.get_task(incremented.task_uid).instructions)
+        self.assertEqual(
+            [[doubled.task_uid], [incremented.task_uid]],
+            [Dipla.task_queue.get_dependency_ids(get_task.uid)
+             for get_task in get_tasks])
+        # The shared task is only run once
+        self.assertEqual([[1]], Dipla.task_queue.pop_task_input().values)
+        self.assertEqual(doubled.task_uid,
+                         Dipla.task_queue.pop_task_input().task_uid)
+        self.assertFalse(Dipla.task_queue.has_next_input())
+
+    def test_get_all_in_session_waits_for_every_promise(self):
+        session = Mock()
+        Dipla._session = session
+        try:
+            doubled = Dipla.apply_distributable(self.double, [1, 2])
+            incremented = doubled.distribute(self.increment)
+            values = Dipla.get_all([doubled, incremented])
+        finally:
+            Dipla._session = None
+        self.assertEqual([[], []], values)
+        self.assertEqual(2, session.run_until_complete.call_count)
+
+    def test_fused_tasks_can_be_run_locally(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        Dipla._create_get_task(doubled.distribute(self.increment))
+        Dipla._local_execution = {'max_workers': 1, 'margin': 2}
+        try:
+            executor = Dipla._create_local_executor()
+        finally:
+            Dipla._local_execution = None
+        self.assertTrue(executor.can_run("double+increment"))
+        self.assertTrue(executor.can_run("double"))
+
+    def test_data_source_function_is_run_by_server_task(self):
+        @Dipla.data_source
+        def parse(value):
+            return int(value)
+
+        promise = Dipla.read_data_source(parse, ["1", "2"])
+        task = Dipla.task_queue.get_task(promise.task_uid)
+        self.assertEqual(parse.parse_function, task.server_function)
+        self.assertEqual(
+            [["1"]], Dipla.task_queue.pop_task_input().values)
+
+    def test_get_applies_plan(self):
+        @Dipla.reduce_distributable()
+        def total(values):
+            return sum(values)
+
+        doubled = Dipla.apply_distributable(self.double, list(range(900)))
+        Dipla.apply_distributable(self.increment, [1])
+        summed = Dipla.apply_distributable(total, doubled)
+        plan = Dipla.plan(summed)
+        self.assertEqual(900, plan.get_node(summed.task_uid).estimated_inputs)
+        self.assertEqual(1, len(plan.held_uids))
+
+        Dipla._create_get_task(summed)
+        self.assertEqual(
+            30, Dipla.task_queue.get_task(summed.task_uid).reduce_group_size)
+        self.assertEqual(
+            14, Dipla.task_queue.get_task(doubled.task_uid).batch_size)
+        self.assertEqual(PriorityMode.planned,
+                         Dipla.task_queue._priority_mode)
+
+    def get_builtin_reduce(self, reduced, results):
+        """
+        Gives the promise's task the results, and runs the built-in reducer
+        reading them as the server would
+        """
+        get_task = Dipla._create_get_task(reduced)
+        reduce_task = Dipla.task_queue.get_task(reduced.task_uid)
+        source_uid = Dipla.task_queue.get_dependency_ids(reduced.task_uid)[0]
+        Dipla.task_queue.pop_task_input(
+            task_uid=source_uid, batch_size=len(results))
+        for result in results:
+            Dipla.task_queue.add_result(source_uid, result)
+        task_input = Dipla.task_queue.pop_task_input(
+            task_uid=reduced.task_uid)
+        partial = reduce_task.server_function(task_input.values[0][0])
+        Dipla.task_queue.add_result(reduced.task_uid, partial)
+        task_input = Dipla.task_queue.pop_task_input(task_uid=get_task.uid)
+        Dipla.task_queue.add_result(get_task.uid, task_input.values[0][0])
+        return Dipla._get_value(reduced, get_task)
+
+    def test_builtin_reducers_run_on_the_server(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2, 3])
+        mean = Dipla.reduce_mean(doubled)
+
+        reduce_task = Dipla.task_queue.get_task(mean.task_uid)
+        self.assertEqual(MachineType.server, reduce_task.machine_type)
+        self.assertTrue(reduce_task.is_reduce)
+        self.assertEqual(4, self.get_builtin_reduce(mean, [2, 4, 6]))
+
+    def test_sketch_reducers_return_their_summaries(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2, 2, 2])
+        self.assertEqual([[4, 3]], self.get_builtin_reduce(
+            Dipla.reduce_top_k(doubled, 1), [2, 4, 4, 4]))
+
+        doubled = Dipla.apply_distributable(self.double, [1, 2])
+        sketch = sketches.HyperLogLog().update(["a", "b"])
+        merged = self.get_builtin_reduce(
+            Dipla.merge_sketches(doubled),
+            [sketch.encode(), sketches.HyperLogLog().update(["c"]).encode()])
+        self.assertEqual(3, merged.count())
+
+    def test_values_are_reduced_by_key_in_partitions(self):
+        @Dipla.reduce_distributable()
+        def add(values):
+            return sum(values)
+
+        pairs = Dipla.apply_distributable(self.double, [1, 2])
+        summed = pairs.reduce_by_key(add, partitions=4)
+        get_task = Dipla._create_get_task(summed)
+        partition_uid = Dipla.task_queue.get_dependency_ids(
+            summed.task_uid)[0]
+        partition_task = Dipla.task_queue.get_task(partition_uid)
+        self.assertEqual("add.by_key", partition_task.instructions)
+        self.assertEqual(1, partition_task.batch_size)
+
+        Dipla.task_queue.pop_task_input(
+            task_uid=pairs.task_uid, batch_size=2)
+        Dipla.task_queue.add_result(pairs.task_uid, [["a", 1], ["b", 2]])
+        self.assertFalse(Dipla.task_queue.has_next_input())
+        Dipla.task_queue.add_result(pairs.task_uid, {"a": 3})
+        # Each partition is a separate input, reduced as a worker would
+        while Dipla.task_queue.has_next_input(MachineType.client):
+            task_input = Dipla.task_queue.pop_task_input(
+                task_uid=partition_uid)
+            Dipla.task_queue.add_result(
+                partition_uid,
+                [[key, add(values)]
+                 for key, values in task_input.values[0][0]])
+        for task_uid in [summed.task_uid, get_task.uid]:
+            while task_uid in Dipla.task_queue.ready_task_uids():
+                task_input = Dipla.task_queue.pop_task_input(
+                    task_uid=task_uid)
+                for value in task_input.values[0]:
+                    Dipla.task_queue.add_result(task_uid, value)
+        self.assertEqual([["a", 4], ["b", 2]],
+                         sorted(Dipla._get_value(summed, get_task)))
+        self.assertIn("add.by_key", dict(Dipla._encode_keyed_reducers(
+            Dipla._keyed_reducers)))
+
+    def test_session_sends_binaries_of_reducers_applied_by_key(self):
+        session = Session('localhost', 8765)
+        session.server = Mock(local_executor=None)
+        session._sent_function_ids = set(Dipla._task_functions)
+
+        @Dipla.reduce_distributable()
+        def add(values):
+            return sum(values)
+
+        pairs = Dipla.apply_distributable(self.double, [1, 2])
+        pairs.reduce_by_key(add)
+        session.prepare()
+        sent_names = [name for args, _ in
+                      session.server.add_binaries.call_args_list
+                      for name, _ in args[1]]
+        self.assertIn("add.by_key", sent_names)
+
+        session.server.add_binaries.reset_mock()
+        session.prepare()
+        self.assertFalse(session.server.add_binaries.called)
+
+    def test_async_sources_wake_the_server_reading_them(self):
+        doubled = Dipla.apply_distributable(self.double, EmptyAsyncValues())
+        stream = Dipla.task_queue.get_task(
+            doubled.task_uid).data_instructions[0].data_streamer.stream
+
+        server = Dipla._create_server()
+        self.assertEqual(server.scheduler.wake, stream.on_available)
+
+    def test_histogram_edges_must_increase(self):
+        doubled = Dipla.apply_distributable(self.double, [1, 2, 3])
+        with self.assertRaises(ValueError):
+            Dipla.reduce_histogram(doubled, [4, 2])
+
     def tearDown(self):
         Dipla._task_creators = dict()
+        Dipla._fused_tasks = dict()
+        Dipla._fused_pipelines = dict()
+        Dipla._combining_functions = set()
+        Dipla._priority_mode_chosen = False
+        Dipla._keyed_reducers = dict()
+
+
+class EmptyAsyncValues:
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class IterateTest(unittest.TestCase):
+
+    def setUp(self):
+        Dipla.task_queue = TaskQueue()
+        # Rounds are run in an open session, which is not needed when the
+        # steps do not send any work
+        Dipla._session = Mock()
+        self.stats = dict(Dipla._stats)
+
+    def test_iterate_runs_until_converged(self):
+        states = []
+
+        def halve(state):
+            states.append(state)
+            return state // 2
+
+        result = Dipla.iterate(
+            halve, 40, until=lambda old, new: old - new < 2)
+        self.assertEqual(1, result)
+        self.assertEqual([40, 20, 10, 5, 2], states)
+        self.assertEqual(5, Dipla._stats["num_rounds"])
+
+    def test_iterate_stops_after_max_rounds(self):
+        result = Dipla.iterate(lambda state: state + 1, 0, max_rounds=3)
+        self.assertEqual(3, result)
+
+    def test_finished_tasks_of_a_round_are_removed(self):
+        existing = self.push_task("existing")
+        Dipla.task_queue.cancel_task("existing")
+        existing_uids = set(Dipla.task_queue.get_task_ids())
+        self.push_task("finished", existing)
+        self.push_task("read", self.push_task("read_by_running"))
+        Dipla.task_queue.cancel_task("finished")
+        # read_by_running has finished, but read still has its result to
+        # run on
+        Dipla.task_queue.pop_task_input(task_uid="read_by_running")
+        Dipla.task_queue.add_result("read_by_running", 2)
+        Dipla.task_queue.cancel_task("read_by_running")
+
+        Dipla._remove_finished_tasks(existing_uids, set())
+        self.assertEqual({"existing", "read", "read_by_running"},
+                         set(Dipla.task_queue.get_task_ids()))
+
+    def push_task(self, uid, source_task=None):
+        task = Task(uid, uid, MachineType.client)
+        if source_task is None:
+            task.add_data_source(DataSource.create_source_from_iterable(
+                [1], uid + "-source"))
+        else:
+            task.add_data_source(DataSource.create_source_from_task(
+                source_task, uid + "-source"))
+        Dipla.task_queue.push_task(task)
+        return task
+
+    def tearDown(self):
+        Dipla._session = None
+        Dipla._stats.update(self.stats)
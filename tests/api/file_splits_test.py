@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+from base64 import b64decode
+from dipla.api_support import file_splits
+
+
+class FileSplitsTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b"aaa\nbb\ncccc\nd\n")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_splits_end_at_the_end_of_a_record(self):
+        splits = file_splits.find_splits(self.path, 5)
+        self.assertEqual([(0, 7), (7, 5), (12, 2)], splits)
+
+    def test_last_split_takes_the_rest_of_the_file(self):
+        with open(self.path, 'ab') as f:
+            f.write(b"no newline")
+        splits = file_splits.find_splits(self.path, 13)
+        self.assertEqual([(0, 14), (14, 10)], splits)
+
+    def test_fixed_width_records(self):
+        splits = file_splits.find_splits(self.path, 5, record_size=2)
+        self.assertEqual([(0, 4), (4, 4), (8, 4), (12, 2)], splits)
+
+    def test_empty_file_has_no_splits(self):
+        with open(self.path, 'wb'):
+            pass
+        self.assertEqual([], file_splits.find_splits(self.path, 5))
+
+    def test_split_references_and_contents(self):
+        splits = [(0, 7), (7, 7)]
+        references = list(file_splits.split_references(self.path, splits))
+        self.assertEqual([self.path, 7, 7],
+                         references[1]['__dipla_file_split__'])
+
+        contents = list(file_splits.split_contents(self.path, splits))
+        self.assertEqual(
+            b"cccc\nd\n", b64decode(contents[1]['__dipla_file_bytes__']))
+        self.assertEqual('utf-8', contents[1]['encoding'])
@@ -1,10 +1,14 @@
 import os
 from unittest import TestCase
 from unittest.mock import MagicMock
+from dipla.client.client import Client
 from dipla.client.command_line_binary_runner import CommandLineBinaryRunner
 from dipla.client.client_services import BinaryRunnerService
 from dipla.client.client_services import BinaryReceiverService
 from dipla.client.client_services import RunInstructionsService
+from dipla.client.client_services import FetchObjectsService
+from dipla.client.client_services import HeartbeatService
+from dipla.shared import broadcasts, objects
 from dipla.shared.services import ServiceError
 from dipla.shared.error_codes import ErrorCodes
 
@@ -74,6 +78,72 @@ class BinaryRunnerServiceTest(TestCase):
         self.assertEquals(
             ErrorCodes.invalid_binary_key, context.exception.code)
 
+    def test_broadcast_references_are_replaced_by_files(self):
+        client = Client()
+        client.binary_paths = {'foo': 'test_path'}
+        runner = MockBinaryRunner()
+        service = BinaryRunnerService(client, runner)
+        key, serialised = broadcasts.serialise({'a': [1, 2]})
+        reference = broadcasts.make_reference(key)
+
+        service.execute({
+            'task_uid': 'bar',
+            'task_instructions': 'foo',
+            'arguments': [[1, 2], [reference, reference]],
+            'broadcasts': {key: serialised},
+        })
+        path = client.broadcast_paths[key]
+        self.assertEqual(
+            [[1, 2], [{'__dipla_broadcast_file__': path}] * 2],
+            runner.arguments)
+        with open(path) as f:
+            self.assertEqual(serialised, f.read())
+        os.remove(path)
+
+    def test_unknown_broadcast_raises_error(self):
+        client = Client()
+        client.binary_paths = {'foo': 'test_path'}
+        service = BinaryRunnerService(client, MockBinaryRunner())
+        data = {
+            'task_uid': 'bar',
+            'task_instructions': 'foo',
+            'arguments': [[broadcasts.make_reference('missing')]],
+        }
+        with self.assertRaises(ServiceError) as context:
+            service.execute(data)
+        self.assertEqual(ErrorCodes.missing_broadcast, context.exception.code)
+
+    def test_held_objects_are_read_from_files(self):
+        client = Client()
+        client.binary_paths = {'foo': 'test_path'}
+        runner = MockBinaryRunner()
+        service = BinaryRunnerService(client, runner)
+        client.add_object('a', '[1, 2]')
+        client.add_object('b', '3')
+        reference = objects.make_reference('a', 6, 'worker')
+
+        service.execute({
+            'task_uid': 'bar',
+            'task_instructions': 'foo',
+            'arguments': [[reference, [objects.make_reference('b', 1)]]],
+        })
+        self.assertEqual(
+            [[{'__dipla_broadcast_file__': client.object_paths['a']}, [3]]],
+            runner.arguments)
+
+    def test_unknown_object_raises_error(self):
+        client = Client()
+        client.binary_paths = {'foo': 'test_path'}
+        service = BinaryRunnerService(client, MockBinaryRunner())
+        data = {
+            'task_uid': 'bar',
+            'task_instructions': 'foo',
+            'arguments': [[[objects.make_reference('missing', 1)]]],
+        }
+        with self.assertRaises(ServiceError) as context:
+            service.execute(data)
+        self.assertEqual(ErrorCodes.missing_object, context.exception.code)
+
 
 class BinaryReceiverServiceTest(TestCase):
 
@@ -122,6 +192,67 @@ class RunInstructionsServiceTest(TestCase):
             {"DISCOVERED": [[[0, 0], [3, 3]], [[0, 0]]], "LOST": ["FOO"]},
             returned["data"]["signals"])
 
+    def test_kept_results_are_sent_as_references(self):
+        client = Client()
+        client.binary_paths = {"foo": "bar"}
+        runner = MagicMock()
+        runner.run.return_value = ([[1, 2], "three"], {})
+        service = RunInstructionsService(client, runner)
+
+        returned = service.execute({
+            "task_uid": "foo_id",
+            "task_instructions": "foo",
+            "arguments": [[1, 2]],
+            "keep_results": True,
+        })
+        results = returned["data"]["results"]
+        self.assertEqual([6, 7], [result["size"] for result in results])
+        object_ids = [objects.get_object_id(result) for result in results]
+        self.assertEqual(
+            ['[1, 2]', '"three"'],
+            [client.read_object(object_id) for object_id in object_ids])
+
+    def test_batch_results_are_combined_into_one(self):
+        client = Client()
+        client.binary_paths = {"foo": "foo_path", "add": "add_path"}
+        runner = MagicMock()
+        runner.run.side_effect = [([1, 2, 3], {}), ([6], {})]
+        service = RunInstructionsService(client, runner)
+
+        returned = service.execute({
+            "task_uid": "foo_id",
+            "task_instructions": "foo",
+            "arguments": [[1, 2, 3]],
+            "combiner": "add",
+        })
+        self.assertEqual([6], returned["data"]["results"])
+        self.assertEqual(3, returned["data"]["combined"])
+        runner.run.assert_called_with("add_path", [[[1, 2, 3]]])
+
+
+class FetchObjectsServiceTest(TestCase):
+
+    def test_held_objects_are_sent_and_others_are_missing(self):
+        client = Client()
+        client.add_object('a', '[1, 2]')
+        service = FetchObjectsService(client)
+
+        returned = service.execute({'object_ids': ['a', 'b']})
+        self.assertEqual('fetched_objects', returned['label'])
+        self.assertEqual(
+            {'objects': {'a': '[1, 2]'}, 'missing': ['b']},
+            returned['data'])
+
+
+class HeartbeatServiceTest(TestCase):
+
+    def test_heartbeat_is_echoed_with_the_size_of_its_probe(self):
+        service = HeartbeatService(Client())
+
+        returned = service.execute({'sent_at': 12.5, 'probe': 'xxxx'})
+        self.assertEqual('heartbeat', returned['label'])
+        self.assertEqual({'sent_at': 12.5, 'probe_size': 4}, returned['data'])
+
 
 class DummyClient:
     def is_task_terminated(self, uid):
@@ -0,0 +1,24 @@
+import os
+from unittest import TestCase
+
+from dipla.client.client import Client
+
+
+class ClientTest(TestCase):
+
+    def test_stored_values_are_removed(self):
+        client = Client()
+        client.add_broadcast('a', '1')
+        client.add_object('b', '[2]')
+        paths = [client.broadcast_paths['a'], client.object_paths['b']]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        client.remove_stored_values()
+        self.assertFalse(any(os.path.exists(os.path.dirname(path))
+                             for path in paths))
+        self.assertEqual({}, client.object_paths)
+        self.assertEqual({}, client.broadcast_paths)
+
+        client.add_object('b', '[2]')
+        self.assertEqual('[2]', client.read_object('b'))
+        client.remove_stored_values()
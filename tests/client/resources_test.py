@@ -0,0 +1,12 @@
+from unittest import TestCase
+from dipla.client.resources import measure_resources
+
+
+class ResourcesTest(TestCase):
+
+    def test_measured_resources_are_reported_by_name(self):
+        resources = measure_resources()
+        self.assertLessEqual(
+            set(resources), {'cpu', 'mem_mb', 'disk_mb', 'numpy'})
+        self.assertGreaterEqual(resources['cpu'], 1)
+        self.assertIsInstance(resources['numpy'], bool)
@@ -0,0 +1,44 @@
+import unittest
+from dipla.server.heartbeat import HeartbeatMonitor
+from dipla.server.worker_group import Worker
+
+
+class HeartbeatMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = HeartbeatMonitor(interval=1, timeout=3, probe_every=3,
+                                        probe_size=100)
+        self.worker = Worker("A", None, quality=1)
+
+    def test_timeout_must_be_longer_than_interval(self):
+        with self.assertRaises(ValueError):
+            HeartbeatMonitor(interval=5, timeout=5)
+
+    def test_every_few_heartbeats_carry_a_probe(self):
+        heartbeats = [self.monitor.make_heartbeat(self.worker, 0)
+                      for _ in range(6)]
+        self.assertEqual([False, True, False, False, True, False],
+                         ['probe' in heartbeat for heartbeat in heartbeats])
+        self.assertEqual(100, len(heartbeats[1]['probe']))
+
+    def test_round_trip_time_is_averaged(self):
+        self.monitor.record_reply(self.worker, {'sent_at': 0}, 1.0)
+        self.assertEqual(1.0, self.worker.rtt)
+        self.monitor.record_reply(self.worker, {'sent_at': 0}, 2.0)
+        self.assertAlmostEqual(1.3, self.worker.rtt)
+
+    def test_bandwidth_is_measured_from_the_extra_time_of_a_probe(self):
+        self.monitor.record_reply(
+            self.worker, {'sent_at': 0, 'probe_size': 100}, 1.0)
+        self.assertIsNone(self.worker.bandwidth)
+
+        self.monitor.record_reply(self.worker, {'sent_at': 0}, 0.5)
+        self.monitor.record_reply(
+            self.worker, {'sent_at': 0, 'probe_size': 100}, 1.0)
+        self.assertAlmostEqual(200, self.worker.bandwidth)
+        self.assertEqual(0.5, self.worker.rtt)
+
+    def test_worker_is_silent_after_the_timeout(self):
+        self.worker.last_seen = 10
+        self.assertFalse(self.monitor.is_silent(self.worker, 13))
+        self.assertTrue(self.monitor.is_silent(self.worker, 13.5))
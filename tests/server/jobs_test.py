@@ -0,0 +1,163 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+from dipla.server.jobs import Job, JobQueue, create_job_server
+from dipla.server.server import BinaryManager
+from dipla.server.server_services import ServiceParams
+from dipla.server.worker_group import Worker
+
+
+def job_message(values, weight=1):
+    return {
+        'weight': weight,
+        'tasks': [{
+            'uid': 'square',
+            'instructions': 'square',
+            'sources': [{'values': values}],
+        }],
+        'result_task': 'square',
+    }
+
+
+class JobTest(unittest.TestCase):
+
+    def test_from_message_namespaces_tasks(self):
+        message = job_message([1, 2])
+        message['tasks'].append({
+            'uid': 'total',
+            'instructions': 'add',
+            'sources': [{'task': 'square'}],
+            'is_reduce': True,
+        })
+        message['result_task'] = 'total'
+
+        job = Job.from_message("job", message)
+        self.assertEqual("job/total", job.result_task_uid)
+        task = job.task_queue.get_task("job/square")
+        self.assertEqual("job-square", task.instructions)
+        self.assertTrue(job.task_queue.get_task("job/total").is_reduce)
+
+    def test_from_message_rejects_invalid_jobs(self):
+        message = job_message([1, 2])
+        message['result_task'] = 'missing'
+        with self.assertRaises(ValueError):
+            Job.from_message("job", message)
+        with self.assertRaises(ValueError):
+            Job.from_message("job", {'tasks': []})
+        with self.assertRaises(ValueError):
+            Job.from_message("job", job_message([1], weight=0))
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue()
+
+    def test_routes_results_to_the_jobs_queue(self):
+        job = self.queue.create_job(job_message([1]))
+        task_input = self.queue.pop_task_input()
+        self.assertEqual(job.task_uid("square"), task_input.task_uid)
+
+        self.queue.add_result(task_input.task_uid, 1)
+        self.assertEqual([1], job.results())
+        self.assertTrue(self.queue.is_inactive())
+
+    def test_ready_tasks_are_ordered_by_weighted_share(self):
+        first = self.queue.create_job(job_message([1, 2, 3]))
+        second = self.queue.create_job(job_message([1, 2, 3], weight=3))
+        self.assertEqual(first.task_uid("square"),
+                         self.queue.ready_task_uids()[0])
+
+        self.queue.pop_task_input()
+        self.assertEqual(second.task_uid("square"),
+                         self.queue.ready_task_uids()[0])
+        self.queue.pop_task_input()
+        # The second job has a third of its share in use and the first
+        # job has all of it, so the second job is still preferred
+        self.assertEqual(second.task_uid("square"),
+                         self.queue.ready_task_uids()[0])
+
+    def test_task_queue_operations_are_routed_to_the_jobs_queue(self):
+        message = job_message([1, 2, 3])
+        message['tasks'].append({
+            'uid': 'total',
+            'instructions': 'add',
+            'sources': [{'task': 'square'}],
+            'is_reduce': True,
+        })
+        message['result_task'] = 'total'
+        job = self.queue.create_job(message)
+        square_uid = job.task_uid("square")
+        total_uid = job.task_uid("total")
+        self.assertEqual([square_uid],
+                         self.queue.get_dependency_ids(total_uid))
+        self.assertEqual([total_uid], self.queue.get_dependee_ids(square_uid))
+
+        self.queue.pop_task_input(task_uid=square_uid, batch_size=3)
+        # Three inputs combined into one result
+        self.queue.add_result(square_uid, 14, num_inputs=3)
+        self.assertTrue(self.queue.is_task_finished(square_uid))
+        self.assertEqual(1, self.queue.num_reduce_values(total_uid))
+        self.assertEqual(1, self.queue.remaining_reduce_values(total_uid))
+        self.queue.set_reduce_group_size(total_uid, 4)
+        self.assertEqual(4, self.queue.get_task(total_uid).reduce_group_size)
+
+    def test_removing_a_job_removes_its_binaries(self):
+        binary_manager = BinaryManager()
+        binary_manager.add_encoded_binaries('.*', [("other", "Zm9v")])
+        queue = JobQueue(binary_manager)
+        message = job_message([1])
+        message['binaries'] = {'square': 'Zm9v'}
+        job = queue.create_job(message)
+        binary_manager.add_encoded_binaries('.*', list(job.binaries.items()))
+
+        queue.remove_job(job.uid)
+        self.assertEqual([("other", "Zm9v")],
+                         binary_manager.get_binaries("linux"))
+
+
+class JobServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = create_job_server()
+        self.sent = []
+        self.server.send = lambda socket, label, data: self.sent.append(
+            (socket, label, data))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_submitted_job_is_run_and_results_are_sent(self):
+        submitter = Worker("submitter", Mock())
+        worker = Worker("worker", Mock(), quality=1)
+        worker.platform = "linux"
+        self.server.worker_group.add_worker(worker)
+        message = job_message([4])
+        message['binaries'] = {'square': 'Zm9v'}
+
+        service = self.server.services.get_service('submit_job')
+        reply = service(message, ServiceParams(self.server, submitter))
+        job_uid = reply['job_uid']
+        # The worker is sent the job's binaries, and is given input once
+        # it confirms it has them
+        self.assertEqual(
+            {job_uid + '-square': 'Zm9v'},
+            self.sent[-1][2]['base64_binaries'])
+        self.server.services.get_service('binaries_received')(
+            {}, ServiceParams(self.server, worker))
+        self.server.distribute_tasks()
+        self.assertEqual('run_instructions', self.sent[-1][1])
+
+        self.server.services.get_service('client_result')(
+            {'task_uid': job_uid + '/square', 'results': [16]},
+            ServiceParams(self.server, worker))
+        self.server.distribute_tasks()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(
+            (submitter.websocket, 'job_result',
+             {'job_uid': job_uid, 'results': [16]}),
+            self.sent[-1])
+        self.assertTrue(self.server.task_queue.is_inactive())
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+from dipla.api import Dipla
+from dipla.server.local_executor import LocalExecutor, run_batch
+from dipla.server.task_queue import TaskInput, MachineType
+
+
+def add(a, b):
+    return a + b
+
+
+def double(value):
+    return value * 2
+
+
+def find_two(value):
+    if value == 2:
+        Dipla.terminate_tasks()
+    return value
+
+
+class LocalExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = LocalExecutor(
+            max_workers=1, margin=2, revisit_after=5)
+
+    def test_tasks_are_sent_to_workers_first(self):
+        self.assertFalse(self.executor.should_run_locally("foo"))
+
+    def test_task_is_run_locally_once_to_measure_it(self):
+        self.executor.record_sent("foo", 2, 20)
+        self.executor.record_remote_run("foo", 2, 1.0)
+        self.assertTrue(self.executor.should_run_locally("foo"))
+        self.executor.get_costs("foo").local_pending = 1
+        self.assertFalse(self.executor.should_run_locally("foo"))
+
+    def test_task_is_run_locally_only_when_clearly_quicker(self):
+        self.executor.record_remote_run("foo", 1, 1.0)
+        self.executor.record_local_run("foo", 1, 0.6)
+        self.assertFalse(self.executor.should_run_locally("foo"))
+
+        self.executor.record_remote_run("bar", 1, 1.0)
+        self.executor.record_local_run("bar", 1, 0.1)
+        self.assertTrue(self.executor.should_run_locally("bar"))
+
+    def test_old_measurements_are_revisited(self):
+        self.executor.record_remote_run("foo", 1, 1.0)
+        self.executor.record_local_run("foo", 1, 0.1)
+        costs = self.executor.get_costs("foo")
+        later = costs.remote_measured_at + 10
+
+        self.assertFalse(self.executor.should_run_locally("foo", later))
+        costs.remote_pending = 1
+        self.assertTrue(self.executor.should_run_locally("foo", later))
+
+    def test_measurements_are_averaged(self):
+        self.executor.record_remote_run("foo", 1, 1.0)
+        self.executor.record_remote_run("foo", 2, 4.0)
+        self.assertAlmostEqual(1.3, self.executor.get_costs("foo").remote_time)
+
+    def test_run_batch_applies_functions_in_turn(self):
+        self.assertTrue(self.executor.add_function("add", [add, double]))
+        functions = self.executor._functions["add"]
+        self.assertEqual(([6, 10], {}),
+                         run_batch(functions, [[1, 2], [2, 3]]))
+
+    def test_run_batch_collects_the_signals_functions_send(self):
+        self.executor.add_function("find_two", [find_two])
+        functions = self.executor._functions["find_two"]
+        self.assertEqual(([1, 2, 3], {"TERMINATE": [True]}),
+                         run_batch(functions, [[1, 2, 3]]))
+        self.assertEqual(([1], {}), run_batch(functions, [[1]]))
+
+    def test_run_resolves_broadcasts_and_returns_results(self):
+        self.executor.add_function("add", [add])
+        task_input = TaskInput(
+            "foo", "add", MachineType.client,
+            [[1, 2], [{"__dipla_broadcast__": "key"}] * 2])
+        on_results = Mock()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.executor.run(task_input, {"key": "10"}, on_results)
+            loop.run_until_complete(asyncio.sleep(0))
+            while not on_results.called:
+                loop.run_until_complete(asyncio.sleep(0.01))
+        finally:
+            self.executor.shutdown()
+        on_results.assert_called_once_with([11, 12], {})
+        self.assertIsNotNone(self.executor.get_costs("foo").local_time)
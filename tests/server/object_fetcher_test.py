@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import Mock
+from dipla.server.object_fetcher import ObjectFetcher
+from dipla.shared import objects
+
+
+class ObjectFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.connected = {"holder", "other"}
+
+        def request_objects(worker_uid, object_ids):
+            if worker_uid not in self.connected:
+                return False
+            self.requests.append((worker_uid, object_ids))
+            return True
+
+        self.fetcher = ObjectFetcher(request_objects)
+        self.a = objects.make_reference("a", 1, "holder")
+        self.b = objects.make_reference("b", 1, "other")
+
+    def test_values_without_other_workers_objects_are_resolved_at_once(self):
+        on_resolved = Mock()
+        self.fetcher.fetch([[1, self.a]], "holder", on_resolved, Mock())
+        on_resolved.assert_called_once_with([[1, self.a]])
+        self.assertEqual([], self.requests)
+
+    def test_objects_are_requested_and_swapped_for_their_values(self):
+        on_resolved = Mock()
+        self.fetcher.fetch([[self.a], [[self.a, self.b]]], "other",
+                           on_resolved, Mock())
+        self.assertEqual([("holder", ["a"])], self.requests)
+        self.assertFalse(on_resolved.called)
+
+        self.fetcher.add_objects({"a": "[1, 2]"})
+        on_resolved.assert_called_once_with([[[1, 2]], [[[1, 2], self.b]]])
+        self.assertEqual(0, self.fetcher.num_waiting())
+
+    def test_objects_are_requested_once_for_several_fetches(self):
+        on_resolved = Mock()
+        self.fetcher.fetch([[self.a]], None, on_resolved, Mock())
+        self.fetcher.fetch([[self.a, self.b]], None, on_resolved, Mock())
+        self.assertEqual([("holder", ["a"]), ("other", ["b"])],
+                         self.requests)
+
+        self.fetcher.add_objects({"a": "1"})
+        on_resolved.assert_called_once_with([[1]])
+        self.fetcher.add_objects({"b": "2"})
+        on_resolved.assert_called_with([[1, 2]])
+
+    def test_fetches_fail_when_the_holder_has_gone(self):
+        on_lost = Mock()
+        self.fetcher.fetch([[self.a]], None, Mock(), on_lost)
+        self.fetcher.remove_holder("holder")
+        on_lost.assert_called_once_with(["a"])
+
+        self.connected.remove("holder")
+        self.fetcher.fetch([[self.a]], None, Mock(), on_lost)
+        on_lost.assert_called_with(["a"])
+        self.assertEqual(0, self.fetcher.num_waiting())
+
+    def test_fetches_fail_when_the_holder_does_not_have_the_object(self):
+        on_resolved = Mock()
+        on_lost = Mock()
+        self.fetcher.fetch([[self.a]], None, on_resolved, on_lost)
+        self.fetcher.add_objects({}, ["a"])
+        on_lost.assert_called_once_with(["a"])
+        self.assertFalse(on_resolved.called)
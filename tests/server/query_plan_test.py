@@ -0,0 +1,116 @@
+import unittest
+from dipla.server import query_plan
+from dipla.server.task_queue import TaskQueue, Task, DataSource, MachineType
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = TaskQueue()
+
+    def push_task(self, uid, source_values=None, source_task=None,
+                  is_reduce=False):
+        task = Task(uid, uid, MachineType.client, is_reduce=is_reduce)
+        if source_values is not None:
+            task.add_data_source(DataSource.create_source_from_iterable(
+                source_values, uid + "-source"))
+        if source_task is not None:
+            task.add_data_source(DataSource.create_source_from_task(
+                source_task, uid + "-source"))
+        self.queue.push_task(task)
+        return task
+
+    def push_pipeline(self, num_values=1000):
+        mapped = self.push_task("map", source_values=range(num_values))
+        return self.push_task("reduce", source_task=mapped, is_reduce=True)
+
+    def test_estimates_follow_cardinality_through_tasks(self):
+        self.push_pipeline()
+        plan = query_plan.build_plan(
+            self.queue, ["reduce"], choose_batch_sizes=False)
+
+        self.assertEqual(1000, plan.get_node("map").estimated_inputs)
+        self.assertEqual(1000, plan.get_node("reduce").estimated_inputs)
+        self.assertEqual(1, plan.get_node("reduce").estimated_outputs)
+        self.assertEqual(1000, plan.get_node("map").estimated_messages)
+        # A reduce in groups of 2 takes 999 runs
+        self.assertEqual(999, plan.get_node("reduce").estimated_messages)
+
+    def test_batch_sizes_are_chosen_from_input_size(self):
+        self.push_pipeline(num_values=640)
+        plan = query_plan.build_plan(self.queue, ["reduce"])
+        self.assertEqual(10, plan.get_node("map").batch_size)
+        self.assertIsNone(plan.get_node("reduce").batch_size)
+
+        plan.apply(self.queue)
+        self.assertEqual(10, self.queue.get_task("map").batch_size)
+
+    def test_group_sizes_are_only_chosen_when_asked(self):
+        self.push_pipeline(num_values=100)
+        plan = query_plan.build_plan(self.queue, ["reduce"])
+        self.assertEqual(2, plan.get_node("reduce").reduce_group_size)
+
+        plan = query_plan.build_plan(
+            self.queue, ["reduce"], choose_group_sizes=["reduce"])
+        self.assertEqual(10, plan.get_node("reduce").reduce_group_size)
+        plan.apply(self.queue)
+        self.assertEqual(10, self.queue.get_task("reduce").reduce_group_size)
+
+    def test_unknown_size_gives_no_estimate(self):
+        self.push_task("foo", source_values=iter([1, 2, 3]))
+        plan = query_plan.build_plan(self.queue, ["foo"])
+        self.assertIsNone(plan.get_node("foo").estimated_inputs)
+        self.assertIsNone(plan.estimated_cost())
+        self.assertIn("?", str(plan))
+
+    def test_upstream_tasks_get_higher_priority(self):
+        self.push_pipeline()
+        plan = query_plan.build_plan(self.queue, ["reduce"])
+        self.assertGreater(plan.get_node("map").priority,
+                           plan.get_node("reduce").priority)
+
+    def test_fused_tasks_do_not_retain_output(self):
+        mapped = self.push_task("map", source_values=[1, 2, 3])
+        self.push_task("double", source_task=mapped)
+        plan = query_plan.build_plan(
+            self.queue, ["double"], can_fuse=lambda up, down: True)
+
+        self.assertEqual("double", plan.get_node("map").fused_into)
+        self.assertFalse(plan.get_node("map").retain_output)
+        self.assertEqual(0, plan.get_node("map").estimated_messages)
+        self.assertTrue(plan.get_node("double").retain_output)
+
+    def test_shared_tasks_are_planned_once_and_targets_not_fused(self):
+        mapped = self.push_task("map", source_values=[1, 2, 3])
+        self.push_task("double", source_task=mapped)
+        plan = query_plan.build_plan(
+            self.queue, ["map", "double"], can_fuse=lambda up, down: True)
+
+        self.assertEqual(["map", "double"],
+                         [node.uid for node in plan.nodes])
+        self.assertTrue(plan.get_node("map").retain_output)
+        self.assertIn("Plan for tasks map, double", str(plan))
+
+    def test_tasks_the_target_does_not_need_are_held(self):
+        self.push_pipeline()
+        self.push_task("other", source_values=[1, 2, 3])
+        plan = query_plan.build_plan(self.queue, ["reduce"])
+        self.assertEqual(["other"], plan.held_uids)
+
+        plan.apply(self.queue)
+        self.assertNotIn("other", self.queue.ready_task_uids())
+
+        plan = query_plan.build_plan(
+            self.queue, ["reduce"], hold_unneeded=False)
+        self.assertEqual([], plan.held_uids)
+
+    def test_plan_can_be_printed_and_dumped(self):
+        self.push_pipeline()
+        plan = query_plan.build_plan(self.queue, ["reduce"])
+
+        dumped = plan.to_dict()
+        self.assertEqual(["reduce"], dumped["targets"])
+        self.assertEqual(["map", "reduce"],
+                         [task["uid"] for task in dumped["tasks"]])
+        self.assertEqual(plan.estimated_cost(), dumped["estimated_cost"])
+        self.assertIn("reduce (reduce by 2)", str(plan))
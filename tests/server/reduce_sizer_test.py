@@ -0,0 +1,30 @@
+import unittest
+from dipla.server.reduce_sizer import ReduceSizer
+
+
+class ReduceSizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sizer = ReduceSizer(server_threshold=4, max_group_time=1.0)
+
+    def test_values_are_split_between_idle_workers(self):
+        self.assertEqual(25, self.sizer.choose_group_size("foo", 100, 4))
+        self.assertEqual(34, self.sizer.choose_group_size("foo", 100, 3))
+        self.assertEqual(100, self.sizer.choose_group_size("foo", 100, 0))
+
+    def test_groups_hold_at_least_two_values(self):
+        self.assertEqual(2, self.sizer.choose_group_size("foo", 3, 10))
+
+    def test_groups_are_limited_by_measured_time_per_value(self):
+        self.sizer.record_run("foo", 10, 1.0)
+        self.assertEqual(0.1, self.sizer.value_time("foo"))
+        self.assertEqual(10, self.sizer.choose_group_size("foo", 100, 2))
+
+        self.sizer.record_run("foo", 10, 2.0)
+        self.assertAlmostEqual(0.13, self.sizer.value_time("foo"))
+        self.assertIsNone(self.sizer.value_time("bar"))
+
+    def test_few_remaining_values_are_finished_on_server(self):
+        self.assertFalse(self.sizer.should_finish_on_server(0))
+        self.assertTrue(self.sizer.should_finish_on_server(4))
+        self.assertFalse(self.sizer.should_finish_on_server(5))
@@ -0,0 +1,73 @@
+import functools
+import unittest
+from unittest.mock import patch
+from dipla.server import reducers
+from dipla.shared import sketches
+
+
+class PythonReducersTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(reducers, 'numpy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_numbers_are_accumulated(self):
+        self.assertEqual(10, reducers.total([1, 2, 3, 4]))
+        self.assertEqual(1, reducers.minimum([3, 1, 2]))
+        self.assertEqual(3.5, reducers.maximum([3, 3.5, 2]))
+
+    def test_lists_are_accumulated_element_by_element(self):
+        self.assertEqual([[4, 6], [8, 10]],
+                         reducers.total([[[1, 2], [3, 4]], [[3, 4], [5, 6]]]))
+        self.assertEqual([1, 5], reducers.maximum([[1, 2], [0, 5]]))
+
+    def test_lists_of_different_shapes_are_not_accumulated(self):
+        with self.assertRaises(ValueError):
+            reducers.total([[1, 2], [1, 2, 3]])
+
+    def test_mean_combines_partial_means(self):
+        partial = reducers.mean([1, 2, 3])
+        self.assertEqual(2, reducers.finish_mean(partial))
+        partial = reducers.mean([partial, 6])
+        self.assertEqual(3, reducers.finish_mean(partial))
+        self.assertEqual([2, 3], reducers.finish_mean(
+            reducers.mean([[1, 2], [3, 4]])))
+
+    def test_histogram_counts_numbers_and_partial_counts(self):
+        histogram = reducers.Histogram([0, 1, 2, 3])
+        partial = histogram([0, 0.5, [1, 2.5], 3, 7, -1])
+        self.assertEqual([2, 1, 2], reducers.finish_histogram(partial))
+        partial = histogram([partial, 1.5])
+        self.assertEqual([2, 2, 2], reducers.finish_histogram(partial))
+
+    def test_histogram_edges_must_increase(self):
+        with self.assertRaises(ValueError):
+            reducers.Histogram([1])
+        with self.assertRaises(ValueError):
+            reducers.Histogram([0, 2, 1])
+
+
+@unittest.skipIf(reducers.numpy is None, "NumPy is not installed")
+class NumpyReducersTest(PythonReducersTest):
+
+    def setUp(self):
+        pass
+
+
+class SketchReducerTest(unittest.TestCase):
+
+    def test_values_and_partial_sketches_are_merged(self):
+        reducer = reducers.SketchReducer(
+            functools.partial(sketches.TopK, 1))
+        partial = reducer(["a", "b", "a"])
+        partial = reducer([partial, "b", "b"])
+        self.assertEqual([["b", 3]],
+                         reducers.finish_sketch(partial).top())
+
+    def test_encoded_sketches_are_merged(self):
+        first = sketches.CountMin().update({"a": 2}).encode()
+        second = sketches.CountMin().update({"a": 3}).encode()
+        partial = reducers.merge_sketches([first, second])
+        partial = reducers.merge_sketches([partial, first])
+        self.assertEqual(7, reducers.finish_sketch(partial).estimate("a"))
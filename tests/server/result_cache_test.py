@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from dipla.server import result_cache
+from dipla.server.result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(':memory:', max_size=20)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_returns_stored_result(self):
+        self.cache.put("a", [1, 2])
+        self.assertEqual([1, 2], self.cache.get("a"))
+        with self.assertRaises(KeyError):
+            self.cache.get("b")
+        self.assertEqual(0.5, self.cache.hit_ratio())
+
+    def test_least_recently_used_results_are_evicted(self):
+        self.cache.put("a", "aaaaaa")
+        self.cache.put("b", "bbbbbb")
+        self.cache.get("a")
+        # Adding "c" takes the cache over 20 bytes, so "b" is removed
+        self.cache.put("c", "cccccc")
+        self.assertEqual("aaaaaa", self.cache.get("a"))
+        self.assertEqual("cccccc", self.cache.get("c"))
+        with self.assertRaises(KeyError):
+            self.cache.get("b")
+
+    def test_results_are_kept_between_runs(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            cache = ResultCache(path)
+            cache.put("a", {"x": 1})
+            cache.close()
+            cache = ResultCache(path)
+            self.assertEqual({"x": 1}, cache.get("a"))
+            cache.close()
+        finally:
+            os.remove(path)
+
+    def test_lookups_and_stores_are_written_when_flushed(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            cache = ResultCache(path, flush_after=3)
+            reader = sqlite3.connect(path)
+
+            def stored():
+                return reader.execute(
+                    "SELECT key, last_used FROM results "
+                    "ORDER BY key").fetchall()
+            cache.put("a", 1)
+            cache.put("b", 2)
+            self.assertEqual([], stored())
+            cache.flush()
+            self.assertEqual([("a", 1), ("b", 2)], stored())
+
+            cache.get("a")
+            cache.get("a")
+            self.assertEqual([("a", 1), ("b", 2)], stored())
+            # The third lookup or store since the flush flushes the cache
+            cache.get("b")
+            self.assertEqual([("a", 4), ("b", 5)], stored())
+            reader.close()
+            cache.close()
+            cache.close()
+        finally:
+            os.remove(path)
+
+    def test_make_key(self):
+        key = result_cache.make_key("f", [[{"b": 1, "a": 2}], [3]])
+        self.assertEqual(
+            key, result_cache.make_key("f", [[{"a": 2, "b": 1}], [3]]))
+        self.assertNotEqual(
+            key, result_cache.make_key("g", [[{"a": 2, "b": 1}], [3]]))
+        self.assertIsNone(result_cache.make_key("f", [[1, 2]]))
+        self.assertIsNone(result_cache.make_key(
+            "f", [[{"__dipla_file_split__": ["path", 0, 1]}]]))
+
+    def test_function_namespace_depends_on_code(self):
+        def first(x):
+            return x
+
+        def second(x):
+            return x + 1
+
+        self.assertEqual(result_cache.function_namespace(first),
+                         result_cache.function_namespace(first))
+        self.assertNotEqual(result_cache.function_namespace(first),
+                            result_cache.function_namespace(second))
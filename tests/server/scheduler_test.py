@@ -0,0 +1,223 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+from dipla.server.scheduler import Scheduler, FifoPolicy, LocalityPolicy
+from dipla.server.scheduler import FairSharePolicy, AffinityPolicy
+from dipla.server.task_queue import TaskQueue, Task, DataSource, MachineType
+from dipla.server.worker_group import WorkerGroup, Worker
+from dipla.shared import statistics
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.task_queue = TaskQueue()
+        stats = {
+            "num_total_workers": 0,
+            "num_idle_workers": 0
+        }
+        self.worker_group = WorkerGroup(statistics.StatisticsUpdater(stats))
+
+    def push_client_task(self, uid, instructions, values):
+        task = Task(uid, instructions, MachineType.client)
+        task.add_data_source(
+            DataSource.create_source_from_iterable(values, uid + "source"))
+        self.task_queue.push_task(task)
+        return task
+
+    def test_decide_returns_none_without_workers(self):
+        self.push_client_task("foo", "foo", [1, 2, 3])
+        scheduler = Scheduler()
+        self.assertIsNone(scheduler.decide(self.task_queue, self.worker_group))
+
+    def test_decide_sends_bigger_batches_to_distant_workers(self):
+        self.push_client_task("foo", "foo", list(range(10)))
+        worker = Worker("A", None, quality=1)
+        worker.rtt = 0.12
+        self.worker_group.add_worker(worker)
+        scheduler = Scheduler(FifoPolicy(batch_size=2), latency_target=0.05)
+
+        decision = scheduler.decide(self.task_queue, self.worker_group)
+        self.assertEqual(5, decision.batch_size)
+
+        worker.rtt = 10
+        decision = scheduler.decide(self.task_queue, self.worker_group)
+        self.assertEqual(16, decision.batch_size)
+
+    def test_decide_records_decision_timing(self):
+        self.push_client_task("foo", "foo", [1, 2, 3])
+        self.worker_group.add_worker(Worker("A", None, quality=1))
+        scheduler = Scheduler()
+
+        scheduler.decide(self.task_queue, self.worker_group)
+        scheduler.decide(self.task_queue, self.worker_group)
+
+        summary = scheduler.timing_summary()
+        self.assertEqual(2, summary["num_decisions"])
+        self.assertEqual(2, len(scheduler.decision_times))
+        self.assertGreaterEqual(summary["max_decision_time"], 0)
+
+    def test_fifo_policy_chooses_first_pushed_task_and_best_worker(self):
+        self.push_client_task("first", "foo", [1, 2, 3])
+        self.push_client_task("second", "bar", [1, 2, 3])
+        self.worker_group.add_worker(Worker("A", None, quality=2))
+        self.worker_group.add_worker(Worker("B", None, quality=1))
+
+        decision = FifoPolicy(batch_size=3).choose(
+            self.task_queue, self.worker_group)
+        self.assertEqual("first", decision.task_uid)
+        self.assertEqual("B", decision.worker_uid)
+        self.assertEqual(3, decision.batch_size)
+
+    def test_task_batch_size_overrides_policy_batch_size(self):
+        task = self.push_client_task("first", "foo", [1, 2, 3])
+        task.batch_size = 2
+        self.worker_group.add_worker(Worker("A", None, quality=1))
+
+        decision = FifoPolicy(batch_size=3).choose(
+            self.task_queue, self.worker_group)
+        self.assertEqual(2, decision.batch_size)
+
+    def test_policies_only_send_input_to_workers_meeting_requirements(self):
+        big = self.push_client_task("big", "foo", [1, 2, 3])
+        big.requirements = {"mem_mb": 2000}
+        self.push_client_task("small", "bar", [1, 2, 3])
+        small_worker = Worker("A", None, quality=1)
+        small_worker.resources = {"mem_mb": 500}
+        big_worker = Worker("B", None, quality=2)
+        big_worker.resources = {"mem_mb": 4000}
+        self.worker_group.add_worker(small_worker)
+        self.worker_group.add_worker(big_worker)
+
+        for policy in (FifoPolicy(), LocalityPolicy(), FairSharePolicy(),
+                       AffinityPolicy(locality_wait=0)):
+            decision = policy.choose(self.task_queue, self.worker_group)
+            self.assertEqual(("big", "B"),
+                             (decision.task_uid, decision.worker_uid))
+
+        self.worker_group.lease_worker("B")
+        decision = FifoPolicy().choose(self.task_queue, self.worker_group)
+        self.assertEqual(("small", "A"),
+                         (decision.task_uid, decision.worker_uid))
+
+    def test_locality_policy_prefers_task_worker_last_ran(self):
+        self.push_client_task("first", "foo", [1, 2, 3])
+        self.push_client_task("second", "bar", [1, 2, 3])
+        worker = Worker("A", None, quality=1)
+        worker.current_task_instr = "bar"
+        self.worker_group.add_worker(worker)
+
+        decision = LocalityPolicy().choose(self.task_queue, self.worker_group)
+        self.assertEqual("second", decision.task_uid)
+        self.assertEqual("A", decision.worker_uid)
+
+    def test_fair_share_policy_prefers_task_with_least_outstanding(self):
+        self.push_client_task("first", "foo", [1, 2, 3])
+        self.push_client_task("second", "bar", [1, 2, 3])
+        self.worker_group.add_worker(Worker("A", None, quality=1))
+        # Two results of "first" are still being computed by workers
+        self.task_queue.pop_task_input(task_uid="first", batch_size=2)
+
+        policy = FairSharePolicy()
+        decision = policy.choose(self.task_queue, self.worker_group)
+        self.assertEqual("second", decision.task_uid)
+
+        self.task_queue.pop_task_input(task_uid="second")
+        policy.set_weight("first", 4)
+        decision = policy.choose(self.task_queue, self.worker_group)
+        self.assertEqual("first", decision.task_uid)
+
+    def test_affinity_policy_prefers_worker_with_most_of_what_task_needs(self):
+        self.push_client_task("first", "foo", [1, 2, 3])
+        task = self.push_client_task("second", "bar", [1, 2, 3])
+        task.add_data_source(DataSource.create_source_from_iterable(
+            [{"__dipla_broadcast__": "key"}], "broadcastsource"))
+        ran_binary = Worker("A", None, quality=1)
+        ran_binary.instructions_run.add("foo")
+        has_broadcast = Worker("B", None, quality=2)
+        has_broadcast.broadcast_keys.add("key")
+        self.worker_group.add_worker(ran_binary)
+        self.worker_group.add_worker(has_broadcast)
+        policy = AffinityPolicy(locality_wait=0)
+
+        self.task_queue.pop_task_input(task_uid="first", batch_size=3)
+        decision = policy.choose(self.task_queue, self.worker_group)
+        self.assertEqual(("second", "B"),
+                         (decision.task_uid, decision.worker_uid))
+
+        ran_binary.kept_task_uids.add("first")
+        self.assertEqual(
+            "B", policy.choose(self.task_queue, self.worker_group).worker_uid)
+
+    def test_affinity_policy_waits_for_busy_better_worker(self):
+        self.push_client_task("first", "foo", [1, 2, 3])
+        better = Worker("A", None, quality=1)
+        better.instructions_run.add("foo")
+        self.worker_group.add_worker(better)
+        self.worker_group.add_worker(Worker("B", None, quality=2))
+        self.worker_group.lease_worker("A")
+
+        policy = AffinityPolicy(locality_wait=60)
+        # A key whose home is not the available worker
+        policy.set_key("first", next(
+            key for key in map(str, range(100))
+            if policy.home_worker_uid(key, ["A", "B"]) == "A"))
+        self.assertIsNone(policy.choose(self.task_queue, self.worker_group))
+        self.assertGreater(policy.retry_after(), 0)
+
+        policy.locality_wait = 0
+        decision = policy.choose(self.task_queue, self.worker_group)
+        self.assertEqual("B", decision.worker_uid)
+
+    def test_affinity_policy_keeps_keys_on_their_home_workers(self):
+        policy = AffinityPolicy()
+        uids = ["A", "B", "C", "D"]
+        homes = {key: policy.home_worker_uid(key, uids)
+                 for key in map(str, range(100))}
+        self.assertEqual(set(uids), set(homes.values()))
+
+        # Only the keys of a worker that leaves move to other workers
+        uids.remove("D")
+        for key, home in homes.items():
+            if home != "D":
+                self.assertEqual(home, policy.home_worker_uid(key, uids))
+
+    def test_batch_size_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            FifoPolicy(batch_size=0)
+
+    def test_run_distributes_tasks_when_woken(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        scheduler = Scheduler()
+        server = Mock()
+        runner = loop.create_task(scheduler.run(server))
+
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(0, server.distribute_tasks.call_count)
+        scheduler.wake()
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(1, server.distribute_tasks.call_count)
+
+        runner.cancel()
+        loop.close()
+
+    def test_run_keeps_running_after_a_pass_raises(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        scheduler = Scheduler()
+        server = Mock()
+        error = KeyError("foo")
+        server.distribute_tasks.side_effect = [error, None]
+        runner = loop.create_task(scheduler.run(server))
+
+        scheduler.wake()
+        loop.run_until_complete(asyncio.sleep(0))
+        server.fail_scheduling_pass.assert_called_once_with(error)
+        scheduler.wake()
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(2, server.distribute_tasks.call_count)
+        self.assertFalse(runner.done())
+
+        runner.cancel()
+        loop.close()
@@ -0,0 +1,51 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+from dipla.server.server_pool import ServerTaskPool
+
+
+def square(value):
+    return value * value
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+class ServerTaskPoolTest(unittest.TestCase):
+
+    def run_on_pool(self, pool, function, values):
+        on_results = Mock()
+        on_error = Mock()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            pool.run(function, values, on_results, on_error)
+            self.assertFalse(pool.has_capacity())
+            while not on_results.called and not on_error.called:
+                loop.run_until_complete(asyncio.sleep(0.01))
+        finally:
+            pool.shutdown()
+        self.assertTrue(pool.has_capacity())
+        return on_results, on_error
+
+    def test_thread_pool_applies_function_to_each_value(self):
+        on_results, on_error = self.run_on_pool(
+            ServerTaskPool('thread', max_workers=1), square, [1, 2, 3])
+        on_results.assert_called_once_with([1, 4, 9])
+        self.assertFalse(on_error.called)
+
+    def test_process_pool_applies_function_to_each_value(self):
+        on_results, _ = self.run_on_pool(
+            ServerTaskPool('process', max_workers=1), square, [4])
+        on_results.assert_called_once_with([16])
+
+    def test_errors_are_passed_on(self):
+        on_results, on_error = self.run_on_pool(
+            ServerTaskPool('thread', max_workers=1), fail, [1])
+        self.assertFalse(on_results.called)
+        self.assertIsInstance(on_error.call_args[0][0], ValueError)
+
+    def test_unknown_kind_of_pool(self):
+        with self.assertRaises(ValueError):
+            ServerTaskPool('gpu')
@@ -3,6 +3,7 @@ from unittest.mock import call, Mock
 from dipla.server.result_verifier import ResultVerifier
 from dipla.server.server import ServerServices, ServiceParams, ServiceError
 from dipla.server.server import BinaryManager
+from dipla.server.task_queue import TaskQueue
 from dipla.server.worker_group import Worker, WorkerGroup
 from dipla.shared import statistics
 from dipla.shared.error_codes import ErrorCodes
@@ -165,6 +166,27 @@ class ServerServicesTest(unittest.TestCase):
 
         service(message, ServiceParams(self.mock_server, self.foo_worker))
 
+    def test_handle_client_result_refreshes_stale_binaries(self):
+        service = self.server_services.get_service('client_result')
+        message = {
+            "task_uid": "bar_task",
+            "results": ["foo"],
+        }
+        self.foo_worker.stale_binaries = True
+
+        service(message, ServiceParams(self.mock_server, self.foo_worker))
+        self.mock_server.refresh_worker_binaries.assert_called_once_with(
+            self.foo_worker)
+
+    def test_handle_submit_job_throws_error_if_server_has_no_jobs(self):
+        service = self.server_services.get_service('submit_job')
+        self.mock_server.task_queue = TaskQueue()
+        with self.assertRaises(ServiceError) as context:
+            service({'tasks': []},
+                    ServiceParams(self.mock_server, self.foo_worker))
+        self.assertEqual(ErrorCodes.jobs_not_supported,
+                         context.exception.code)
+
     # def test_handle_start_server(self):
     #     service = self.server_services.get_service('start_server')
 
@@ -243,14 +265,10 @@ class ServerServicesTest(unittest.TestCase):
             "signals": {"FOOBAR": [[[0, 0], [3, 3]]]}
         }
 
-        mock_task = Mock()
-        self.mock_server.task_queue.get_task.return_value = mock_task
-        mock_task.signals = {"FOOBAR": Mock()}
-
         service(message, ServiceParams(self.mock_server, self.foo_worker))
 
-        mock_task.signals["FOOBAR"].assert_called_with(
-            self.mock_server, "foo_task", [[0, 0], [3, 3]])
+        self.mock_server.handle_signals.assert_called_with(
+            "foo_task", {"FOOBAR": [[[0, 0], [3, 3]]]})
 
     def test_handle_client_result_does_not_add_invalid_results(self):
         service = self.server_services.get_service("client_result")
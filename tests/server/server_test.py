@@ -1,9 +1,18 @@
+import asyncio
+import time
 import unittest
+from unittest.mock import Mock, patch
+from dipla.server import reducers
+from dipla.server.heartbeat import HeartbeatMonitor
+from dipla.server.reduce_sizer import ReduceSizer
 from dipla.server.server import Server, BinaryManager, ServerServices
+from dipla.server.server import SERVER_POOL_BATCH_SIZE
+from dipla.server.server_services import ServiceParams
+from dipla.server.result_cache import ResultCache
 from dipla.server.result_verifier import ResultVerifier
 from dipla.server.task_queue import TaskQueue, Task, DataSource, MachineType
 from dipla.server.worker_group import WorkerGroup, Worker
-from dipla.shared import statistics
+from dipla.shared import statistics, objects
 
 
 class ServerTest(unittest.TestCase):
@@ -14,8 +23,13 @@ class ServerTest(unittest.TestCase):
         self.result_verifier = ResultVerifier()
         stats = {
             "num_total_workers": 0,
-            "num_idle_workers": 0
+            "num_idle_workers": 0,
+            "num_results_from_clients": 0,
+            "num_cache_hits": 0,
+            "num_cache_misses": 0,
+            "cache_hit_ratio": 0,
         }
+        self.stats = stats
         stat_updater = statistics.StatisticsUpdater(stats)
         self.worker_group = WorkerGroup(stat_updater)
         self.server = Server(self.task_queue,
@@ -87,3 +101,480 @@ class ServerTest(unittest.TestCase):
 
         self.server.distribute_tasks()
         self.assertEqual([5, 4, 3, 2, 1], self.server_task.task_output)
+
+    def test_terminate_task_cancels_task_on_next_distribution(self):
+        worker_socket = Mock()
+        self.worker_group.add_worker(Worker("fooworker", worker_socket))
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(label)
+
+        self.server.terminate_task("footask")
+        self.assertEqual(["terminate_task"], sent)
+        self.server.distribute_tasks()
+
+        self.assertEqual(["terminate_task"], sent)
+        self.assertTrue(self.task_queue.is_task_complete("footask"))
+        self.assertFalse(self.task_queue.has_next_input())
+
+    def test_wait_until_resolves_after_distribution(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.server_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.server_task)
+
+        future = self.server.wait_until(
+            lambda: len(self.server_task.task_output) > 0)
+        self.assertFalse(future.done())
+        self.server.distribute_tasks()
+        self.assertTrue(future.done())
+        loop.close()
+
+    def test_cached_inputs_are_not_sent_and_new_results_are_cached(self):
+        cache = ResultCache(':memory:')
+        task = Task("footask", "bar", MachineType.client,
+                    result_cache=cache, cache_namespace="f")
+        task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2], "foosource"))
+        cache.put(task.cached_result_key([[1]]), "one")
+        self.task_queue.push_task(task)
+        worker = Worker("fooworker", None, quality=1)
+        self.worker_group.add_worker(worker)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+        self.server.verify_probability = 0
+
+        self.server.distribute_tasks()
+        self.assertEqual([[[2]]], [data["arguments"] for data in sent])
+        self.assertEqual(["one"], task.task_output)
+        self.assertEqual(0.5, self.stats["cache_hit_ratio"])
+
+        self.server.services.get_service("client_result")(
+            {"task_uid": "footask", "results": ["two"]},
+            ServiceParams(self.server, worker))
+        self.assertEqual("two", cache.get(task.cached_result_key([[2]])))
+
+    def test_each_broadcast_is_sent_to_a_worker_once(self):
+        worker = Worker("worker", Mock(), quality=1)
+        other_worker = Worker("other", Mock(), quality=1)
+        self.server.add_broadcast("key", "[1, 2]")
+        reference = {"__dipla_broadcast__": "key"}
+
+        data = {"arguments": [[1, 2], [reference, reference]]}
+        self.server.attach_broadcasts(data, worker)
+        self.assertEqual({"key": "[1, 2]"}, data["broadcasts"])
+
+        data = {"arguments": [[3], [reference]]}
+        self.server.attach_broadcasts(data, worker)
+        self.assertNotIn("broadcasts", data)
+
+        data = {"arguments": [[3], [reference]]}
+        self.server.attach_broadcasts(data, other_worker)
+        self.assertEqual({"key": "[1, 2]"}, data["broadcasts"])
+
+    def test_add_binaries_sends_binaries_to_connected_workers(self):
+        ready_worker = Worker("ready", Mock(), quality=1)
+        ready_worker.platform = "linux"
+        busy_worker = Worker("busy", Mock(), quality=1)
+        self.worker_group.add_worker(ready_worker)
+        self.worker_group.add_worker(busy_worker)
+        self.worker_group.lease_worker("busy")
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(
+            (socket, label, data))
+
+        self.server.add_binaries('.*', [("foo", "Zm9v")])
+
+        self.assertEqual(
+            [(ready_worker.websocket, "get_binaries",
+              {"base64_binaries": {"foo": "Zm9v"}})],
+            sent)
+        # The ready worker is added back when it replies binaries_received
+        self.assertEqual(["busy"], self.worker_group.worker_uids())
+        self.assertFalse(ready_worker.stale_binaries)
+        self.assertTrue(busy_worker.stale_binaries)
+
+        # Workers are only sent the binaries they do not have yet, unless
+        # they have been removed since
+        self.worker_group.add_worker(ready_worker)
+        sent.clear()
+        self.server.add_binaries('.*', [("bar", "YmFy"), ("baz", "YmF6")])
+        self.binary_manager.remove_binaries(["baz"])
+        busy_worker.platform = "linux"
+        self.server.refresh_worker_binaries(busy_worker)
+        self.assertEqual(
+            [(ready_worker.websocket, "get_binaries",
+              {"base64_binaries": {"bar": "YmFy", "baz": "YmF6"}}),
+             (busy_worker.websocket, "get_binaries",
+              {"base64_binaries": {"foo": "Zm9v", "bar": "YmFy"}})],
+            sent)
+
+    def test_cheap_task_input_is_run_by_local_executor(self):
+        executor = Mock()
+        executor.has_capacity.return_value = True
+        executor.can_run.return_value = True
+        executor.should_run_locally.side_effect = [True, False]
+        self.server.local_executor = executor
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+
+        self.server.distribute_tasks()
+        task_input, _, on_results = executor.run.call_args[0]
+        self.assertEqual([[1]], task_input.values)
+
+        on_results([2], {})
+        self.assertEqual([2], self.client_task.task_output)
+
+    def test_signal_handlers_are_called_with_each_value(self):
+        handler = Mock()
+        self.client_task.signals = {"FOOBAR": handler}
+        self.task_queue.push_task(self.client_task)
+
+        self.server.handle_signals(
+            "footask", {"FOOBAR": [[0, 0], [3, 3]], "BAZ": [1]})
+        self.assertEqual(
+            [((self.server, "footask", [0, 0]),),
+             ((self.server, "footask", [3, 3]),)],
+            handler.call_args_list)
+
+    def test_local_input_that_terminates_cancels_its_task(self):
+        executor = Mock()
+        executor.has_capacity.return_value = True
+        executor.can_run.return_value = True
+        executor.should_run_locally.side_effect = [True, False]
+        self.server.local_executor = executor
+        self.client_task.signals = {
+            'TERMINATE': lambda server, uid, _: server.terminate_task(uid)}
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+
+        self.server.distribute_tasks()
+        _, _, on_results = executor.run.call_args[0]
+        on_results([2], {'TERMINATE': [True]})
+        self.assertEqual([2], self.client_task.task_output)
+        self.server.distribute_tasks()
+        self.assertTrue(self.client_task.cancelled)
+        self.assertTrue(self.task_queue.is_task_complete("footask"))
+
+    def test_failed_local_input_is_sent_to_a_worker(self):
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+        task_input = self.task_queue.pop_task_input()
+        self.server._add_local_results(task_input, None, None)
+        self.worker_group.add_worker(Worker("fooworker", None, quality=1))
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+        self.server.verify_probability = 0
+        self.server.scheduler.policy.choose = Mock(return_value=None)
+
+        self.server.distribute_tasks()
+        self.assertEqual([[[1]]], [data["arguments"] for data in sent])
+
+    def test_client_run_time_is_recorded(self):
+        executor = Mock()
+        self.server.local_executor = executor
+        worker = Worker("fooworker", None, quality=1)
+        worker.sent_at = 0
+
+        self.server.record_client_run(worker, "footask", 4)
+        self.assertEqual("footask",
+                         executor.record_remote_run.call_args[0][0])
+        self.assertIsNone(worker.sent_at)
+
+    def test_server_task_function_is_run_on_server_pool(self):
+        pool = Mock()
+        pool.has_capacity.side_effect = [True, False]
+        self.server.server_pool = pool
+        task = Task("footask", "bar", MachineType.server,
+                    server_function=str)
+        task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(task)
+
+        self.server.distribute_tasks()
+        function, values, on_results, _ = pool.run.call_args[0]
+        self.assertEqual(str, function)
+        self.assertEqual([1, 2, 3, 4], values)
+        self.assertEqual([], task.task_output)
+
+        on_results(["1", "2", "3", "4"])
+        self.assertEqual(["1", "2", "3", "4"], task.task_output)
+
+    def test_server_pool_results_are_added_in_the_order_read(self):
+        pool = Mock()
+        self.server.server_pool = pool
+        task = Task("footask", "bar", MachineType.server,
+                    server_function=str)
+        task.add_data_source(DataSource.create_source_from_iterable(
+            range(SERVER_POOL_BATCH_SIZE * 2), "foosource"))
+        self.task_queue.push_task(task)
+
+        self.server.distribute_tasks()
+        (_, first, on_first, _), (_, second, on_second, _) = \
+            [call[0] for call in pool.run.call_args_list]
+        on_second([str(value) for value in second])
+        self.assertEqual([], task.task_output)
+
+        on_first([str(value) for value in first])
+        self.assertEqual([str(value) for value in first + second],
+                         task.task_output)
+
+    def test_server_task_function_is_run_inline_without_pool(self):
+        task = Task("footask", "bar", MachineType.server,
+                    server_function=str)
+        task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(task)
+
+        self.server.distribute_tasks()
+        self.assertEqual(["1", "2", "3", "4"], task.task_output)
+
+    def test_server_task_function_error_cancels_task(self):
+        task = Task("footask", "bar", MachineType.server,
+                    server_function=lambda value: 1 / 0)
+        task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(task)
+
+        self.server.distribute_tasks()
+        self.assertTrue(task.cancelled)
+        self.assertEqual([], task.task_output)
+
+    def test_failed_scheduling_pass_cancels_the_task_being_scheduled(self):
+        self.worker_group.add_worker(Worker("fooworker", Mock()))
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+        other_task = Task("bartask", "bar", MachineType.client)
+        other_task.add_data_source(
+            DataSource.create_source_from_iterable([5], "barsource"))
+        self.task_queue.push_task(other_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(
+            data["task_uid"])
+        self.server.verify_probability = 0
+        lease_worker = self.worker_group.lease_worker
+        self.worker_group.lease_worker = Mock(side_effect=KeyError("foo"))
+
+        with self.assertRaises(KeyError) as context:
+            self.server.distribute_tasks()
+        self.server.fail_scheduling_pass(context.exception)
+        self.assertTrue(self.client_task.cancelled)
+        self.assertFalse(other_task.cancelled)
+
+        self.worker_group.lease_worker = lease_worker
+        self.server.distribute_tasks()
+        self.assertEqual(["bartask"], sent)
+
+    def test_kept_results_are_stored_as_references_to_the_worker(self):
+        self.worker_group.add_worker(Worker("fooworker", None, quality=1))
+        task = Task("footask", "bar", MachineType.client,
+                    keep_on_worker=True)
+        task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        self.server.distribute_tasks()
+        self.assertTrue(sent[0]["keep_results"])
+        self.assertEqual({}, self.server.verify_inputs)
+
+        worker = self.worker_group.get_worker("fooworker")
+        self.server.services.get_service("client_result")(
+            {"task_uid": "footask",
+             "results": [objects.make_reference("a", 2)]},
+            ServiceParams(self.server, worker))
+        self.assertEqual([objects.make_reference("a", 2, "fooworker")],
+                         task.task_output)
+
+    def test_input_is_sent_to_the_worker_holding_its_objects(self):
+        self.worker_group.add_worker(Worker("best", None, quality=2))
+        self.worker_group.add_worker(Worker("holder", None, quality=1))
+        reference = objects.make_reference("a", 2, "holder")
+        self.client_task.add_data_source(
+            DataSource.create_source_from_iterable([reference], "foosource"))
+        self.task_queue.push_task(self.client_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        self.server.distribute_tasks()
+        self.assertEqual([[[reference]]], [data["arguments"] for data in sent])
+        self.assertEqual(["best"], [worker.uid for worker in
+                                    self.worker_group.available_workers()])
+
+    def test_server_task_fetches_objects_from_the_worker_holding_them(self):
+        holder = Worker("holder", Mock(), quality=1)
+        self.server._connected_workers["holder"] = holder
+        reference = objects.make_reference("a", 2, "holder")
+        self.server_task.add_data_source(
+            DataSource.create_source_from_iterable([reference], "foosource"))
+        self.task_queue.push_task(self.server_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(
+            (socket, label, data))
+
+        self.server.distribute_tasks()
+        self.assertEqual(
+            [(holder.websocket, "fetch_objects", {"object_ids": ["a"]})],
+            sent)
+        self.assertEqual([], self.server_task.task_output)
+
+        self.server.services.get_service("fetched_objects")(
+            {"objects": {"a": "[1]"}, "missing": []},
+            ServiceParams(self.server, holder))
+        self.assertEqual([[1]], self.server_task.task_output)
+
+    def test_silent_worker_is_removed_and_its_input_requeued(self):
+        self.server.heartbeat_monitor = HeartbeatMonitor(interval=1,
+                                                         timeout=2)
+
+        async def close():
+            pass
+        silent = Worker("silent", Mock(), quality=1)
+        silent.websocket.close = Mock(side_effect=close)
+        self.server._connected_workers["silent"] = silent
+        self.worker_group.add_worker(silent)
+        self.client_task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(self.client_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(
+            (socket, label, data))
+        self.server.verify_probability = 0
+        self.server.distribute_tasks()
+        self.assertEqual([silent.websocket], [item[0] for item in sent])
+
+        alive = Worker("alive", Mock(), quality=1)
+        self.server._connected_workers["alive"] = alive
+        silent.last_seen = 0
+        alive.last_seen = 10
+        sent.clear()
+
+        async def check():
+            self.server.check_heartbeats(now=11)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(check())
+        loop.close()
+        self.assertEqual([(alive.websocket, "heartbeat", {"sent_at": 11})],
+                         sent)
+        self.assertTrue(silent.websocket.close.called)
+        self.assertNotIn("silent", self.worker_group.worker_uids())
+
+        sent.clear()
+        self.worker_group.add_worker(alive)
+        self.server.scheduler.policy.choose = Mock(return_value=None)
+        self.server.distribute_tasks()
+        self.assertEqual([[[1]]], [item[2]["arguments"] for item in sent])
+        self.assertIs(alive.in_flight_input.values, sent[0][2]["arguments"])
+
+    def test_heartbeat_reply_records_round_trip_time(self):
+        self.server.heartbeat_monitor = HeartbeatMonitor()
+        worker = Worker("fooworker", None, quality=1)
+
+        self.server.services.get_service("heartbeat")(
+            {"sent_at": time.monotonic() - 0.5, "probe_size": 0},
+            ServiceParams(self.server, worker))
+        self.assertGreaterEqual(worker.rtt, 0.5)
+
+    def test_large_input_is_sent_to_the_worker_with_most_bandwidth(self):
+        best = Worker("best", None, quality=2)
+        best.bandwidth = 10
+        fast = Worker("fast", None, quality=1)
+        fast.bandwidth = 1000
+        self.worker_group.add_worker(best)
+        self.worker_group.add_worker(fast)
+        self.client_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "foosource"))
+        self.task_queue.push_task(self.client_task)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        with patch("dipla.server.server.LARGE_PAYLOAD_SIZE", 1):
+            self.server.distribute_tasks()
+        self.assertEqual(["best"], [worker.uid for worker in
+                                    self.worker_group.available_workers()])
+
+    def test_combined_results_complete_the_batch_they_came_from(self):
+        self.worker_group.add_worker(Worker("fooworker", None, quality=1))
+        task = Task("footask", "bar", MachineType.client, combiner="add")
+        task.add_data_source(self.sample_data_source)
+        self.task_queue.push_task(task)
+        self.server.scheduler.policy.batch_size = 4
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        self.server.distribute_tasks()
+        self.assertEqual("add", sent[0]["combiner"])
+        self.assertEqual({}, self.server.verify_inputs)
+
+        self.server.services.get_service("client_result")(
+            {"task_uid": "footask", "results": [10], "combined": 4},
+            ServiceParams(self.server, self.worker_group.get_worker(
+                "fooworker")))
+        self.assertEqual([10], task.task_output)
+        self.assertEqual(0, task.in_flight())
+
+    def push_reduce_task(self, values, **kwargs):
+        task = Task("reducetask", "sum", MachineType.client,
+                    complete_check=lambda streamer:
+                        not streamer.has_available_data(),
+                    is_reduce=True, reduce_function=sum, **kwargs)
+        task.add_data_source(
+            DataSource.create_source_from_iterable(values, "foosource"))
+        self.task_queue.push_task(task)
+        return task
+
+    def test_adaptive_reduce_groups_are_split_between_idle_workers(self):
+        self.server.reduce_sizer = ReduceSizer(server_threshold=0)
+        for uid in ("A", "B", "C"):
+            self.worker_group.add_worker(Worker(uid, None, quality=1))
+        self.push_reduce_task(list(range(12)), adaptive_group_size=True)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        self.server.distribute_tasks()
+        self.assertEqual([4, 4, 4],
+                         [len(data["arguments"][0][0]) for data in sent])
+
+    def test_last_reduce_values_are_reduced_on_server(self):
+        self.server.reduce_sizer = ReduceSizer(server_threshold=8)
+        self.worker_group.add_worker(Worker("fooworker", None, quality=1))
+        task = self.push_reduce_task([1, 2, 3, 4, 5],
+                                     adaptive_group_size=True)
+        sent = []
+        self.server.send = lambda socket, label, data: sent.append(data)
+
+        self.server.distribute_tasks()
+        self.assertEqual([], sent)
+        self.assertEqual([15], task.task_output)
+        self.assertTrue(task.complete)
+
+    def test_server_reduce_accumulates_results_as_they_arrive(self):
+        def until_unavailable(streamer):
+            return not streamer.has_available_data()
+
+        map_task = Task("maptask", "double", MachineType.client,
+                        complete_check=until_unavailable)
+        map_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "foosource"))
+        sum_task = Task("sumtask", "reduce_sum", MachineType.server,
+                        complete_check=until_unavailable, is_reduce=True,
+                        reduce_group_size=reducers.GROUP_SIZE,
+                        server_function=reducers.total)
+        sum_task.add_data_source(
+            DataSource.create_source_from_task(map_task, "mapsource"))
+        self.task_queue.push_task(map_task)
+        self.task_queue.push_task(sum_task)
+
+        self.task_queue.pop_task_input(task_uid="maptask")
+        self.task_queue.add_result("maptask", 2)
+        self.server.distribute_tasks()
+        # A lone value waits for another to be reduced with
+        self.assertEqual([], sum_task.task_output)
+
+        self.task_queue.pop_task_input(task_uid="maptask", batch_size=2)
+        self.task_queue.add_result("maptask", 4)
+        self.server.distribute_tasks()
+        self.assertEqual([6], sum_task.task_output)
+
+        self.task_queue.add_result("maptask", 6)
+        self.server.distribute_tasks()
+        self.assertEqual([6, 12], sum_task.task_output)
+        self.assertTrue(sum_task.complete)
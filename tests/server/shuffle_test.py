@@ -0,0 +1,88 @@
+import os
+import unittest
+from dipla.server.shuffle import Shuffle, check_pairs
+
+
+class ShuffleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = []
+        self.finished = False
+        self.shuffle = Shuffle(self.source, lambda: self.finished,
+                               num_partitions=4)
+
+    def pop_all(self, shuffle):
+        groups = []
+        while len(shuffle) > 0:
+            groups.extend(shuffle.pop())
+        return sorted(groups)
+
+    def test_partitions_are_ready_once_the_source_has_finished(self):
+        self.source.append([["a", 1], ["b", 2]])
+        self.assertEqual(0, len(self.shuffle))
+
+        self.source.append({"a": 3})
+        self.finished = True
+        self.assertEqual([["a", [1, 3]], ["b", [2]]],
+                         self.pop_all(self.shuffle))
+
+    def test_keys_are_partitioned_by_hash(self):
+        self.source.append([[key, 1] for key in range(100)] + [[7, 2]])
+        self.finished = True
+        num_partitions = len(self.shuffle)
+        self.assertGreater(num_partitions, 1)
+        for _ in range(num_partitions):
+            keys = [key for key, _ in self.shuffle.pop()]
+            self.assertEqual(
+                {self.shuffle.partition_of(keys[0])},
+                {self.shuffle.partition_of(key) for key in keys})
+        self.assertEqual(self.shuffle.partition_of(7),
+                         Shuffle([], None, 4).partition_of(7))
+
+    def test_full_partitions_are_spilled_to_disk(self):
+        shuffle = Shuffle(self.source, lambda: self.finished,
+                          num_partitions=1, spill_after=2)
+        self.source.extend([[["a", 1], ["b", 2]], [["a", 3]]])
+        self.assertEqual(0, len(shuffle))
+        directory = shuffle._spill_directory
+        self.assertEqual(["0"], os.listdir(directory))
+
+        self.finished = True
+        self.assertEqual([["a", [1, 3]], ["b", [2]]], self.pop_all(shuffle))
+        self.assertFalse(os.path.exists(directory))
+
+    def test_spilled_partitions_are_merged_in_batches(self):
+        shuffle = Shuffle(self.source, lambda: self.finished,
+                          num_partitions=1, spill_after=3)
+        self.source.extend([[["b", 1], ["c", 2], ["a", 3], ["c", 4]],
+                            [["a", 5], ["d", 6]]])
+        self.finished = True
+        self.assertEqual(1, len(shuffle))
+        self.assertEqual([["a", [3, 5]], ["b", [1]]], shuffle.pop())
+        self.assertEqual(1, len(shuffle))
+        self.assertEqual([["c", [2, 4]], ["d", [6]]], shuffle.pop())
+        self.assertEqual(0, len(shuffle))
+
+    def test_values_are_consumed_once_nothing_else_reads_them(self):
+        can_consume = False
+        shuffle = Shuffle(self.source, lambda: self.finished,
+                          can_consume=lambda: can_consume)
+        self.source.append([["a", 1]])
+        self.assertEqual(0, len(shuffle))
+        self.assertEqual(1, len(self.source))
+
+        can_consume = True
+        self.source.append([["a", 2]])
+        self.finished = True
+        self.assertEqual([["a", [1, 2]]], self.pop_all(shuffle))
+        self.assertEqual([], self.source)
+
+    def test_values_must_be_pairs(self):
+        check_pairs([["a", 1]])
+        check_pairs({"a": 1})
+        with self.assertRaises(ValueError):
+            check_pairs([1, 2])
+
+        self.source.extend([[1, 2], [["a", 1]]])
+        self.finished = True
+        self.assertEqual([["a", [1]]], self.pop_all(self.shuffle))
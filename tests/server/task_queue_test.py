@@ -1,10 +1,12 @@
+import asyncio
 import unittest
 from unittest.mock import MagicMock, Mock
 from dipla.server import task_queue
 from dipla.server.task_queue import Task, TaskQueueNode
 from dipla.server.task_queue import DataSource, DataStreamer
-from dipla.server.task_queue import MachineType
+from dipla.server.task_queue import MachineType, PriorityMode
 from dipla.server.task_queue import TaskQueueEmpty, DataStreamerEmpty
+from dipla.server.result_cache import ResultCache
 
 
 class TaskQueueTest(unittest.TestCase):
@@ -279,6 +281,8 @@ class TaskQueueTest(unittest.TestCase):
         mock_task = MagicMock()
         mock_task.signals = ["FOO", "BAR"]
         mock_task.data_instructions = [MagicMock()]
+        # The task would otherwise appear to have a result cache
+        mock_task.result_cache = None
         node = TaskQueueNode(mock_task)
 
         task_input = node.next_input()
@@ -326,3 +330,456 @@ class TaskQueueTest(unittest.TestCase):
 
         with self.assertRaises(ValueError):
             self.queue.push_task_input("foo", [[1, 2], [1, 2]])
+
+    def test_ready_task_uids_are_in_push_order(self):
+        for uid in ["c", "a", "b"]:
+            task = Task(uid, "", MachineType.client)
+            task.add_data_source(
+                DataSource.create_source_from_iterable([1], uid + "src"))
+            self.queue.push_task(task)
+        empty_task = Task("empty", "", MachineType.client)
+        empty_task.add_data_source(
+            DataSource.create_source_from_iterable([], "emptysrc"))
+        self.queue.push_task(empty_task)
+
+        self.assertEqual(["c", "a", "b"], self.queue.ready_task_uids())
+
+    def test_pop_task_input_from_task_in_batch(self):
+        first_task = Task("foo", "", MachineType.client)
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([4, 5, 6], "b"))
+        second_task = Task("bar", "", MachineType.client)
+        second_task.add_data_source(
+            DataSource.create_source_from_iterable([7], "c"))
+        self.queue.push_task(first_task)
+        self.queue.push_task(second_task)
+
+        popped = self.queue.pop_task_input(task_uid="foo", batch_size=2)
+        self.assertEqual("foo", popped.task_uid)
+        self.assertEqual([[1, 2], [4, 5]], popped.values)
+        self.assertEqual(2, first_task.num_expected_results)
+
+        # The batch is cut short when the task runs out of input
+        popped = self.queue.pop_task_input(task_uid="foo", batch_size=5)
+        self.assertEqual([[3], [6]], popped.values)
+
+        with self.assertRaises(TaskQueueEmpty):
+            self.queue.pop_task_input(task_uid="foo")
+
+    def test_combined_result_counts_for_its_whole_batch(self):
+        sample_task = Task("foo", "", MachineType.client, combiner="add")
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        self.queue.push_task(sample_task)
+
+        popped = self.queue.pop_task_input(task_uid="foo", batch_size=3)
+        self.assertEqual("add", popped.combiner)
+        self.queue.add_result("foo", 6, num_inputs=3)
+        self.assertEqual([6], sample_task.task_output)
+        self.assertEqual(0, sample_task.in_flight())
+
+    def test_remaining_reduce_values_wait_for_the_task_read(self):
+        mapped = Task("map", "", MachineType.client)
+        mapped.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        reduced = Task("reduce", "", MachineType.client, is_reduce=True)
+        reduced.add_data_source(
+            DataSource.create_source_from_task(mapped, "b"))
+        self.queue.push_task(mapped)
+        self.queue.push_task(reduced)
+        self.queue.add_result("map", 1)
+        self.queue.add_result("map", 2)
+        self.assertEqual(2, self.queue.num_reduce_values("reduce"))
+        self.assertIsNone(self.queue.remaining_reduce_values("reduce"))
+
+        mapped.complete = True
+        self.queue.pop_task_input(task_uid="reduce")
+        self.assertEqual(0, self.queue.num_reduce_values("reduce"))
+        self.assertEqual(1, self.queue.remaining_reduce_values("reduce"))
+
+    def test_task_completed_early_is_not_finished(self):
+        def until_unavailable(streamer):
+            return not streamer.has_available_data()
+
+        source = Task("source", "", MachineType.client,
+                      complete_check=until_unavailable)
+        source.add_data_source(
+            DataSource.create_source_from_iterable([1, 2], "a"))
+        mapped = Task("map", "", MachineType.client,
+                      complete_check=until_unavailable)
+        mapped.add_data_source(
+            DataSource.create_source_from_task(source, "b"))
+        self.queue.push_task(source)
+        self.queue.push_task(mapped)
+        self.queue.pop_task_input(task_uid="source", batch_size=2)
+        self.queue.add_result("source", 1)
+        self.queue.pop_task_input(task_uid="map")
+        self.queue.add_result("map", 1)
+        # The map has used up what the source has produced so far
+        self.assertTrue(self.queue.is_task_complete("map"))
+        self.assertFalse(self.queue.is_task_finished("map"))
+
+        self.queue.add_result("source", 2)
+        self.assertFalse(self.queue.is_task_finished("map"))
+        self.queue.pop_task_input(task_uid="map")
+        self.queue.add_result("map", 2)
+        self.assertTrue(self.queue.is_task_finished("map"))
+
+    def push_pipeline(self):
+        # source -> map -> reduce, where the map and the reduce both have
+        # some input ready
+        source = Task("source", "", MachineType.client)
+        source.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        mapped = Task("map", "", MachineType.client)
+        mapped.add_data_source(
+            DataSource.create_source_from_task(source, "b"))
+        reduced = Task("reduce", "", MachineType.client)
+        reduced.add_data_source(
+            DataSource.create_source_from_task(mapped, "c"))
+        self.queue.push_task(source)
+        self.queue.push_task(mapped)
+        self.queue.push_task(reduced)
+        self.queue.add_result("source", 1)
+        self.queue.add_result("map", 1)
+
+    def test_insertion_priority_mode_pops_upstream_task_first(self):
+        self.push_pipeline()
+        self.assertEqual(
+            ["source", "map", "reduce"], self.queue.ready_task_uids())
+        self.assertEqual("source", self.queue.pop_task_input().task_uid)
+
+    def test_insertion_priority_mode_does_not_rely_on_dictionary_order(self):
+        self.push_pipeline()
+        self.queue.fuse_tasks("map", "reduce", "fused")
+        # Dictionaries on older versions of Python can be in any order
+        self.queue._nodes = dict(reversed(list(self.queue._nodes.items())))
+        self.queue.set_priority_mode(PriorityMode.insertion)
+        self.assertEqual(["source", "reduce"], self.queue.ready_task_uids())
+
+    def test_downstream_first_priority_mode_pops_downstream_task_first(self):
+        self.push_pipeline()
+        self.queue.set_priority_mode(PriorityMode.downstream_first)
+        self.assertEqual(
+            ["reduce", "map", "source"], self.queue.ready_task_uids())
+        self.assertEqual("reduce", self.queue.pop_task_input().task_uid)
+
+    def test_critical_path_priority_mode_prefers_longest_chain(self):
+        self.push_pipeline()
+        short_task = Task("short", "", MachineType.client)
+        short_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "d"))
+        self.queue.push_task(short_task)
+        self.queue.set_priority_mode(PriorityMode.critical_path)
+        self.assertEqual(
+            ["source", "map", "reduce", "short"],
+            self.queue.ready_task_uids())
+
+    def test_planned_priority_mode_prefers_highest_priority(self):
+        self.push_pipeline()
+        self.queue.get_task("map").priority = 5
+        self.queue.get_task("reduce").priority = 2
+        self.queue.set_priority_mode(PriorityMode.planned)
+        self.assertEqual(
+            ["map", "reduce", "source"], self.queue.ready_task_uids())
+
+    def test_held_tasks_are_not_popped(self):
+        self.push_pipeline()
+        self.queue.set_held_tasks(["source", "map"])
+        self.assertEqual(["reduce"], self.queue.ready_task_uids())
+        self.assertEqual("reduce", self.queue.pop_task_input().task_uid)
+
+        self.queue.set_held_tasks([])
+        self.assertTrue(self.queue.has_next_input())
+
+    def test_max_in_flight_limits_popped_input(self):
+        sample_task = Task("foo", "", MachineType.client, max_in_flight=2)
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3, 4], "bar"))
+        self.queue.push_task(sample_task)
+
+        popped = self.queue.pop_task_input(batch_size=3)
+        self.assertEqual([[1, 2]], popped.values)
+        self.assertFalse(self.queue.has_next_input())
+
+        self.queue.add_result("foo", "result")
+        self.assertTrue(self.queue.has_next_input())
+        self.assertEqual([[3]], self.queue.pop_task_input().values)
+
+    def test_full_output_buffer_stops_popping_input(self):
+        sample_task = Task("foo", "", MachineType.client,
+                           max_buffered_output=1)
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "bar"))
+        self.queue.push_task(sample_task)
+
+        self.queue.pop_task_input()
+        self.queue.add_result("foo", "result")
+        self.assertTrue(sample_task.is_output_full())
+        self.assertFalse(self.queue.has_next_input())
+
+        del sample_task.task_output[:]
+        self.assertTrue(self.queue.has_next_input())
+        self.assertEqual([[2]], self.queue.pop_task_input().values)
+
+    def test_cached_inputs_are_not_popped(self):
+        cache = ResultCache(':memory:')
+        sample_task = Task(
+            "foo", "", MachineType.client,
+            complete_check=lambda streamer: not streamer.has_available_data(),
+            result_cache=cache, cache_namespace="f")
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "bar"))
+        cache.put(sample_task.cached_result_key([[1]]), "one")
+        cache.put(sample_task.cached_result_key([[2]]), "two")
+        self.queue.push_task(sample_task)
+
+        popped = self.queue.pop_task_input(batch_size=1)
+        self.assertEqual([[3]], popped.values)
+        self.assertEqual([sample_task.cached_result_key([[3]])],
+                         popped.cache_keys)
+        self.assertEqual(["one", "two"], sample_task.task_output)
+
+        self.queue.add_result("foo", "three")
+        self.assertTrue(self.queue.is_task_complete("foo"))
+
+    def test_fully_cached_input_is_empty(self):
+        cache = ResultCache(':memory:')
+        sample_task = Task("foo", "", MachineType.client,
+                           result_cache=cache, cache_namespace="f")
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "bar"))
+        cache.put(sample_task.cached_result_key([[1]]), "one")
+        self.queue.push_task(sample_task)
+
+        self.assertTrue(self.queue.pop_task_input().is_empty())
+        self.assertEqual(["one"], sample_task.task_output)
+        self.assertFalse(self.queue.has_next_input())
+
+    def test_get_dependee_and_dependency_ids(self):
+        source_task = Task("source", "", MachineType.client)
+        source_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "d"))
+        self.queue.push_task(source_task)
+        self.assertEqual([], self.queue.get_dependee_ids("source"))
+
+        map_task = Task("map", "", MachineType.client)
+        map_task.add_data_source(
+            DataSource.create_source_from_task(source_task, "e"))
+        self.queue.push_task(map_task)
+        self.assertEqual(["map"], self.queue.get_dependee_ids("source"))
+        self.assertEqual(["source"], self.queue.get_dependency_ids("map"))
+
+    def test_is_subgraph_inactive(self):
+        source_task = Task("source", "", MachineType.client)
+        source_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "d"))
+        self.queue.push_task(source_task)
+        other_task = Task("other", "", MachineType.client)
+        other_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "o"))
+        self.queue.push_task(other_task)
+        map_task = Task("map", "", MachineType.client)
+        map_task.add_data_source(
+            DataSource.create_source_from_task(source_task, "e"))
+        self.queue.push_task(map_task)
+
+        self.assertFalse(self.queue.is_subgraph_inactive("map"))
+        self.queue.cancel_task("source")
+        self.assertTrue(self.queue.is_subgraph_inactive("map"))
+        self.assertFalse(self.queue.is_inactive())
+
+    def test_iterator_source_pulls_values_lazily(self):
+        pulled = []
+
+        def values():
+            for i in range(1000):
+                pulled.append(i)
+                yield i
+
+        sample_task = Task("foo", "", MachineType.client)
+        sample_task.add_data_source(DataSource.create_source_from_iterator(
+            values(), "bar", prefetch=3))
+        self.queue.push_task(sample_task)
+
+        self.assertEqual([[0, 1]], self.queue.pop_task_input(
+            batch_size=2).values)
+        self.assertLessEqual(len(pulled), 5)
+
+    def use_new_event_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        return loop
+
+    def test_async_iterator_source_waits_for_values(self):
+        loop = self.use_new_event_loop()
+        more_values = asyncio.Event()
+
+        source = DataSource.create_source_from_iterator(
+            AsyncValues([1, 2], wait_before_last=more_values), "bar")
+        streamer = source.data_streamer
+        self.assertFalse(streamer.has_available_data())
+        self.assertTrue(streamer.is_waiting())
+
+        loop.run_until_complete(asyncio.sleep(0))
+        # The last value pulled is held back until the iterator ends
+        self.assertFalse(streamer.has_available_data())
+        more_values.set()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual([1], streamer.read())
+        self.assertEqual([2], streamer.read())
+        self.assertFalse(streamer.is_waiting())
+
+    def test_async_iterator_source_error_fails_the_reading_task(self):
+        loop = self.use_new_event_loop()
+        error = ValueError("foo")
+        sample_task = Task("foo", "", MachineType.client)
+        sample_task.add_data_source(DataSource.create_source_from_iterator(
+            AsyncValues([1], error=error), "bar"))
+        self.queue.push_task(sample_task)
+        streamer = sample_task.data_instructions[0].data_streamer
+
+        self.assertFalse(self.queue.has_next_input())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertFalse(streamer.is_waiting())
+        self.assertTrue(sample_task.cancelled)
+        self.assertIs(error, sample_task.error)
+        self.assertTrue(self.queue.is_task_complete("foo"))
+
+    def test_cancel_task_discards_input_and_ignores_results(self):
+        sample_task = Task("foo", "", MachineType.client)
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "bar"))
+        self.queue.push_task(sample_task)
+        self.queue.pop_task_input()
+
+        self.queue.cancel_task("foo")
+        self.assertFalse(self.queue.has_next_input())
+        self.assertTrue(self.queue.is_task_complete("foo"))
+        self.assertTrue(self.queue.is_inactive())
+
+        self.queue.add_result("foo", "late result")
+        self.assertEqual([], sample_task.task_output)
+
+    def test_cancel_task_completes_drained_dependees(self):
+        first_task = Task("first", "", MachineType.client)
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        second_task = Task(
+            "second", "", MachineType.client,
+            complete_check=lambda streamer: not streamer.has_available_data())
+        second_task.add_data_source(
+            DataSource.create_source_from_task(first_task, "b"))
+        third_task = Task("third", "", MachineType.server)
+        third_task.add_data_source(
+            DataSource.create_source_from_task(second_task, "c"))
+        self.queue.push_task(first_task)
+        self.queue.push_task(second_task)
+        self.queue.push_task(third_task)
+
+        self.queue.pop_task_input(task_uid="first")
+        self.queue.add_result("first", "found it")
+        self.queue.cancel_task("first")
+
+        # The result produced before cancelling can still be used
+        self.assertEqual(["second"], self.queue.ready_task_uids())
+        self.queue.pop_task_input(task_uid="second")
+        self.assertFalse(self.queue.is_task_complete("second"))
+        self.queue.add_result("second", "used it")
+        self.assertTrue(self.queue.is_task_complete("second"))
+
+    def test_cancel_task_completes_dependees_with_no_input(self):
+        first_task = Task("first", "", MachineType.client)
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2, 3], "a"))
+        second_task = Task("second", "", MachineType.client)
+        second_task.add_data_source(
+            DataSource.create_source_from_task(first_task, "b"))
+        self.queue.push_task(first_task)
+        self.queue.push_task(second_task)
+
+        self.queue.cancel_task("first")
+        self.assertTrue(self.queue.is_task_complete("second"))
+        self.assertTrue(self.queue.is_inactive())
+
+    def test_result_failing_a_check_fails_the_reading_task(self):
+        first_task = Task("first", "", MachineType.client)
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([1, 2], "a"))
+        second_task = Task("second", "", MachineType.client)
+        second_task.add_data_source(
+            DataSource.create_source_from_task(first_task, "b"))
+        self.queue.push_task(first_task)
+        self.queue.push_task(second_task)
+        error = ValueError("not a number")
+
+        def check(result):
+            if not isinstance(result, int):
+                raise error
+        first_task.result_checks["second"] = check
+
+        self.queue.pop_task_input(task_uid="first", batch_size=2)
+        self.queue.add_result("first", 2)
+        self.assertFalse(second_task.cancelled)
+        self.queue.add_result("first", "two")
+        self.assertTrue(second_task.cancelled)
+        self.assertIs(error, second_task.error)
+        self.assertFalse(first_task.cancelled)
+
+    def test_cancel_missing_task(self):
+        with self.assertRaises(KeyError):
+            self.queue.cancel_task("foo")
+
+    def test_remove_finished_tasks(self):
+        first_task = Task("first", "", MachineType.client)
+        first_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "a"))
+        second_task = Task("second", "", MachineType.client)
+        second_task.add_data_source(
+            DataSource.create_source_from_task(first_task, "b"))
+        self.queue.push_task(first_task)
+        self.queue.push_task(second_task)
+        self.queue.cancel_task("first")
+
+        with self.assertRaises(ValueError):
+            self.queue.remove_tasks(["first"])
+
+        self.queue.remove_tasks(["second"])
+        self.assertEqual(["first"], list(self.queue.get_task_ids()))
+        self.assertEqual([], self.queue.get_dependee_ids("first"))
+
+    def test_remove_active_task(self):
+        sample_task = Task("foo", "", MachineType.client)
+        sample_task.add_data_source(
+            DataSource.create_source_from_iterable([1], "a"))
+        self.queue.push_task(sample_task)
+        with self.assertRaises(ValueError):
+            self.queue.remove_tasks(["foo"])
+
+
+class AsyncValues:
+    """
+    An async iterator over a list of values, which can wait for an event
+    before its last value and raise an error once the values run out
+    """
+
+    def __init__(self, values, wait_before_last=None, error=None):
+        self.values = list(values)
+        self.wait_before_last = wait_before_last
+        self.error = error
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.values:
+            if self.error is not None:
+                raise self.error
+            raise StopAsyncIteration
+        if len(self.values) == 1 and self.wait_before_last is not None:
+            await self.wait_before_last.wait()
+        return self.values.pop(0)
@@ -79,3 +79,21 @@ class WorkerGroupTest(unittest.TestCase):
 
         with self.assertRaises(KeyError):
             self.group.return_worker("Z")
+
+    def test_lease_worker_by_uid(self):
+        self.group.add_worker(Worker("A", None, quality=0.5))
+        self.group.add_worker(Worker("B", None, quality=0.9))
+        self.assertEqual("B", self.group.lease_worker("B").uid)
+        available = self.group.available_workers()
+        self.assertEqual(["A"], [w.uid for w in available])
+
+        with self.assertRaises(KeyError):
+            self.group.lease_worker("B")
+
+    def test_worker_satisfies_reported_resources(self):
+        worker = Worker("A", None, quality=1)
+        worker.resources = {"cpu": 4, "mem_mb": 1000, "numpy": False}
+        self.assertTrue(worker.satisfies({"cpu": 4, "mem_mb": 500}))
+        self.assertFalse(worker.satisfies({"mem_mb": 2000}))
+        self.assertFalse(worker.satisfies({"numpy": True}))
+        self.assertFalse(worker.satisfies({"disk_mb": 1}))
@@ -0,0 +1,33 @@
+import os
+import tempfile
+import unittest
+from base64 import b64encode
+
+from dipla.shared.arguments import load_argument
+
+
+class LoadArgumentTest(unittest.TestCase):
+
+    def read_broadcast(self, value):
+        return '[1, 2]' if value == {'broadcast': 'key'} else None
+
+    def test_values_that_refer_to_nothing_are_unchanged(self):
+        self.assertEqual(3, load_argument(3, self.read_broadcast))
+        self.assertEqual({'a': 1}, load_argument({'a': 1},
+                                                 self.read_broadcast))
+
+    def test_broadcasts_are_read_as_json(self):
+        self.assertEqual([1, 2], load_argument({'broadcast': 'key'},
+                                               self.read_broadcast))
+
+    def test_file_parts_are_read(self):
+        handle, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b'hello world')
+
+        split = {'__dipla_file_split__': [path, 6, 5], 'encoding': 'utf-8'}
+        self.assertEqual('world', load_argument(split, self.read_broadcast))
+        contents = {'__dipla_file_bytes__': b64encode(b'hi').decode('ascii'),
+                    'encoding': None}
+        self.assertEqual(b'hi', load_argument(contents, self.read_broadcast))
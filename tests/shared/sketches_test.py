@@ -0,0 +1,105 @@
+import unittest
+
+from dipla.shared import sketches
+
+
+class TopKTest(unittest.TestCase):
+
+    def test_most_frequent_items_are_found(self):
+        top_k = sketches.TopK(2, counters=3)
+        top_k.update(["a"] * 10 + ["b", "c", "d", "e"] + ["f"] * 6)
+        self.assertEqual(["a", "f"], [item for item, _ in top_k.top()])
+        self.assertEqual(10, top_k.estimate("a"))
+        self.assertLessEqual(top_k.estimate("f") - top_k.error("f"), 6)
+
+    def test_merged_counts_are_added(self):
+        first = sketches.TopK(2).update({"a": 5, "b": 1})
+        second = sketches.TopK(2).update({"a": 2, "c": 4})
+        first.merge(second)
+        self.assertEqual([["a", 7], ["c", 4]], first.top())
+        self.assertEqual(12, first.total)
+
+    def test_encoding_round_trips(self):
+        top_k = sketches.TopK(2).update({"a": 5, 3: 2})
+        decoded = sketches.decode(top_k.encode())
+        self.assertIsInstance(decoded, sketches.TopK)
+        self.assertEqual(top_k.top(), decoded.top())
+
+
+class CountMinTest(unittest.TestCase):
+
+    def test_estimates_are_never_under(self):
+        count_min = sketches.CountMin(width=8, depth=3)
+        items = {str(i): i for i in range(20)}
+        count_min.update(items)
+        for item, count in items.items():
+            self.assertGreaterEqual(count_min.estimate(item), count)
+
+    def test_merging_adds_counts(self):
+        first = sketches.CountMin().update({"a": 3})
+        second = sketches.CountMin().update({"a": 4, "b": 1})
+        merged = sketches.decode(first.merge(second).encode())
+        self.assertEqual(7, merged.estimate("a"))
+        self.assertEqual(8, merged.total)
+
+    def test_different_sizes_cannot_be_merged(self):
+        with self.assertRaises(ValueError):
+            sketches.CountMin(width=8).merge(sketches.CountMin(width=16))
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def test_distinct_items_are_estimated(self):
+        hyper_log_log = sketches.HyperLogLog()
+        hyper_log_log.update(list(range(5000)) * 2)
+        self.assertAlmostEqual(5000, hyper_log_log.count(), delta=250)
+
+    def test_merged_estimate_counts_shared_items_once(self):
+        first = sketches.HyperLogLog().update(range(0, 3000))
+        second = sketches.HyperLogLog().update(range(2000, 5000))
+        merged = sketches.decode(sketches.merge_encoded(
+            [first.encode(), second.encode()]))
+        self.assertAlmostEqual(5000, merged.count(), delta=250)
+
+    def test_encoding_is_compact(self):
+        self.assertEqual(2 + 4096, len(sketches.HyperLogLog().to_bytes()))
+
+
+class ReservoirTest(unittest.TestCase):
+
+    def test_sample_is_kept_to_its_size(self):
+        reservoir = sketches.Reservoir(size=5, seed=1).update(range(100))
+        self.assertEqual(5, len(reservoir.sample))
+        self.assertEqual(100, reservoir.seen)
+        self.assertTrue(set(reservoir.sample) <= set(range(100)))
+
+    def test_merged_sample_draws_from_both(self):
+        first = sketches.Reservoir(size=10, seed=1).update(range(3))
+        second = sketches.Reservoir(size=10, seed=2).update(range(3, 6))
+        first.merge(second)
+        self.assertEqual(list(range(6)), sorted(first.sample))
+
+        merged = sketches.decode(first.encode())
+        self.assertEqual(sorted(first.sample), sorted(merged.sample))
+        self.assertEqual(6, merged.seen)
+
+    def test_different_sizes_cannot_be_merged(self):
+        first = sketches.Reservoir(size=10).update(range(20))
+        second = sketches.Reservoir(size=5).update(range(20))
+        with self.assertRaises(ValueError):
+            first.merge(second)
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_unknown_data_is_rejected(self):
+        with self.assertRaises(ValueError):
+            sketches.from_bytes(b'\x00')
+
+    def test_sketch_is_abstract(self):
+        with self.assertRaises(TypeError):
+            sketches.Sketch()
+
+    def test_different_kinds_cannot_be_merged(self):
+        with self.assertRaises(ValueError):
+            sketches.TopK(1).merge(sketches.HyperLogLog())